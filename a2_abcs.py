@@ -4,6 +4,7 @@
 
 import platform
 import abc
+import itertools
 import torch
 import warnings
 
@@ -214,6 +215,12 @@ class DecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
     See :func:`__init__` and :func:`init_submodules` for a description of the
     attributes.
 
+    When called, the encoder states `h` and lengths `F_lens` may be shared by
+    groups of consecutive rows of `E_tm1` and `htilde_tm1`. If `h` holds
+    ``N' = N / K`` sentences for ``N`` rows, the ``n``-th row decodes the
+    ``(n // K)``-th sentence. This lets a beam search keep one copy of the
+    encoder states per sentence rather than one per path.
+
     Attributes
     ----------
     target_vocab_size : int
@@ -224,8 +231,24 @@ class DecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
     embedding : torch.nn.Embedding
     cell : {torch.nn.GRUCell, torch.nn.LSTMCell, torch.nn.RNNCell}
     ff : torch.nn.Linear
+    target_vocab : torch.LongTensor or None
+        If set, a sorted long tensor of shape ``(V',)`` of the only target ids
+        to compute logits for, as with a vocabulary shortlist. The logits
+        then have shape ``(N, V')``, where ``logits_t[n, i]`` is for the
+        token ``target_vocab[i]``.
+    output_index : object or None
+        If set, :func:`get_current_logits` outside of training returns
+        ``output_index.search(htilde_t)``: log-probabilities, already
+        normalized, of only some of the target words for each row, such as
+        those an approximate search deems most likely. After each call,
+        ``output_index.candidates`` is a long tensor of the same shape whose
+        ``[n, i]`` is the token of ``logits_t[n, i]``. It must always include
+        the end-of-sequence token. Takes precedence over `target_vocab`.
     '''
 
+    target_vocab = None
+    output_index = None
+
     def __init__(
             self, target_vocab_size, pad_id=-1, word_embedding_size=1024,
             hidden_state_size=1024, cell_type='lstm'):
@@ -303,8 +326,11 @@ class DecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
         _dim_check('h', h, 3)
         _dim_check('F_lens', F_lens, 1)
         batch_size = E_tm1.shape[0]
-        if h.shape[1] != batch_size or F_lens.shape[0] != batch_size:
+        if F_lens.shape[0] != h.shape[1] or batch_size % h.shape[1]:
             raise RuntimeError('batch sizes not consistent')
+        if htilde_tm1 is None and h.shape[1] != batch_size:
+            raise RuntimeError(
+                'htilde_tm1 must be set when h is shared between rows')
         if htilde_tm1 is not None:
             if self.cell_type == 'lstm':
                 htilde_tm1, c_t = htilde_tm1
@@ -404,10 +430,12 @@ class DecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
             ``i``-th index of the encoder RNN's last hidden state at time ``s``
             of the ``n``-th sequence in the batch. The states of the
             encoder have been right-padded such that ``h[F_lens[n]:, n]``
-            should all be ignored.
+            should all be ignored. May instead be of shape
+            ``(S, N / K, self.hidden_state_size)`` and shared by groups of
+            ``K`` rows, as described in :class:`DecoderBase`.
         F_lens : torch.LongTensor
-            An integer tensor of shape ``(N,)`` corresponding to the lengths
-            of the encoded source sentences.
+            An integer tensor of shape ``(N,)`` (or ``(N / K,)``, like `h`)
+            corresponding to the lengths of the encoded source sentences.
 
         Returns
         -------
@@ -482,11 +510,119 @@ class DecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
             A float tensor of shape ``(N, self.target_vocab_size)``.
             ``logits_t[n]`` is an un-normalized distribution over the next
             target word for the ``n``-th sequence:
-            ``Pr_b(i) = softmax(logits_t[n])``
+            ``Pr_b(i) = softmax(logits_t[n])``. Of shape
+            ``(N, len(self.target_vocab))`` if `target_vocab` is set. Not
+            logits but log-probabilities if `output_index` is set.
         '''
         raise NotImplementedError()
 
 
+class BeamLattice(object):
+    '''The token histories of a batch of beams, stored as backpointers
+
+    Rather than copying every path at every step of a beam search, the
+    lattice stores just the token each path appended and the index of the
+    path it extended, into a buffer allocated up front. Whole paths are
+    followed back through the pointers only when they are asked for.
+
+    Parameters
+    ----------
+    b_0 : torch.LongTensor
+        A long tensor of shape ``(N, K)`` of the first token of every path.
+    capacity : int, optional
+        How many steps to allocate room for. The buffer grows by doubling
+        if more are needed.
+
+    Attributes
+    ----------
+    tokens : torch.LongTensor
+        A long tensor of shape ``(capacity, N, K)`` where ``tokens[start + t',
+        n, k]`` is the token the ``k``-th path of the ``n``-th beam appended
+        at step ``t'``.
+    parents : torch.LongTensor
+        Of the same shape as `tokens`, where ``parents[start + t', n, k]``
+        indexes the path at step ``t' - 1`` that path ``k`` extended.
+    start, end : int
+        The stored steps are ``tokens[start:end]``.
+    '''
+
+    def __init__(self, b_0, capacity=64):
+        N, K = b_0.shape
+        self.tokens = b_0.new_empty((max(capacity, 1), N, K))
+        self.parents = torch.empty_like(self.tokens)
+        self.tokens[0] = b_0
+        self.parents[0] = torch.arange(K, device=b_0.device)
+        self.start, self.end = 0, 1
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def last(self):
+        '''The ``(N, K)`` tokens appended at the latest step'''
+        return self.tokens[self.end - 1]
+
+    def append(self, parents, tokens):
+        '''Record a step, where path k of beam n extended parents[n, k]'''
+        if self.end == self.tokens.shape[0]:
+            self._resize(max(self.tokens.shape[0], 2 * len(self)))
+        self.tokens[self.end] = tokens
+        self.parents[self.end] = parents
+        self.end += 1
+
+    def paths(self, select=None):
+        '''Follow the backpointers into paths of shape ``(t, N', K)``
+
+        `select` optionally indexes the beams to follow.
+        '''
+        tokens = self.tokens[self.start:self.end]
+        parents = self.parents[self.start:self.end]
+        if select is not None:
+            tokens, parents = tokens[:, select], parents[:, select]
+        b_1 = torch.empty_like(tokens)
+        k = torch.arange(tokens.shape[2], device=tokens.device)
+        k = k.expand_as(tokens[0])  # (N', K)
+        for t in range(tokens.shape[0] - 1, -1, -1):
+            b_1[t] = tokens[t].gather(1, k)
+            k = parents[t].gather(1, k)
+        return b_1
+
+    def keep(self, keep):
+        '''Drop the beams where `keep` is False'''
+        self._resize(self.tokens.shape[0], keep)
+
+    def forget(self, t):
+        '''Drop all but the latest `t` steps'''
+        self.start = max(self.start, self.end - t)
+
+    def join(self, other):
+        '''Append the beams of `other`, a lattice of a single step
+
+        The new beams are padded back in time with their first token.
+        '''
+        assert len(other) == 1
+        tokens = torch.cat([
+            self.tokens[self.start:self.end],
+            other.last.expand(len(self), -1, -1)], 1)
+        parents = torch.cat([
+            self.parents[self.start:self.end],
+            other.parents[0].expand(len(self), -1, -1)], 1)
+        self._store(tokens, parents, self.tokens.shape[0])
+
+    def _resize(self, capacity, keep=slice(None)):
+        # copy the stored steps of the kept beams to the start of a new buffer
+        self._store(
+            self.tokens[self.start:self.end, keep],
+            self.parents[self.start:self.end, keep], capacity)
+
+    def _store(self, tokens, parents, capacity):
+        self.tokens = tokens.new_empty((capacity,) + tokens.shape[1:])
+        self.parents = torch.empty_like(self.tokens)
+        self.start, self.end = 0, tokens.shape[0]
+        self.tokens[:self.end] = tokens
+        self.parents[:self.end] = parents
+
+
 class EncoderDecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
     '''Decode a source transcription into a target transcription
 
@@ -508,8 +644,27 @@ class EncoderDecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
     beam_width : int
     encoder : EncoderBase
     decoder : DecoderBase
+    beam_rows_decoded : int
+        The number of rows (paths times steps) :func:`beam_search` has run
+        through the decoder since the model was made. Reset it freely.
+    beam_rows_skipped : int
+        The number of rows :func:`beam_search` would also have run through the
+        decoder had it kept decoding sentences whose every path had finished.
+    shortlist : torch.LongTensor or None
+        If set, a long tensor of shape ``(self.source_vocab_size, M)`` where
+        ``shortlist[f]`` are the target ids most likely to translate the
+        source id ``f``, right-padded with ``-1``. Beam search then only
+        scores the target words on the shortlists of the words in the batch,
+        plus the `shortlist_frequent` most frequent ones. See
+        :func:`a2_dataloader.build_shortlist`.
+    shortlist_frequent : int
+        Target ids below this are always scored when `shortlist` is set.
+        Vocabularies number words from most to least frequent.
     '''
 
+    shortlist = None
+    shortlist_frequent = 0
+
     def __init__(
             self, encoder_class, decoder_class,
             source_vocab_size, target_vocab_size, source_pad_id=-1,
@@ -611,6 +766,7 @@ class EncoderDecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
         self.encoder_dropout = encoder_dropout
         self.cell_type = cell_type
         self.beam_width = beam_width
+        self.beam_rows_decoded = self.beam_rows_skipped = 0
         self.encoder = self.decoder = None
         self.init_submodules(encoder_class, decoder_class)
         assert isinstance(self.encoder, encoder_class)
@@ -707,8 +863,41 @@ class EncoderDecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
         h = self.encoder(F, F_lens)  # (S, N, 2 * H)
         if self.training:
             return self.get_logits_for_teacher_forcing(h, F_lens, E)
-        else:
+        if self.shortlist is None:
+            return self.beam_search(h, F_lens, max_T, on_max)
+        self.decoder.target_vocab = self.get_target_vocab(F)
+        try:
             return self.beam_search(h, F_lens, max_T, on_max)
+        finally:
+            self.decoder.target_vocab = None
+
+    def get_target_vocab(self, F):
+        '''Get the target ids the shortlist allows for some source ids
+
+        Parameters
+        ----------
+        F : torch.LongTensor
+            A long tensor of source ids of any shape. Padding is fine: the
+            padding id never appears in the data the shortlist is built from,
+            so it has no candidates.
+
+        Returns
+        -------
+        target_vocab : torch.LongTensor
+            A sorted long tensor of shape ``(V',)`` of the union of the
+            shortlists of `F`, the `shortlist_frequent` most frequent target
+            ids, and ``self.target_eos``.
+        '''
+        shortlist = self.shortlist.to(F.device)
+        candidates = shortlist[F.flatten()].flatten()
+        candidates = torch.cat([
+            candidates[candidates >= 0],
+            torch.arange(
+                min(self.shortlist_frequent, self.target_vocab_size),
+                device=F.device),
+            torch.tensor([self.target_eos], device=F.device),
+        ])
+        return torch.unique(candidates)
 
     @abc.abstractmethod
     def get_logits_for_teacher_forcing(self, h, F_lens, E):
@@ -749,9 +938,256 @@ class EncoderDecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
         '''
         raise NotImplementedError()
 
+    def get_packed_logits_for_teacher_forcing(self, h, F_lens, E, keep):
+        '''Get the logits of only some positions via teacher forcing
+
+        The default picks them out of :func:`get_logits_for_teacher_forcing`.
+        Subclasses can skip computing the rest.
+
+        Parameters
+        ----------
+        h, F_lens, E
+            As in :func:`get_logits_for_teacher_forcing`.
+        keep : torch.BoolTensor
+            A boolean tensor of shape ``(T - 1, N)`` of the positions to
+            compute logits for.
+
+        Returns
+        -------
+        logits : torch.FloatTensor
+            A float tensor of shape ``(M, self.target_vocab_size)``, where
+            ``M`` is the number of positions in `keep`. ``logits[m]`` is
+            ``get_logits_for_teacher_forcing(h, F_lens, E)[t, n]`` for the
+            ``m``-th position ``(t, n)`` of `keep`, in order of ``t``, then
+            ``n``.
+        '''
+        logits = self.get_logits_for_teacher_forcing(h, F_lens, E)
+        return logits[keep]
+
+    def get_packed_hidden_states_for_teacher_forcing(self, h, F_lens, E, keep):
+        '''Get the decoder states of only some positions via teacher forcing
+
+        These are what the output layer turns into the logits of
+        :func:`get_packed_logits_for_teacher_forcing`. Subclasses need not
+        implement this, in which case ``forward_packed(..., states=True)``
+        is unavailable.
+
+        Parameters
+        ----------
+        h, F_lens, E, keep
+            As in :func:`get_packed_logits_for_teacher_forcing`.
+
+        Returns
+        -------
+        htilde : torch.FloatTensor
+            A float tensor of shape ``(M, 2 * self.encoder_hidden_size)``,
+            ordered like the logits of
+            :func:`get_packed_logits_for_teacher_forcing`. Cell states are
+            discarded.
+        '''
+        raise NotImplementedError()
+
+    def forward_packed(self, F, F_lens, E, states=False):
+        '''Teacher force, computing logits for non-padding targets only
+
+        The output layer is the most expensive part of teacher forcing. This
+        skips it for the end-of-sequence padding that the loss would ignore
+        anyway.
+
+        Parameters
+        ----------
+        F, F_lens, E
+            As in :func:`forward`.
+        states : bool, optional
+            If set, return the decoder states the logits would be computed
+            from rather than the logits, leaving the output layer to the
+            caller (e.g. to fuse it with the loss).
+
+        Returns
+        -------
+        logits : torch.FloatTensor
+            A float tensor of shape ``(M, self.target_vocab_size)`` of the
+            logits of the ``M`` targets in ``E[1:]`` that are not padding
+            (see :func:`get_target_padding_mask`), in order of time step,
+            then batch element. If `states` is set, the decoder states of
+            shape ``(M, 2 * self.encoder_hidden_size)`` instead.
+        E_packed : torch.LongTensor
+            A long tensor of shape ``(M,)`` of those targets.
+        '''
+        if not self.training:
+            raise RuntimeError('forward_packed is for training only')
+        self.check_input(F, F_lens, E, None, 'ignore')
+        h = self.encoder(F, F_lens)  # (S, N, 2 * H)
+        keep = ~self.get_target_padding_mask(E[1:])  # (T - 1, N)
+        if states:
+            out = self.get_packed_hidden_states_for_teacher_forcing(
+                h, F_lens, E, keep)
+        else:
+            out = self.get_packed_logits_for_teacher_forcing(
+                h, F_lens, E, keep)
+        return out, E[1:][keep]
+
     def beam_search(self, h, F_lens, max_T, on_max):
         # beam search
         assert not self.training
+        htilde_tm1, logpb_tm1, lattice = self._start_beams(
+            h, F_lens, max_T + 1 if on_max != 'ignore' else 64)
+        # Sentences still being decoded and the beams of the ones set aside
+        N = h.shape[1]
+        active = torch.arange(N, device=h.device)
+        done = []
+        t = 0
+        while torch.any(lattice.last[:, 0] != self.target_eos):
+            if t == max_T:
+                if on_max == 'raise':
+                    raise RuntimeError(
+                        f'Beam search has not finished by t={t}. Increase the '
+                        f'number of parameters and train longer')
+                elif on_max == 'halt':
+                    warnings.warn(f'Beam search not finished by t={t}. Halted')
+                    break
+            htilde_tm1, logpb_tm1 = self._extend_beams(
+                htilde_tm1, lattice, logpb_tm1, h, F_lens,
+                torch.full_like(active, t))
+            t += 1
+            self.beam_rows_skipped += (N - active.shape[0]) * self.beam_width
+            # Once every path of a sentence has finished, all it can do is
+            # append <eos> with log prob 0, which changes neither its paths
+            # nor their order. We set its beam aside and stop decoding it
+            is_done = torch.all(lattice.last == self.target_eos, 1)  # (N',)
+            if torch.any(is_done):
+                done.append((active[is_done], lattice.paths(is_done)))
+                keep = ~is_done
+                active = active[keep]
+                h, F_lens, htilde_tm1, logpb_tm1 = self._keep_beams(
+                    keep, h, F_lens, htilde_tm1, logpb_tm1, lattice)
+        # the paths are only followed back through the lattice once done
+        b_tm1_1 = lattice.paths()
+        if not done:
+            return b_tm1_1
+        # scatter the beams back, padding the early ones with <eos> as if
+        # they'd been decoded until the end
+        b_1 = torch.full(
+            (b_tm1_1.shape[0], N, self.beam_width), self.target_eos,
+            dtype=torch.long, device=b_tm1_1.device)
+        b_1[:, active] = b_tm1_1
+        for idx, b_tm1_1 in done:
+            b_1[:b_tm1_1.shape[0], idx] = b_tm1_1
+        return b_1
+
+    def beam_search_stream(
+            self, sentences, batch_size, max_T=100, on_max='halt'):
+        '''Beam search over a stream of source sentences
+
+        Keeps up to `batch_size` sentences in the search at once. As soon as
+        the top path of a sentence ends, the sentence is handed back and the
+        next ones from `sentences` are encoded and take its place, so the
+        decoder keeps working on ``batch_size * self.beam_width`` paths
+        until the stream runs dry.
+
+        Each sentence stops as soon as its top path ends, exactly as if it
+        were searched alone. A batch passed to :func:`beam_search` keeps
+        extending the other paths of a sentence until every sentence in the
+        batch is done, so the two can disagree on the odd sentence.
+
+        Parameters
+        ----------
+        sentences : iterable
+            Yields long tensors of shape ``(S_i,)``, the source sentences.
+            They must be on the same device as the model.
+        batch_size : int
+            The number of sentences to search at once.
+        max_T : int, optional
+            The maximum number of steps to search a sentence for.
+        on_max : {'halt', 'raise', 'ignore'}, optional
+            What to do with a sentence still going after `max_T` steps: return
+            it as is with a warning, raise a :class:`RuntimeError`, or keep
+            going.
+
+        Yields
+        ------
+        i : int
+            The index of a finished sentence in `sentences`. Sentences are
+            yielded in the order they finish.
+        b_1 : torch.LongTensor
+            A long tensor of shape ``(T_i, self.beam_width)`` holding the
+            paths of the sentence's beam, as ``beam_search(...)[:, 0]`` would
+            for the sentence alone.
+        '''
+        assert not self.training
+        _in_range_check('batch_size', batch_size, 1)
+        sentences = enumerate(sentences)
+        htilde_tm1 = h = None
+        ids, sources = [], []
+        changed = False
+        while True:
+            # top up the search with new sentences
+            new = list(itertools.islice(sentences, batch_size - len(ids)))
+            if new:
+                ids += [i for i, _ in new]
+                F_new = [F_i for _, F_i in new]
+                sources += F_new
+                changed = True
+                F_lens_new = torch.tensor(
+                    [F_i.shape[0] for F_i in F_new], device=F_new[0].device)
+                F_new = torch.nn.utils.rnn.pad_sequence(
+                    F_new, padding_value=self.source_pad_id)
+                self.check_input(F_new, F_lens_new, None, max_T, on_max)
+                h_new = self.encoder(F_new, F_lens_new)
+                beams = self._start_beams(
+                    h_new, F_lens_new,
+                    max_T + 1 if on_max != 'ignore' else 64)
+                if h is None:
+                    h, F_lens = h_new, F_lens_new
+                    htilde_tm1, logpb_tm1, lattice = beams
+                    t = torch.zeros_like(F_lens)
+                else:
+                    h, F_lens, htilde_tm1, logpb_tm1 = self._join_beams(
+                        (h, F_lens, htilde_tm1, logpb_tm1, lattice),
+                        (h_new, F_lens_new) + beams)
+                    t = torch.cat([t, torch.zeros_like(F_lens_new)])
+                del F_new, h_new, beams
+            if not ids:
+                self.decoder.target_vocab = None
+                return
+            if self.shortlist is not None and changed:
+                # the sentences changed. So might their shortlists
+                self.decoder.target_vocab = self.get_target_vocab(
+                    torch.cat(sources))
+            changed = False
+            htilde_tm1, logpb_tm1 = self._extend_beams(
+                htilde_tm1, lattice, logpb_tm1, h, F_lens, t)
+            t += 1
+            is_done = lattice.last[:, 0] == self.target_eos  # (N',)
+            if on_max != 'ignore' and torch.any(~is_done & (t == max_T)):
+                if on_max == 'raise':
+                    raise RuntimeError(
+                        f'Beam search has not finished by t={max_T}. Increase '
+                        f'the number of parameters and train longer')
+                warnings.warn(f'Beam search not finished by t={max_T}. Halted')
+                is_done |= t == max_T
+            if not torch.any(is_done):
+                continue
+            b_1 = lattice.paths(is_done)
+            for j_done, j in enumerate(is_done.nonzero().flatten().tolist()):
+                yield ids[j], b_1[-1 - int(t[j]):, j_done]
+            keep = ~is_done
+            ids = [i for i, keep_i in zip(ids, keep.tolist()) if keep_i]
+            sources = [
+                F_i for F_i, keep_i in zip(sources, keep.tolist()) if keep_i]
+            changed = True
+            t = t[keep]
+            h, F_lens, htilde_tm1, logpb_tm1 = self._keep_beams(
+                keep, h, F_lens, htilde_tm1, logpb_tm1, lattice)
+            if ids:
+                # forget the tokens from before the oldest sentence started
+                lattice.forget(1 + int(t.max()))
+            else:
+                h = None
+
+    def _start_beams(self, h, F_lens, max_T=64):
+        # the decoder state, path log probs, and path lattice before the first
+        # step. The lattice has room for max_T steps
         htilde_tm1 = self.decoder.get_first_hidden_state(h, F_lens)
         logpb_tm1 = torch.where(
             torch.arange(self.beam_width, device=h.device) > 0,  # K
@@ -762,71 +1198,158 @@ class EncoderDecoderBase(torch.nn.Module, metaclass=abc.ABCMeta):
         )  # (N, K)
         assert torch.all(logpb_tm1[:, 0] == 0.)
         assert torch.all(logpb_tm1[:, 1:] == -float('inf'))
-        b_tm1_1 = torch.full_like(  # (t, N, K)
-            logpb_tm1, self.target_sos, dtype=torch.long).unsqueeze(0)
+        lattice = BeamLattice(torch.full_like(  # (N, K)
+            logpb_tm1, self.target_sos, dtype=torch.long), max_T)
         # We treat each beam within the batch as just another batch when
         # computing logits, then recover the original batch dimension by
-        # reshaping
+        # reshaping. The K paths of a beam share one copy of the encoder
+        # states: the decoder maps path n * K + k back to sentence n
         htilde_tm1 = htilde_tm1.unsqueeze(1).repeat(1, self.beam_width, 1)
         htilde_tm1 = htilde_tm1.flatten(end_dim=1)  # (N * K, 2 * H)
         if self.cell_type == 'lstm':
             htilde_tm1 = (htilde_tm1, torch.zeros_like(htilde_tm1))
-        h = h.unsqueeze(2).repeat(1, 1, self.beam_width, 1)
-        h = h.flatten(1, 2)  # (S, N * K, 2 * H)
-        F_lens = F_lens.unsqueeze(-1).repeat(1, self.beam_width).flatten()
-        v_is_eos = torch.arange(self.target_vocab_size, device=h.device)
-        v_is_eos = v_is_eos == self.target_eos  # (V,)
-        t = 0
-        while torch.any(b_tm1_1[-1, :, 0] != self.target_eos):
-            if t == max_T:
-                if on_max == 'raise':
-                    raise RuntimeError(
-                        f'Beam search has not finished by t={t}. Increase the '
-                        f'number of parameters and train longer')
-                elif on_max == 'halt':
-                    warnings.warn(f'Beam search not finished by t={t}. Halted')
-                    break
-            finished = (b_tm1_1[-1] == self.target_eos)
-            E_tm1 = b_tm1_1[-1].flatten()  # (N * K,)
-            logits_t, htilde_t = self.decoder(E_tm1, htilde_tm1, h, F_lens)
-            logits_t = logits_t.view(
-                -1, self.beam_width, self.target_vocab_size)  # (N, K, V)
+        return htilde_tm1, logpb_tm1, lattice
+
+    def _extend_beams(self, htilde_tm1, lattice, logpb_tm1, h, F_lens, t):
+        # one step of the search, appended to lattice. t is a long tensor of
+        # shape (N,) holding the number of steps each sentence has taken
+        finished = (lattice.last == self.target_eos)
+        E_tm1 = lattice.last.flatten()  # (N * K,)
+        logits_t, htilde_t = self.decoder(E_tm1, htilde_tm1, h, F_lens)
+        self.beam_rows_decoded += E_tm1.shape[0]
+        V = logits_t.shape[-1]  # less than the vocabulary with a shortlist
+        # or an output index
+        logits_t = logits_t.view(-1, self.beam_width, V)  # (N, K, V)
+        output_index = self.decoder.output_index
+        if output_index is None:
+            candidates = None
             logpy_t = torch.nn.functional.log_softmax(logits_t, -1)
-            # We length-normalize the extensions of the unfinished paths
-            if t:
-                logpb_tm1 = torch.where(
-                    finished, logpb_tm1, logpb_tm1 * (t / (t + 1)))
-                logpy_t = logpy_t / (t + 1)
-            # For any path that's finished:
-            # - v == <eos> gets log prob 0
-            # - v != <eos> gets log prob -inf
-            logpy_t = logpy_t.masked_fill(
-                finished.unsqueeze(-1) & v_is_eos, 0.)
-            logpy_t = logpy_t.masked_fill(
-                finished.unsqueeze(-1) & (~v_is_eos), -float('inf'))
-            if self.cell_type == 'lstm':
-                htilde_t = (
-                    htilde_t[0].view(
-                        -1, self.beam_width, 2 * self.encoder_hidden_size),
-                    htilde_t[1].view(
-                        -1, self.beam_width, 2 * self.encoder_hidden_size),
-                )
-            else:
-                htilde_t = htilde_t.view(
-                    -1, self.beam_width, 2 * self.encoder_hidden_size)
-            b_t_0, b_t_1, logpb_t = self.update_beam(
-                htilde_t, b_tm1_1, logpb_tm1, logpy_t)
-            del logits_t, logpy_t, finished, htilde_t
-            if self.cell_type == 'lstm':
-                htilde_tm1 = (
-                    b_t_0[0].flatten(end_dim=1),
-                    b_t_0[1].flatten(end_dim=1)
-                )
-            else:
-                htilde_tm1 = b_t_0.flatten(end_dim=1)  # (N * K, 2 * H)
-            logpb_tm1, b_tm1_1 = logpb_t, b_t_1
-            t += 1
-        return b_tm1_1
+        else:
+            # already normalized, each row over its own candidate tokens
+            candidates = output_index.candidates.view(-1, self.beam_width, V)
+            logpy_t = logits_t
+        # We length-normalize the extensions of the unfinished paths
+        t = t.unsqueeze(-1)  # (N, 1)
+        logpb_tm1 = torch.where(
+            finished | (t == 0), logpb_tm1,
+            logpb_tm1 * (t.double() / (t + 1).double()).float())
+        logpy_t = logpy_t / (t + 1).unsqueeze(-1).float()
+        # For any path that's finished:
+        # - v == <eos> gets log prob 0
+        # - v != <eos> gets log prob -inf
+        target_vocab = self.decoder.target_vocab
+        if candidates is not None:
+            v_is_eos = candidates == self.target_eos  # (N, K, V)
+        elif target_vocab is None:
+            v_is_eos = torch.arange(V, device=h.device) == self.target_eos
+        else:
+            v_is_eos = target_vocab == self.target_eos  # (V,)
+        logpy_t = logpy_t.masked_fill(
+            finished.unsqueeze(-1) & v_is_eos, 0.)
+        logpy_t = logpy_t.masked_fill(
+            finished.unsqueeze(-1) & (~v_is_eos), -float('inf'))
+        if self.cell_type == 'lstm':
+            htilde_t = (
+                htilde_t[0].view(
+                    -1, self.beam_width, 2 * self.encoder_hidden_size),
+                htilde_t[1].view(
+                    -1, self.beam_width, 2 * self.encoder_hidden_size),
+            )
+        else:
+            htilde_t = htilde_t.view(
+                -1, self.beam_width, 2 * self.encoder_hidden_size)
+        b_t_0, k_tm1, v, logpb_t = self.select_beams(
+            htilde_t, logpb_tm1, logpy_t)
+        if candidates is not None:
+            v = candidates[
+                torch.arange(v.shape[0], device=v.device).unsqueeze(1),
+                k_tm1, v]
+        elif target_vocab is not None:
+            v = target_vocab[v]
+        lattice.append(k_tm1, v)
+        del logits_t, logpy_t, finished, htilde_t, k_tm1, v, candidates
+        if self.cell_type == 'lstm':
+            htilde_t = (
+                b_t_0[0].flatten(end_dim=1),
+                b_t_0[1].flatten(end_dim=1)
+            )
+        else:
+            htilde_t = b_t_0.flatten(end_dim=1)  # (N * K, 2 * H)
+        return htilde_t, logpb_t
+
+    def _keep_beams(self, keep, h, F_lens, htilde_tm1, logpb_tm1, lattice):
+        # drop the sentences where keep is False from the search state
+        def keep_rows(x):
+            x = x.view(-1, self.beam_width, *x.shape[1:])[keep]
+            return x.flatten(end_dim=1)
+
+        h, F_lens = h[:, keep], F_lens[keep]
+        if F_lens.shape[0]:
+            h = h[:F_lens.max()]
+        if self.cell_type == 'lstm':
+            htilde_tm1 = tuple(keep_rows(x) for x in htilde_tm1)
+        else:
+            htilde_tm1 = keep_rows(htilde_tm1)
+        lattice.keep(keep)
+        return h, F_lens, htilde_tm1, logpb_tm1[keep]
+
+    def _join_beams(self, state, state_new):
+        # append the sentences of search state_new to those of state, where
+        # each is (h, F_lens, htilde_tm1, logpb_tm1, lattice)
+        h, F_lens, htilde_tm1, logpb_tm1, lattice = state
+        h_new, F_lens_new, htilde_new, logpb_new, lattice_new = state_new
+        S = max(h.shape[0], h_new.shape[0])
+        h = torch.cat([
+            torch.nn.functional.pad(x, (0, 0, 0, 0, 0, S - x.shape[0]))
+            for x in (h, h_new)], 1)
+        if self.cell_type == 'lstm':
+            htilde_tm1 = tuple(
+                torch.cat([x, x_new]) for x, x_new in zip(
+                    htilde_tm1, htilde_new))
+        else:
+            htilde_tm1 = torch.cat([htilde_tm1, htilde_new])
+        # the new paths are only <sos> so far. The lattice pads their past
+        # with it
+        lattice.join(lattice_new)
+        return (
+            h, torch.cat([F_lens, F_lens_new]), htilde_tm1,
+            torch.cat([logpb_tm1, logpb_new]))
+
+    def select_beams(self, htilde_t, logpb_tm1, logpy_t):
+        '''Pick the paths to keep in a beam search, without their history
+
+        Does what :func:`update_beam` does, but rather than the whole token
+        sequences of the kept paths, returns where each came from and what it
+        appended. :func:`beam_search` keeps those in a :class:`BeamLattice`
+        so that a step costs the same no matter how long the paths get.
+
+        The default calls :func:`update_beam` with a history of a single step
+        holding the index of each path.
+
+        Parameters
+        ----------
+        htilde_t, logpb_tm1, logpy_t
+            As in :func:`update_beam`.
+
+        Returns
+        -------
+        b_t_0 : torch.FloatTensor
+            As in :func:`update_beam`.
+        k_tm1 : torch.LongTensor
+            A long tensor of shape ``(N, self.beam_width)`` where
+            ``k_tm1[n, k]`` indexes the path in `logpb_tm1` that the ``k``-th
+            kept path extends.
+        v : torch.LongTensor
+            A long tensor of shape ``(N, self.beam_width)`` where ``v[n, k]``
+            is the token the ``k``-th kept path was extended with.
+        logpb_t : torch.FloatTensor
+            As in :func:`update_beam`.
+        '''
+        b_tm1_1 = torch.arange(self.beam_width, device=logpb_tm1.device)
+        b_tm1_1 = b_tm1_1.expand_as(logpb_tm1).unsqueeze(0)  # (1, N, K)
+        b_t_0, b_t_1, logpb_t = self.update_beam(
+            htilde_t, b_tm1_1, logpb_tm1, logpy_t)
+        return b_t_0, b_t_1[0], b_t_1[1], logpb_t
 
     @abc.abstractmethod
     def update_beam(self, htilde_t, b_tm1_1, logpb_tm1, logpy_t):
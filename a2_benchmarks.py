@@ -0,0 +1,857 @@
+# Copyright 2020 University of Toronto, all rights reserved
+
+'''Benchmarks for the faster code paths in A2
+
+Each benchmark times a fast path against the code it replaced and returns
+its measurements as a dictionary. ``a2_run.py bench`` prints them.
+'''
+
+import os
+import time
+import tempfile
+import multiprocessing
+
+import torch
+
+import a2_dataloader
+import a2_encoder_decoder
+import a2_training_and_testing
+
+
+def benchmark_tokenizer(dir_, langs=('e', 'f'), repeats=3):
+    '''Time tokenizing a directory line-by-line against in bulk
+
+    Parameters
+    ----------
+    dir_ : str
+        A path to the transcription directory.
+    langs : sequence, optional
+        Which languages' files to tokenize.
+    repeats : int, optional
+        The number of times to time each tokenizer. The fastest time is kept.
+
+    Returns
+    -------
+    results : dict
+        ``'lines'`` is the number of lines in the files tokenized.
+        ``'by_line'`` and ``'bulk'`` are the lines per second of the original
+        per-line tokenizer and of :func:`a2_dataloader.get_dir_lines`.
+    '''
+    filenames = sorted(
+        fn for fn in os.listdir(dir_) if fn[-2:] in {'.' + l for l in langs})
+    by_line = bulk = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for filename in filenames:
+            tokenized, _ = a2_dataloader._tokenize_file_by_line(
+                os.path.join(dir_, filename))
+        by_line = min(by_line, time.perf_counter() - start)
+        start = time.perf_counter()
+        num_lines = 0
+        for lang in langs:
+            for _ in a2_dataloader.get_dir_lines(dir_, lang):
+                num_lines += 1
+        bulk = min(bulk, time.perf_counter() - start)
+    return {
+        'lines': num_lines,
+        'by_line': num_lines / by_line,
+        'bulk': num_lines / bulk,
+    }
+
+
+def benchmark_vocab(vocab_file, dir_, lang, repeats=3):
+    '''Time loading a vocabulary and encoding a directory with it
+
+    Parameters
+    ----------
+    vocab_file : str
+        A path to a text vocabulary, as read by
+        :func:`a2_dataloader.read_word2id_from_file`.
+    dir_ : str
+        A path to the transcription directory to encode.
+    lang : {'e', 'f'}
+        The language of `vocab_file`.
+    repeats : int, optional
+        The number of times to time each step. The fastest time is kept.
+
+    Returns
+    -------
+    results : dict
+        ``'text'`` and ``'binary'`` are the seconds taken to load the
+        vocabulary from text and from the binary format. ``'tokens'`` is the
+        number of tokens in `dir_`. ``'by_token'`` and ``'batch'`` are the
+        tokens per second encoded by one dictionary lookup per token and by
+        :func:`a2_dataloader.encode_batch`.
+    '''
+    word2id = a2_dataloader.read_word2id_from_file(vocab_file)
+    tokenized = [t for t, _, _ in a2_dataloader.get_dir_lines(dir_, lang)]
+    num_tokens = sum(len(t) for t in tokenized)
+    unk = len(word2id)
+    text = binary = by_token = batch = float('inf')
+    with tempfile.TemporaryDirectory() as tmp:
+        binary_file = os.path.join(tmp, 'vocab.bin')
+        a2_dataloader.write_word2id_to_file(word2id, binary_file)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            a2_dataloader.read_word2id_from_file(vocab_file)
+            text = min(text, time.perf_counter() - start)
+            start = time.perf_counter()
+            a2_dataloader.read_word2id_from_file(binary_file)
+            binary = min(binary, time.perf_counter() - start)
+            start = time.perf_counter()
+            for tokens in tokenized:
+                [word2id.get(w, unk) for w in tokens]
+            by_token = min(by_token, time.perf_counter() - start)
+            start = time.perf_counter()
+            a2_dataloader.encode_batch(word2id, tokenized)
+            batch = min(batch, time.perf_counter() - start)
+    return {
+        'text': text,
+        'binary': binary,
+        'tokens': num_tokens,
+        'by_token': num_tokens / by_token,
+        'batch': num_tokens / batch,
+    }
+
+
+def benchmark_dataset_memory(dataset):
+    '''Measure the memory a DataLoader worker copies when reading a dataset
+
+    A worker is a forked process. Its pages are shared with the parent until
+    written to, and merely reading a Python object writes to its reference
+    count. This benchmark forks a process which reads every pair of
+    `dataset` and reports how much private memory that process dirtied. It
+    does the same for a tuple of one tensor per sequence, as
+    :class:`a2_dataloader.HansardDataset` used to store its pairs.
+
+    Linux only, since it reads ``/proc/self/smaps_rollup``.
+
+    Parameters
+    ----------
+    dataset : HansardDataset
+
+    Returns
+    -------
+    results : dict
+        ``'pairs'`` and ``'flat'`` are the megabytes a worker dirtied reading
+        the tuple of tensors and `dataset` respectively. ``'flat_size'`` is
+        the size in megabytes of the arrays `dataset` stores pairs in.
+    '''
+    flat_size = (
+        dataset.F.numel() * dataset.F.element_size() +
+        dataset.E.numel() * dataset.E.element_size() +
+        dataset.F_offsets.nbytes + dataset.E_offsets.nbytes) / 2 ** 20
+    flat = _worker_dirty_mb(dataset)
+    pairs = tuple((F.long(), E.long()) for F, E in dataset)
+    pairs = _worker_dirty_mb(pairs)
+    return {'pairs': pairs, 'flat': flat, 'flat_size': flat_size}
+
+
+def _worker_dirty_mb(dataset):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_read_all, args=(dataset, queue))
+    process.start()
+    dirty = queue.get()
+    process.join()
+    return dirty
+
+
+def _read_all(dataset, queue):
+    before = _private_dirty_kb()
+    for i in range(len(dataset)):
+        F, E = dataset[i]
+        del F, E
+    queue.put((_private_dirty_kb() - before) / 1024)
+
+
+def _private_dirty_kb():
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                return int(line.split()[1])
+    raise RuntimeError('No Private_Dirty entry in /proc/self/smaps_rollup')
+
+
+def benchmark_first_hidden_state(
+        batch_sizes=(1, 10, 100, 1000), max_source_len=50,
+        hidden_state_size=512, repeats=3, device='cpu'):
+    '''Time building the decoder's first hidden state
+
+    Compares :func:`a2_encoder_decoder.DecoderWithoutAttention.
+    get_first_hidden_state` against the per-sentence loop it replaced.
+
+    Parameters
+    ----------
+    batch_sizes : sequence, optional
+        The batch sizes ``N`` to time.
+    max_source_len : int, optional
+        Source lengths are drawn uniformly from ``[1, max_source_len]``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``.
+    repeats : int, optional
+        The number of times to time each batch size. The fastest time is kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by batch size. Each value is a dictionary whose ``'loop'`` and
+        ``'gather'`` are the seconds taken by the old and new versions, and
+        whose ``'equal'`` is whether they produced identical outputs.
+    '''
+    device = torch.device(device)
+    decoder = a2_encoder_decoder.DecoderWithoutAttention(
+        10, hidden_state_size=hidden_state_size).to(device)
+    results = dict()
+    for N in batch_sizes:
+        F_lens = torch.randint(1, max_source_len + 1, (N,))
+        h = torch.randn(
+            int(F_lens.max()), N, hidden_state_size, device=device)
+        loop = gather = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            expected = _first_hidden_state_by_loop(
+                h, F_lens, hidden_state_size)
+            _synchronize(device)
+            loop = min(loop, time.perf_counter() - start)
+            start = time.perf_counter()
+            actual = decoder.get_first_hidden_state(h, F_lens)
+            _synchronize(device)
+            gather = min(gather, time.perf_counter() - start)
+        results[N] = {
+            'loop': loop,
+            'gather': gather,
+            'equal': torch.equal(actual, expected),
+        }
+    return results
+
+
+def benchmark_attention(
+        source_lens=(10, 50, 100), batch_size=100, hidden_state_size=512,
+        num_steps=10, repeats=3, device='cpu'):
+    '''Time several steps of attention over a batch, forwards and backwards
+
+    Compares :func:`a2_encoder_decoder.DecoderWithAttention.attend` against
+    the loops over source positions it replaced, both rebuilding its
+    :class:`a2_encoder_decoder.AttentionContext` every step and reusing it.
+
+    Parameters
+    ----------
+    source_lens : sequence, optional
+        The source lengths ``S`` to time.
+    batch_size : int, optional
+        The batch size ``N``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``.
+    num_steps : int, optional
+        The number of decoder steps attending over the same encoder states.
+    repeats : int, optional
+        The number of times to time each source length. The fastest time is
+        kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by source length. Each value is a dictionary whose ``'loop'``,
+        ``'batched'``, and ``'cached'`` are the seconds taken by the old
+        version, the new one rebuilding its context every step, and the new
+        one reusing it. ``'max_diff'`` is the largest absolute difference
+        between the old and cached versions' context vectors.
+    '''
+    device = torch.device(device)
+    decoder = a2_encoder_decoder.DecoderWithAttention(
+        10, hidden_state_size=hidden_state_size).to(device)
+
+    def run(attend, htilde_t, h, F_lens, reuse=True):
+        c_t = htilde_t
+        cs = []
+        for _ in range(num_steps):
+            if not reuse:
+                decoder.attention_context = None
+            c_t = attend(c_t, h, F_lens)
+            cs.append(c_t)
+        torch.stack(cs).sum().backward()
+        decoder.attention_context = None
+        return c_t
+
+    results = dict()
+    for S in source_lens:
+        F_lens = torch.randint(1, S + 1, (batch_size,), device=device)
+        F_lens[0] = S
+        h = torch.randn(
+            S, batch_size, hidden_state_size, device=device,
+            requires_grad=True)
+        htilde_t = torch.randn(
+            batch_size, hidden_state_size, device=device, requires_grad=True)
+        times = dict.fromkeys(('loop', 'batched', 'cached'), float('inf'))
+        for _ in range(repeats):
+            for name in times:
+                start = time.perf_counter()
+                if name == 'loop':
+                    expected = run(
+                        lambda *args: _attend_by_loop(decoder, *args),
+                        htilde_t, h, F_lens)
+                else:
+                    actual = run(
+                        decoder.attend, htilde_t, h, F_lens,
+                        name == 'cached')
+                _synchronize(device)
+                times[name] = min(times[name], time.perf_counter() - start)
+        times['max_diff'] = float((actual - expected).abs().max())
+        results[S] = times
+    return results
+
+
+def benchmark_beam_encoder_states(
+        batch_size=100, beam_widths=(1, 4, 16), source_len=50,
+        hidden_state_size=512, num_steps=10, repeats=3, device='cpu'):
+    '''Time attention decoder steps with replicated and shared encoder states
+
+    Beam search used to copy the encoder states and source lengths once per
+    path in the beam. Now the paths of a beam share one copy. This benchmark
+    runs decoder steps both ways.
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        The number of source sentences ``N``.
+    beam_widths : sequence, optional
+        The beam widths ``K`` to time.
+    source_len : int, optional
+        The source length ``S``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``.
+    num_steps : int, optional
+        The number of decoder steps per timing.
+    repeats : int, optional
+        The number of times to time each beam width. The fastest time is kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by beam width. Each value is a dictionary whose
+        ``'replicated'`` and ``'shared'`` are the seconds taken by each
+        version, and whose ``'replicated_mb'`` and ``'shared_mb'`` are the
+        megabytes of encoder states (including attention keys) each holds.
+        ``'max_diff'`` is the largest absolute difference between their
+        logits.
+    '''
+    device = torch.device(device)
+    decoder = a2_encoder_decoder.DecoderWithAttention(
+        1000, word_embedding_size=hidden_state_size // 2,
+        hidden_state_size=hidden_state_size, cell_type='gru').to(device)
+    decoder.eval()
+    F_lens = torch.randint(1, source_len + 1, (batch_size,), device=device)
+    F_lens[0] = source_len
+    h = torch.randn(source_len, batch_size, hidden_state_size, device=device)
+    results = dict()
+    for K in beam_widths:
+        h_rep = h.unsqueeze(2).repeat(1, 1, K, 1).flatten(1, 2)
+        F_lens_rep = F_lens.unsqueeze(-1).repeat(1, K).flatten()
+        E_tm1 = torch.randint(1000, (batch_size * K,), device=device)
+        htilde_0 = torch.randn(
+            batch_size * K, hidden_state_size, device=device)
+        times = dict.fromkeys(('replicated', 'shared'), float('inf'))
+        logits = dict()
+        with torch.no_grad():
+            for _ in range(repeats):
+                for name, h_, F_lens_ in (
+                        ('replicated', h_rep, F_lens_rep),
+                        ('shared', h, F_lens)):
+                    start = time.perf_counter()
+                    htilde_tm1 = htilde_0
+                    for _ in range(num_steps):
+                        logits[name], htilde_tm1 = decoder(
+                            E_tm1, htilde_tm1, h_, F_lens_)
+                    decoder.attention_context = None
+                    _synchronize(device)
+                    times[name] = min(
+                        times[name], time.perf_counter() - start)
+        # the states and their unit-length keys
+        size = 2 * h.element_size() / 2 ** 20
+        results[K] = {
+            'replicated': times['replicated'],
+            'shared': times['shared'],
+            'replicated_mb': size * h_rep.numel(),
+            'shared_mb': size * h.numel(),
+            'max_diff': float(
+                (logits['replicated'] - logits['shared']).abs().max()),
+        }
+    return results
+
+
+def benchmark_teacher_forcing(
+        target_lens=(10, 30, 50), batch_size=100, source_len=30,
+        hidden_state_size=512, vocab_size=5000, cell_type='lstm', repeats=3,
+        device='cpu'):
+    '''Time teacher forcing a decoder without attention, forwards and backwards
+
+    Compares :func:`a2_encoder_decoder.EncoderDecoder.
+    get_logits_for_teacher_forcing`, which runs the whole target sequence
+    through one multi-step recurrent layer, against stepping through it one
+    token at a time.
+
+    Parameters
+    ----------
+    target_lens : sequence, optional
+        The target lengths ``T`` to time.
+    batch_size : int, optional
+        The number of sequences ``N``.
+    source_len : int, optional
+        The source length ``S``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``.
+    vocab_size : int, optional
+        The target vocabulary size ``V``.
+    cell_type : {'lstm', 'gru', 'rnn'}, optional
+    repeats : int, optional
+        The number of times to time each length. The fastest time is kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by target length. Each value is a dictionary whose ``'loop'``
+        and ``'fused'`` are the target tokens per second of each version,
+        and whose ``'max_diff'`` is the largest absolute difference between
+        their logits.
+    '''
+    device = torch.device(device)
+    model = a2_encoder_decoder.EncoderDecoder(
+        a2_encoder_decoder.Encoder, a2_encoder_decoder.DecoderWithoutAttention,
+        vocab_size, vocab_size, encoder_hidden_size=hidden_state_size // 2,
+        word_embedding_size=hidden_state_size // 2, cell_type=cell_type,
+    ).to(device)
+    model.train()
+    F_lens = torch.randint(1, source_len + 1, (batch_size,), device=device)
+    F_lens[0] = source_len
+    h = torch.randn(source_len, batch_size, hidden_state_size, device=device)
+    results = dict()
+    for T in target_lens:
+        E = torch.randint(vocab_size, (T, batch_size), device=device)
+        times = dict.fromkeys(('loop', 'fused'), float('inf'))
+        logits = dict()
+        for _ in range(repeats):
+            for name, get_logits in (
+                    ('loop', _teacher_forcing_by_loop),
+                    ('fused', type(model).get_logits_for_teacher_forcing)):
+                model.zero_grad()
+                start = time.perf_counter()
+                logits[name] = get_logits(model, h, F_lens, E)
+                logits[name].sum().backward()
+                _synchronize(device)
+                times[name] = min(times[name], time.perf_counter() - start)
+        num_tokens = (T - 1) * batch_size
+        results[T] = {
+            'loop': num_tokens / times['loop'],
+            'fused': num_tokens / times['fused'],
+            'max_diff': float(
+                (logits['loop'] - logits['fused']).abs().max()),
+        }
+    return results
+
+
+def benchmark_input_table(
+        beam_widths=(1, 4, 16), batch_size=100, hidden_state_size=512,
+        vocab_size=20000, cell_type='lstm', attention=False, num_steps=10,
+        repeats=3, device='cpu'):
+    '''Time decoder steps with and without an input table
+
+    With :func:`a2_encoder_decoder.DecoderWithoutAttention.
+    precompute_input_table`, the product of each target word's embedding
+    with the cell's input weights is looked up rather than computed at every
+    step of a beam search. This benchmark runs decoder steps both ways.
+
+    Parameters
+    ----------
+    beam_widths : sequence, optional
+        The beam widths ``K`` to time.
+    batch_size : int, optional
+        The number of source sentences ``N``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``. Embeddings are the same
+        size.
+    vocab_size : int, optional
+        The target vocabulary size ``V``.
+    cell_type : {'lstm', 'gru', 'rnn'}, optional
+    attention : bool, optional
+        Whether to time a :class:`a2_encoder_decoder.DecoderWithAttention`,
+        which still multiplies the attention context by its input weights.
+    num_steps : int, optional
+        The number of decoder steps per timing.
+    repeats : int, optional
+        The number of times to time each beam width. The fastest time is kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by beam width. Each value is a dictionary whose ``'embedding'``
+        and ``'table'`` are the seconds taken by each version, and whose
+        ``'max_diff'`` is the largest absolute difference between their
+        logits. The key ``'table_mb'`` holds the size of the table.
+    '''
+    device = torch.device(device)
+    decoder_class = (
+        a2_encoder_decoder.DecoderWithAttention if attention
+        else a2_encoder_decoder.DecoderWithoutAttention)
+    decoder = decoder_class(
+        vocab_size, word_embedding_size=hidden_state_size,
+        hidden_state_size=hidden_state_size, cell_type=cell_type).to(device)
+    decoder.eval()
+    input_table = decoder.precompute_input_table()
+    source_len = 30
+    F_lens = torch.randint(1, source_len + 1, (batch_size,), device=device)
+    F_lens[0] = source_len
+    h = torch.randn(source_len, batch_size, hidden_state_size, device=device)
+    results = {
+        'table_mb': input_table.numel() * input_table.element_size() / 2 ** 20
+    }
+    for K in beam_widths:
+        E_tm1 = torch.randint(vocab_size, (batch_size * K,), device=device)
+        htilde_0 = torch.randn(
+            batch_size * K, hidden_state_size, device=device)
+        if cell_type == 'lstm':
+            htilde_0 = (htilde_0, torch.zeros_like(htilde_0))
+        times = dict.fromkeys(('embedding', 'table'), float('inf'))
+        logits = dict()
+        with torch.no_grad():
+            for _ in range(repeats):
+                for name, table in (
+                        ('embedding', None), ('table', input_table)):
+                    decoder.input_table = table
+                    start = time.perf_counter()
+                    htilde_tm1 = htilde_0
+                    for _ in range(num_steps):
+                        logits[name], htilde_tm1 = decoder(
+                            E_tm1, htilde_tm1, h, F_lens)
+                    decoder.attention_context = None
+                    _synchronize(device)
+                    times[name] = min(
+                        times[name], time.perf_counter() - start)
+        times['max_diff'] = float(
+            (logits['embedding'] - logits['table']).abs().max())
+        results[K] = times
+    decoder.input_table = None
+    return results
+
+
+def benchmark_output_index(
+        probes=(2, 8, 32), batch_size=100, beam_width=4,
+        hidden_state_size=512, vocab_size=20000, slack=1., num_steps=10,
+        repeats=3, device='cpu'):
+    '''Time scoring beam paths with every word and with an output index
+
+    :class:`a2_encoder_decoder.OutputIndex` only scores the words of the
+    clusters of output layer rows most likely to hold the best ones. This
+    benchmark times the output layer and the top ``K`` words of each path
+    both ways, and counts how many of the best words the index finds. The
+    weights are random, so the clusters are looser than in a trained model:
+    ``test --output-index`` measures a trained one.
+
+    Parameters
+    ----------
+    probes : sequence, optional
+        The numbers of clusters to probe to time.
+    batch_size : int, optional
+        The number of source sentences ``N``.
+    beam_width : int, optional
+        The beam width ``K``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``.
+    vocab_size : int, optional
+        The target vocabulary size ``V``.
+    slack : float, optional
+        As in :class:`a2_encoder_decoder.OutputIndex`.
+    num_steps : int, optional
+        The number of beam steps per timing.
+    repeats : int, optional
+        The number of times to time each number of probes. The fastest time
+        is kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by the number of probes. Each value is a dictionary whose
+        ``'exact'`` and ``'index'`` are the seconds per beam step of each
+        version, ``'recall'`` is the fraction of the top ``K`` words of each
+        path the index found, and ``'fallback'`` is the fraction of paths it
+        scored every word for.
+    '''
+    device = torch.device(device)
+    ff = torch.nn.Linear(hidden_state_size, vocab_size).to(device)
+    htilde_t = torch.randn(
+        batch_size * beam_width, hidden_state_size, device=device)
+    results = dict()
+    with torch.no_grad():
+        exact = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                logpy_t = torch.nn.functional.log_softmax(ff(htilde_t), -1)
+                best = logpy_t.topk(beam_width, 1)[1]
+            _synchronize(device)
+            exact = min(exact, time.perf_counter() - start)
+        for P in probes:
+            index = a2_encoder_decoder.OutputIndex(
+                ff.weight, ff.bias, probes=P, k=beam_width, slack=slack)
+            times = float('inf')
+            for _ in range(repeats):
+                index.rows_searched = index.rows_exact = 0
+                start = time.perf_counter()
+                for _ in range(num_steps):
+                    logpy_t = index.search(htilde_t)
+                    found = logpy_t.topk(beam_width, 1)[1]
+                    found = index.candidates.gather(1, found)
+                _synchronize(device)
+                times = min(times, time.perf_counter() - start)
+            recall = (found.unsqueeze(2) == best.unsqueeze(1)).any(1)
+            results[P] = {
+                'exact': exact / num_steps,
+                'index': times / num_steps,
+                'recall': float(recall.float().mean()),
+                'fallback': index.rows_exact / index.rows_searched,
+            }
+    return results
+
+
+def benchmark_loss(
+        num_tokens=(2000, 8000), vocab_size=20000, hidden_state_size=512,
+        chunk_size=1024, device='cpu'):
+    '''Measure the peak memory of the full and chunked output layer losses
+
+    :func:`a2_training_and_testing.chunked_cross_entropy` never holds the
+    ``(M, V)`` logits of a batch whole, nor their gradient. This benchmark
+    runs the output layer and summed cross-entropy forwards and backwards
+    both ways and measures how much memory each needs at its peak beyond
+    what was allocated before it started.
+
+    On CUDA, this is read from :func:`torch.cuda.max_memory_allocated`. On
+    the CPU, it is the process's peak resident set size, reset before each
+    run by writing to ``/proc/self/clear_refs``, so it is Linux only.
+
+    Parameters
+    ----------
+    num_tokens : sequence, optional
+        The numbers of target tokens ``M`` in a batch to measure.
+    vocab_size : int, optional
+        The target vocabulary size ``V``.
+    hidden_state_size : int, optional
+        The decoder's hidden state size ``2 * H``.
+    chunk_size : int, optional
+        As in :func:`a2_training_and_testing.chunked_cross_entropy`.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by the number of tokens. Each value is a dictionary whose
+        ``'full'`` and ``'chunked'`` are the peak megabytes of each version,
+        whose ``'full_s'`` and ``'chunked_s'`` are the seconds each took, and
+        whose ``'logits_mb'`` is the size of the whole logits.
+    '''
+    device = torch.device(device)
+    ff = torch.nn.Linear(hidden_state_size, vocab_size).to(device)
+    results = dict()
+    for M in num_tokens:
+        htilde = torch.randn(
+            M, hidden_state_size, device=device, requires_grad=True)
+        E = torch.randint(vocab_size, (M,), device=device)
+
+        def full():
+            logits = ff(htilde)
+            return torch.nn.functional.cross_entropy(
+                logits, E, reduction='sum')
+
+        def chunked():
+            return a2_training_and_testing.chunked_cross_entropy(
+                htilde, E, ff.weight, ff.bias, chunk_size)
+
+        result = {
+            'logits_mb': M * vocab_size * htilde.element_size() / 2 ** 20}
+        for name, loss in (('full', full), ('chunked', chunked)):
+            ff.zero_grad()
+            htilde.grad = None
+            result[name], result[name + '_s'] = _peak_memory_mb(
+                device, lambda: loss().backward())
+        results[M] = result
+    return results
+
+
+def _peak_memory_mb(device, run):
+    # the most memory run() needs at once beyond what is already allocated,
+    # and how long it took
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+    else:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')  # reset the peak resident set size
+        before = _proc_status_kb('VmRSS:') * 1024
+    start = time.perf_counter()
+    run()
+    _synchronize(device)
+    duration = time.perf_counter() - start
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = _proc_status_kb('VmHWM:') * 1024
+    return (peak - before) / 2 ** 20, duration
+
+
+def _proc_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    raise RuntimeError(f'No {field} entry in /proc/self/status')
+
+
+def benchmark_optimizer(
+        vocab_size=20000, word_embedding_size=512, num_tokens=(100, 1000),
+        repeats=3, device='cpu'):
+    '''Time an optimizer step on a word embedding with dense and sparse Adam
+
+    :func:`a2_training_and_testing.build_optimizer` gives embeddings with
+    sparse gradients a :class:`torch.optim.SparseAdam`, which only updates
+    the rows of the words in the batch. This benchmark times the backward
+    pass and step of an embedding both ways, after a few warm-up steps.
+
+    Parameters
+    ----------
+    vocab_size : int, optional
+        The number of rows in the embedding.
+    word_embedding_size : int, optional
+        The size of each row.
+    num_tokens : sequence, optional
+        The numbers of tokens in a batch to time. They are drawn uniformly
+        from the vocabulary.
+    repeats : int, optional
+        The number of times to time each batch. The fastest time is kept.
+    device : torch.device or str, optional
+        Where to run.
+
+    Returns
+    -------
+    results : dict
+        Keyed by the number of tokens. Each value is a dictionary whose
+        ``'dense'`` and ``'sparse'`` are the seconds taken by each version.
+    '''
+    device = torch.device(device)
+    results = dict()
+    for M in num_tokens:
+        times = dict()
+        for name in ('dense', 'sparse'):
+            torch.manual_seed(0)
+            embedding = torch.nn.Embedding(
+                vocab_size, word_embedding_size,
+                sparse=(name == 'sparse')).to(device)
+            optimizer = a2_training_and_testing.build_optimizer(embedding)
+            times[name] = float('inf')
+            for i in range(repeats + 2):
+                idx = torch.randint(vocab_size, (M,), device=device)
+                optimizer.zero_grad()
+                loss = embedding(idx).sum()
+                start = time.perf_counter()
+                loss.backward()
+                optimizer.step()
+                _synchronize(device)
+                if i >= 2:  # let the moments be allocated first
+                    times[name] = min(
+                        times[name], time.perf_counter() - start)
+        results[M] = times
+    return results
+
+
+def decoder_flops_per_row(model, source_len=0):
+    '''Estimate the floating point operations of one beam search row
+
+    A row is one path of one sentence decoded for one step. The estimate
+    counts two operations per multiply-add in the decoder's matrix products
+    (the recurrent cell, the attention over the source, and the output
+    layer), plus a few per target word for the log-softmax. Element-wise
+    gate arithmetic is ignored.
+
+    Parameters
+    ----------
+    model : EncoderDecoder
+    source_len : int, optional
+        The source length to attend over, if the decoder has attention.
+
+    Returns
+    -------
+    flops : int
+    '''
+    decoder = model.decoder
+    cell = decoder.cell
+    flops = 2 * (cell.weight_ih.numel() + cell.weight_hh.numel())
+    flops += 2 * decoder.ff.weight.numel() + 3 * model.target_vocab_size
+    if isinstance(decoder, a2_encoder_decoder.DecoderWithAttention):
+        # energies, then the weighted sum of the encoder states
+        flops += 4 * source_len * decoder.hidden_state_size
+    return flops
+
+
+def _attend_by_loop(decoder, htilde_t, h, F_lens):
+    # DecoderWithAttention.attend before it was batched
+    cos = torch.nn.CosineSimilarity(dim=1, eps=1e-08)
+    e_t = cos(htilde_t, h[0]).view(1, -1)
+    for h_idx in h[1:]:
+        e_t = torch.cat((e_t, cos(htilde_t, h_idx).view(1, -1)), 0)
+    pad_mask = torch.arange(h.shape[0], device=h.device)
+    pad_mask = pad_mask.unsqueeze(-1) >= F_lens
+    alpha = torch.nn.functional.softmax(
+        e_t.masked_fill(pad_mask, -float('inf')), 0)
+    c_t = torch.zeros_like(htilde_t)
+    for idx in range(alpha.shape[0]):
+        c_t = c_t + alpha[idx].repeat(h.shape[2], 1).T * h[idx]
+    return c_t
+
+
+def _teacher_forcing_by_loop(model, h, F_lens, E):
+    # EncoderDecoder.get_logits_for_teacher_forcing, one step at a time
+    decoder = model.decoder
+    htilde_tm1 = decoder.get_first_hidden_state(h, F_lens)
+    if model.cell_type == 'lstm':
+        htilde_tm1 = (htilde_tm1, torch.zeros_like(htilde_tm1))
+    logits = []
+    for t in range(E.shape[0] - 1):
+        xtilde_t = decoder.get_current_rnn_input(E[t], htilde_tm1, h, F_lens)
+        htilde_tm1 = decoder.get_current_hidden_state(xtilde_t, htilde_tm1)
+        if model.cell_type == 'lstm':
+            logits.append(decoder.get_current_logits(htilde_tm1[0]))
+        else:
+            logits.append(decoder.get_current_logits(htilde_tm1))
+    return torch.stack(logits)
+
+
+def _first_hidden_state_by_loop(h, F_lens, hidden_state_size):
+    # DecoderWithoutAttention.get_first_hidden_state before it was batched
+    htilde_tm1 = torch.cat((
+        h[F_lens[0] - 1, 0, :hidden_state_size // 2],
+        h[0, 0, hidden_state_size // 2:]), 0)
+    htilde_tm1 = htilde_tm1.view(1, hidden_state_size)
+    for idx in range(1, F_lens.shape[0]):
+        output = torch.cat((
+            h[F_lens[idx] - 1, idx, :hidden_state_size // 2],
+            h[0, idx, hidden_state_size // 2:]), 0)
+        output = output.view(1, hidden_state_size)
+        htilde_tm1 = torch.cat((htilde_tm1, output), 0)
+    return htilde_tm1
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
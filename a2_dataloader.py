@@ -8,27 +8,70 @@ this nicer.
 
 import locale
 import os
+import io
 import re
-from string import punctuation
+import json
+import struct
+import zlib
+import random
+import multiprocessing
+import threading
+import queue
+import time
+import shutil
+import hashlib
+import tempfile
+from string import punctuation, digits
 from collections import Counter
+from itertools import accumulate, chain, repeat
 import gzip
+import numpy as np
 import torch
 
 
 TOKENIZER_PATTERN = re.compile(r'[' + re.escape(punctuation) + r'\d\s]+')
 
+# the complement of TOKENIZER_PATTERN. Finding all its matches in a line is
+# the same as splitting the line by TOKENIZER_PATTERN and dropping empties
+_TOKEN_PATTERN = re.compile(r'[^' + re.escape(punctuation) + r'\d\s]+')
+
+# for ASCII text, TOKENIZER_PATTERN is the same as turning punctuation and
+# digits into spaces, then splitting on whitespace
+_ASCII_SEPARATORS = str.maketrans(
+    punctuation + digits, ' ' * len(punctuation + digits))
+
+# bump whenever the on-disk layout of a corpus cache changes
+CORPUS_CACHE_VERSION = 2
+
+# binary vocabularies start with this, then a header of the format version,
+# the number of words, the size of the payload in bytes, and the CRC-32 of
+# the payload. The payload is every word in id order, UTF-8 encoded and
+# separated by newlines
+VOCAB_MAGIC = b'A2VOCAB\x00'
+VOCAB_VERSION = 1
+_VOCAB_HEADER = struct.Struct('<IIQI')
+
 locale.setlocale(locale.LC_ALL, 'C')  # ensure reproducible sorting
 
 __all__ = [
     'get_dir_lines',
     'build_vocab_from_dir',
+    'build_vocabs_from_dir',
     'word2id_to_id2word',
     'id2word_to_word2id',
     'write_word2id_to_file',
     'read_word2id_from_file',
+    'encode_batch',
     'get_common_prefixes',
+    'build_corpus_cache',
+    'get_dir_ids',
     'HansardDataset',
+    'build_shortlist',
+    'HansardIterableDataset',
+    'get_pair_lengths',
+    'BucketBatchSampler',
     'HansardDataLoader',
+    'DevicePrefetcher',
 ]
 
 
@@ -59,15 +102,50 @@ def get_dir_lines(dir_, lang, filenames=None):
         filenames = sorted(os.listdir(dir_))
     for filename in filenames:
         if filename.endswith(lang):
-            with open(os.path.join(dir_, filename)) as f:
-                offs = f.tell()
-                line = f.readline()
-                while line:
-                    yield [
-                        w for w in TOKENIZER_PATTERN.split(line.lower()) if w
-                    ], filename, offs
-                    offs = f.tell()
-                    line = f.readline()
+            tokenized, offsets = _tokenize_file(os.path.join(dir_, filename))
+            for tokens, offs in zip(tokenized, offsets):
+                yield tokens, filename, offs
+
+
+def _tokenize_file(path):
+    # read and tokenize a whole file at once. Returns the tokens of each line
+    # and the byte offset each line starts at
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'\r' in data:
+        # universal newlines treat '\r' as a line break, too
+        return _tokenize_file_by_line(path)
+    byte_lines = data.split(b'\n')
+    if not byte_lines[-1]:
+        byte_lines.pop()  # the file is empty or ends in a newline
+    text = data.decode(locale.getpreferredencoding(False)).lower()
+    if data.isascii():
+        text = text.translate(_ASCII_SEPARATORS)
+    lines = text.split('\n')[:len(byte_lines)]
+    if len(lines) != len(byte_lines):
+        # an encoding where bytes and lines don't line up
+        return _tokenize_file_by_line(path)
+    if data.isascii():
+        tokenized = list(map(str.split, lines))
+    else:
+        tokenized = list(map(_TOKEN_PATTERN.findall, lines))
+    offsets = [0]
+    offsets.extend(accumulate(len(line) + 1 for line in byte_lines))
+    return tokenized, offsets[:-1]
+
+
+def _tokenize_file_by_line(path):
+    tokenized, offsets = [], []
+    with open(path) as f:
+        offs = f.tell()
+        line = f.readline()
+        while line:
+            tokenized.append(
+                [w for w in TOKENIZER_PATTERN.split(line.lower()) if w])
+            offsets.append(offs)
+            offs = f.tell()
+            line = f.readline()
+    return tokenized, offsets
 
 
 def build_vocab_from_dir(train_dir_, lang, max_vocab=5000):
@@ -100,6 +178,72 @@ def build_vocab_from_dir(train_dir_, lang, max_vocab=5000):
     return dict((v[0], i) for i, v in enumerate(word2count))
 
 
+def build_vocabs_from_dir(
+        train_dir_, max_vocab=5000, langs=('e', 'f'), num_workers=None):
+    '''Build vocabularies for several languages in one pass over a directory
+
+    Word counts are tallied per file over a pool of processes, then merged.
+    The result for each language matches :func:`build_vocab_from_dir`,
+    including how ties in counts are broken.
+
+    Parameters
+    ----------
+    train_dir_ : str
+        A path to the transcription directory. ALWAYS use the training
+        directory, not the test, directory, when building a vocabulary.
+    max_vocab : int, optional
+        The size of each vocabulary.
+    langs : sequence, optional
+        Which languages to build vocabularies for.
+    num_workers : int, optional
+        The number of processes to count with. If :obj:`None`, one per CPU.
+        If ``1``, counts are tallied in this process.
+
+    Returns
+    -------
+    lang2word2id : dict
+        A dictionary of keys being languages in `langs`, values being
+        `word2id` dictionaries.
+    '''
+    _in_range_check('max_vocab', max_vocab, 3)
+    for lang in langs:
+        _in_set_check('lang', lang, {'e', 'f'})
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    _in_range_check('num_workers', num_workers, 1)
+    jobs = [
+        (train_dir_, filename)
+        for filename in sorted(os.listdir(train_dir_))
+        if filename[-2:] in {'.' + lang for lang in langs}
+    ]
+    lang2count = dict((lang, Counter()) for lang in langs)
+    if num_workers == 1:
+        counts = map(_count_file_words, jobs)
+        for (_, filename), word2count in zip(jobs, counts):
+            lang2count[filename[-1]].update(word2count)
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            counts = pool.imap(_count_file_words, jobs, chunksize=4)
+            for (_, filename), word2count in zip(jobs, counts):
+                lang2count[filename[-1]].update(word2count)
+    lang2word2id = dict()
+    for lang, word2count in lang2count.items():
+        word2count = sorted(
+            word2count.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+        word2count = word2count[:max_vocab - 3]
+        lang2word2id[lang] = dict(
+            (v[0], i) for i, v in enumerate(word2count))
+    return lang2word2id
+
+
+def _count_file_words(job):
+    dir_, filename = job
+    word2count = Counter()
+    for tokenized, _, _ in get_dir_lines(dir_, filename[-1], [filename]):
+        word2count.update(tokenized)
+    return word2count
+
+
 def word2id_to_id2word(word2id):
     '''word2id -> id2word'''
     return dict((v, k) for (k, v) in word2id.items())
@@ -119,16 +263,24 @@ def write_word2id_to_file(word2id, file_):
         A dictionary of keys being words, values being ids
     file_ : str or file
         A file to write `word2id` to. If a path that ends with ``.gz``, it will
-        be gzipped.
+        be gzipped. If a path that ends with ``.bin`` or a file opened in
+        binary mode, `word2id` is written in a binary format which
+        :func:`read_word2id_from_file` loads much faster than text.
     '''
     if isinstance(file_, str):
         if file_.endswith('.gz'):
             with gzip.open(file_, mode='wt') as file_:
                 return write_word2id_to_file(word2id, file_)
+        elif file_.endswith('.bin'):
+            with open(file_, 'wb') as file_:
+                return write_word2id_to_file(word2id, file_)
         else:
             with open(file_, 'w') as file_:
                 return write_word2id_to_file(word2id, file_)
     id2word = word2id_to_id2word(word2id)
+    if isinstance(file_, (io.RawIOBase, io.BufferedIOBase)):
+        file_.write(_word2id_to_bytes(word2id, id2word))
+        return
     for i in range(len(id2word)):
         file_.write('{} {}\n'.format(id2word[i], i))
 
@@ -140,20 +292,33 @@ def read_word2id_from_file(file_):
     ----------
     file_ : str or file
         A file to read `word2id` from. If a path that ends with ``.gz``, it
-        will be de-compressed via gzip.
+        will be de-compressed via gzip. If a path that ends with ``.bin`` or a
+        file opened in binary mode, it should be in the binary format written
+        by :func:`write_word2id_to_file`.
 
     Returns
     -------
     word2id : dict
         A dictionary of keys being words, values being ids
+
+    Raises
+    ------
+    ValueError
+        If the file is malformed, including when a binary file fails its
+        checksum.
     '''
     if isinstance(file_, str):
         if file_.endswith('.gz'):
             with gzip.open(file_, mode='rt') as file_:
                 return read_word2id_from_file(file_)
+        elif file_.endswith('.bin'):
+            with open(file_, 'rb') as file_:
+                return read_word2id_from_file(file_)
         else:
             with open(file_) as file_:
                 return read_word2id_from_file(file_)
+    if isinstance(file_, (io.RawIOBase, io.BufferedIOBase)):
+        return _word2id_from_bytes(file_.read())
     ids = set()
     word2id = dict()
     for line in file_:
@@ -172,6 +337,72 @@ def read_word2id_from_file(file_):
     return word2id
 
 
+def _word2id_to_bytes(word2id, id2word):
+    words = [id2word[i] for i in range(len(id2word))]
+    for word in words:
+        if not word or any(c.isspace() for c in word):
+            raise ValueError(f'Cannot store word {word!r} in a binary vocab')
+    payload = '\n'.join(words).encode('utf-8')
+    header = _VOCAB_HEADER.pack(
+        VOCAB_VERSION, len(words), len(payload), zlib.crc32(payload))
+    return VOCAB_MAGIC + header + payload
+
+
+def _word2id_from_bytes(data):
+    if not data.startswith(VOCAB_MAGIC):
+        raise ValueError('Not a binary vocabulary file')
+    start = len(VOCAB_MAGIC) + _VOCAB_HEADER.size
+    if len(data) < start:
+        raise ValueError('Binary vocabulary file is truncated')
+    version, num_words, size, crc = _VOCAB_HEADER.unpack(
+        data[len(VOCAB_MAGIC):start])
+    if version != VOCAB_VERSION:
+        raise ValueError(
+            f'Binary vocabulary file has version {version}, expected '
+            f'{VOCAB_VERSION}')
+    payload = data[start:]
+    if len(payload) != size or zlib.crc32(payload) != crc:
+        raise ValueError('Binary vocabulary file failed its checksum')
+    words = payload.decode('utf-8').split('\n') if num_words else []
+    word2id = dict(zip(words, range(len(words))))
+    if len(words) != num_words or len(word2id) != num_words:
+        raise ValueError('Binary vocabulary file has duplicate words')
+    return word2id
+
+
+def encode_batch(word2id, tokenized, unk=None):
+    '''Map a batch of token lists to ids in one call
+
+    Parameters
+    ----------
+    word2id : dict
+        A dictionary of words to ids.
+    tokenized : sequence
+        A sequence of lists of tokens, such as those yielded by
+        :func:`get_dir_lines`.
+    unk : int, optional
+        The id of out-of-vocabulary words. Defaults to ``len(word2id)``.
+
+    Returns
+    -------
+    ids, offsets : numpy.ndarray
+        ``ids[offsets[l]:offsets[l + 1]]`` are the ids of ``tokenized[l]``.
+        `ids` are 32-bit and `offsets` are 64-bit integers.
+    '''
+    if unk is None:
+        unk = len(word2id)
+    if not isinstance(tokenized, (list, tuple)):
+        tokenized = list(tokenized)
+    lens = np.fromiter(
+        map(len, tokenized), dtype=np.int64, count=len(tokenized))
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+    # the lookups run in C rather than a Python-level loop
+    ids = np.fromiter(
+        map(word2id.get, chain.from_iterable(tokenized), repeat(unk)),
+        dtype=np.int32, count=int(offsets[-1]))
+    return ids, offsets
+
+
 def get_common_prefixes(dir_):
     '''Return a list of file name prefixes common to both English and French
 
@@ -200,6 +431,238 @@ def get_common_prefixes(dir_):
     return sorted(common)
 
 
+def build_corpus_cache(dir_, lang, word2id, cache_dir, prefixes=None):
+    '''Tokenize files in a directory once and store their ids on disk
+
+    The cache holds three arrays: ``ids``, every token id of every line laid
+    end-to-end; ``offsets``, where line ``l`` occupies
+    ``ids[offsets[l]:offsets[l + 1]]``; and ``lines``, where the lines of
+    the ``p``-th cached prefix are ``lines[p]`` up to ``lines[p + 1]``.
+    Out-of-vocabulary words are stored as ``len(word2id)``.
+
+    The cache lives in a subdirectory of `cache_dir` keyed on `dir_`, `lang`,
+    the contents of `word2id`, and :const:`TOKENIZER_PATTERN`, so changing
+    any of them leads to a fresh cache.
+
+    Alongside the arrays, the cache keeps a manifest of the size,
+    modification time, and SHA-1 hash of every file it was built from. If a
+    cache already exists, only prefixes whose files are new or whose
+    contents changed are tokenized. The rest are copied over from the old
+    cache.
+
+    Parameters
+    ----------
+    dir_ : str
+        A path to the transcription directory.
+    lang : {'e', 'f'}
+        Whether to tokenize the English files ('e') or the French ones ('f').
+    word2id : dict
+        A dictionary of `lang` words to ids.
+    cache_dir : str
+        Where to store caches.
+    prefixes : sequence, optional
+        The file prefixes in `dir_` to cache. If :obj:`None`, all common
+        prefixes in `dir_` are cached.
+
+    Returns
+    -------
+    path : str
+        The directory the cache was written to.
+    '''
+    _in_set_check('lang', lang, {'e', 'f'})
+    if prefixes is None:
+        prefixes = get_common_prefixes(dir_)
+    prefixes = sorted(prefixes)
+    path = os.path.join(cache_dir, _corpus_cache_key(dir_, lang, word2id))
+    manifest = dict(
+        (p, _stat_file(os.path.join(dir_, p + '.' + lang))) for p in prefixes)
+    if os.path.isdir(path):
+        old_index = _read_corpus_index(path)
+        old = dict((p, i) for i, p in enumerate(old_index['prefixes']))
+        old_manifest = old_index['manifest']
+    else:
+        old, old_manifest = dict(), dict()
+    reused = []
+    for prefix in prefixes:
+        if prefix not in old:
+            continue
+        entry, old_entry = manifest[prefix], old_manifest[prefix]
+        if _same_stat(entry, old_entry):
+            entry['sha1'] = old_entry['sha1']
+            reused.append(prefix)
+            continue
+        # the file was touched. Hash it to see if its contents changed
+        entry['sha1'] = _hash_file(os.path.join(dir_, prefix + '.' + lang))
+        if entry['sha1'] == old_entry['sha1']:
+            reused.append(prefix)
+    changed = sorted(set(prefixes) - set(reused))
+    for prefix in changed:
+        manifest[prefix]['sha1'] = _hash_file(
+            os.path.join(dir_, prefix + '.' + lang))
+    new = _tokenize_dir_ids(dir_, lang, word2id, changed)
+    old_arrays = _load_corpus_arrays(path) if reused else None
+    new_where = dict((p, i) for i, p in enumerate(changed))
+    slices = []
+    for prefix in prefixes:
+        if prefix in new_where:
+            slices.append(_prefix_slice(*new, new_where[prefix]))
+        else:
+            slices.append(_prefix_slice(*old_arrays, old[prefix]))
+    ids, offsets, lines = _join_prefix_slices(slices)
+    index = {
+        'version': CORPUS_CACHE_VERSION,
+        'dir': os.path.abspath(dir_),
+        'lang': lang,
+        'tokenizer': TOKENIZER_PATTERN.pattern,
+        'prefixes': prefixes,
+        'manifest': manifest,
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary directory first so that a crash (or a concurrent
+    # reader) never sees a half-written cache
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        np.save(os.path.join(tmp, 'ids.npy'), ids)
+        np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp, 'lines.npy'), lines)
+        with open(os.path.join(tmp, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        del slices, old_arrays  # release the old memory map
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+    return path
+
+
+def get_dir_ids(dir_, lang, word2id, prefixes, cache_dir=None):
+    '''Get the token ids of every line in some files of a given language
+
+    Parameters
+    ----------
+    dir_ : str
+        A path to the transcription directory.
+    lang : {'e', 'f'}
+        Whether to read the English files ('e') or the French ones ('f').
+    word2id : dict
+        A dictionary of `lang` words to ids. Out-of-vocabulary words are given
+        the id ``len(word2id)``.
+    prefixes : sequence
+        The file prefixes in `dir_` to read, in order.
+    cache_dir : str, optional
+        If set, ids are memory-mapped from a cache built by
+        :func:`build_corpus_cache`, first updating it if it is missing any of
+        `prefixes` or any of their files have changed size or modification
+        time. If :obj:`None`, files are tokenized from scratch.
+
+    Returns
+    -------
+    ids, offsets, lines : numpy.ndarray
+        ``ids[offsets[l]:offsets[l + 1]]`` are the ids of the ``l``-th line
+        and ``lines[p]`` up to ``lines[p + 1]`` are the lines of
+        ``prefixes[p]``. `ids` may be a read-only memory map.
+    '''
+    prefixes = list(prefixes)
+    if cache_dir is None:
+        return _tokenize_dir_ids(dir_, lang, word2id, prefixes)
+    path = os.path.join(cache_dir, _corpus_cache_key(dir_, lang, word2id))
+    if os.path.isdir(path):
+        manifest = _read_corpus_index(path)['manifest']
+        for prefix in prefixes:
+            if prefix not in manifest:
+                break
+            stat = _stat_file(os.path.join(dir_, prefix + '.' + lang))
+            if not _same_stat(manifest[prefix], stat):
+                break
+        else:
+            return _read_corpus_cache(path, prefixes)
+    common = get_common_prefixes(dir_)
+    path = build_corpus_cache(
+        dir_, lang, word2id, cache_dir, set(common) | set(prefixes))
+    return _read_corpus_cache(path, prefixes)
+
+
+def _corpus_cache_key(dir_, lang, word2id):
+    hash_ = hashlib.sha1()
+    hash_.update(
+        f'{CORPUS_CACHE_VERSION}\n{os.path.abspath(dir_)}\n{lang}\n'
+        f'{TOKENIZER_PATTERN.pattern}\n'.encode())
+    id2word = word2id_to_id2word(word2id)
+    for i in range(len(id2word)):
+        hash_.update(f'{id2word[i]} {i}\n'.encode())
+    return hash_.hexdigest()
+
+
+def _stat_file(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _same_stat(entry, other):
+    return (
+        entry['size'] == other['size'] and
+        entry['mtime_ns'] == other['mtime_ns'])
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _tokenize_dir_ids(dir_, lang, word2id, prefixes):
+    tokenized, num_lines = [], []
+    for prefix in prefixes:
+        filenames = [prefix + '.' + lang]
+        n = len(tokenized)
+        tokenized.extend(t for t, _, _ in get_dir_lines(dir_, lang, filenames))
+        num_lines.append(len(tokenized) - n)
+    ids, offsets = encode_batch(word2id, tokenized)
+    lines = np.concatenate([[0], np.cumsum(num_lines, dtype=np.int64)])
+    return ids, offsets, lines
+
+
+def _read_corpus_index(path):
+    with open(os.path.join(path, 'index.json')) as f:
+        return json.load(f)
+
+
+def _load_corpus_arrays(path):
+    ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+    lines = np.load(os.path.join(path, 'lines.npy'))
+    return ids, offsets, lines
+
+
+def _read_corpus_cache(path, prefixes):
+    cached = _read_corpus_index(path)['prefixes']
+    ids, offsets, lines = _load_corpus_arrays(path)
+    if cached == prefixes:
+        return ids, offsets, lines
+    # gather the requested prefixes into fresh arrays
+    where = dict((p, i) for i, p in enumerate(cached))
+    return _join_prefix_slices(
+        [_prefix_slice(ids, offsets, lines, where[p]) for p in prefixes])
+
+
+def _prefix_slice(ids, offsets, lines, p):
+    # the ids and line lengths of the p-th prefix
+    a, b = lines[p], lines[p + 1]
+    return ids[offsets[a]:offsets[b]], np.diff(offsets[a:b + 1])
+
+
+def _join_prefix_slices(slices):
+    ids = np.concatenate(
+        [ids for ids, _ in slices] + [np.empty(0, dtype=np.int32)])
+    lens = np.concatenate(
+        [lens for _, lens in slices] + [np.empty(0, dtype=np.int64)])
+    offsets = np.concatenate([[0], np.cumsum(lens, dtype=np.int64)])
+    lines = np.concatenate(
+        [[0], np.cumsum([len(lens) for _, lens in slices], dtype=np.int64)])
+    return ids, offsets, lines
+
+
 class HansardDataset(torch.utils.data.Dataset):
     '''A dataset of a partition of the Canadian Hansards
 
@@ -221,6 +684,9 @@ class HansardDataset(torch.utils.data.Dataset):
     prefixes : sequence, optional
         A list of file prefixes in `dir_` to consider part of the dataset. If
         :obj:`None`, will search for all common prefixes in the directory.
+    cache_dir : str, optional
+        If set, token ids are read from (and, the first time, written to) a
+        corpus cache in this directory. See :func:`build_corpus_cache`.
 
     Attributes
     ----------
@@ -246,53 +712,58 @@ class HansardDataset(torch.utils.data.Dataset):
         The total number of unique ids in target sequences. All ids are bound
         between ``[0, target_vocab_size - 1]`` inclusive. Includes
         `target_unk`, `target_sos`, and `target_eos`.
-    pairs : tuple
+    F, E : torch.Tensor
+        Every source (target) sequence laid end-to-end, each target sequence
+        including its SOS and EOS. Both are stored in the smallest integer
+        type that can hold their ids. Indexing the dataset returns views of
+        slices of these, not copies.
+    F_offsets, E_offsets : numpy.ndarray
+        The ``i``-th pair is ``F[F_offsets[i]:F_offsets[i + 1]]`` and
+        ``E[E_offsets[i]:E_offsets[i + 1]]``.
     '''
 
     def __init__(
             self, dir_, french_word2id, english_word2id, source_language='f',
-            prefixes=None):
-        _in_set_check('source_language', source_language, {'e', 'f'})
-        if isinstance(french_word2id, str):
-            french_word2id = read_word2id_from_file(french_word2id)
-        else:
-            _word2id_validity_check('french_word2id', french_word2id)
-        if isinstance(english_word2id, str):
-            english_word2id = read_word2id_from_file(english_word2id)
-        else:
-            _word2id_validity_check('english_word2id', english_word2id)
+            prefixes=None, cache_dir=None):
+        source_word2id, target_word2id, target_language = \
+            _get_source_target_word2id(
+                french_word2id, english_word2id, source_language)
         if prefixes is None:
             prefixes = get_common_prefixes(dir_)
-        english_fns = (p + '.e' for p in prefixes)
-        french_fns = (p + '.f' for p in prefixes)
-        english_l = get_dir_lines(dir_, 'e', english_fns)
-        french_l = get_dir_lines(dir_, 'f', french_fns)
-        if source_language == 'f':
-            source_word2id = french_word2id
-            target_word2id = english_word2id
-        else:
-            source_word2id = english_word2id
-            target_word2id = french_word2id
-        pairs = []
         F_unk, F_pad = range(len(source_word2id), len(source_word2id) + 2)
         E_unk, E_sos, E_eos = range(
             len(target_word2id), len(target_word2id) + 3)
-        for (e, e_fn, _), (f, f_fn, _) in zip(english_l, french_l):
-            assert e_fn[:-2] == f_fn[:-2]
-            if not e or not f:
-                assert not e and not f  # if either is empty, both should be
-                continue
-            if source_language == 'f':
-                F, E = f, e
-            else:
-                F, E = e, f
-            F = torch.tensor([source_word2id.get(w, F_unk) for w in F])
-            E = torch.tensor(
-                [E_sos] + [target_word2id.get(w, E_unk) for w in E] + [E_eos])
-            if torch.all(F == F_unk) and torch.all(E[1:-1] == E_unk):
-                # skip sentences that are solely OOV
-                continue
-            pairs.append((F, E))
+        F, F_offs, F_lines = get_dir_ids(
+            dir_, source_language, source_word2id, prefixes, cache_dir)
+        E, E_offs, E_lines = get_dir_ids(
+            dir_, target_language, target_word2id, prefixes, cache_dir)
+        # every prefix should have as many source lines as target lines
+        assert np.array_equal(F_lines, E_lines)
+        F_lens, E_lens = np.diff(F_offs), np.diff(E_offs)
+        # if either is empty, both should be
+        assert np.array_equal(F_lens == 0, E_lens == 0)
+        # skip empty sentences and sentences that are solely OOV
+        F_known = np.concatenate([[0], np.cumsum(F != F_unk)])
+        E_known = np.concatenate([[0], np.cumsum(E != E_unk)])
+        keep = (
+            (F_known[F_offs[1:]] > F_known[F_offs[:-1]]) |
+            (E_known[E_offs[1:]] > E_known[E_offs[:-1]]))
+        F_dtype = _smallest_int_dtype(F_pad)
+        E_dtype = _smallest_int_dtype(E_eos)
+        F = F[np.repeat(keep, F_lens)].astype(F_dtype)
+        E = E[np.repeat(keep, E_lens)]
+        F_lens, E_lens = F_lens[keep], E_lens[keep]
+        # insert SOS and EOS around every target sentence
+        E_sents = np.repeat(np.arange(len(E_lens)), E_lens)
+        E_full = np.empty(len(E) + 2 * len(E_lens), dtype=E_dtype)
+        E_full[np.arange(len(E)) + 2 * E_sents + 1] = E
+        E_ends = np.cumsum(E_lens + 2)
+        E_full[E_ends - E_lens - 2] = E_sos
+        E_full[E_ends - 1] = E_eos
+        self.F = torch.from_numpy(F)
+        self.F_offsets = np.concatenate([[0], np.cumsum(F_lens)])
+        self.E = torch.from_numpy(E_full)
+        self.E_offsets = np.concatenate([[0], E_ends])
         self.dir_ = dir_
         self.source_language = source_language
         self.source_vocab_size = len(source_word2id) + 2  # pad id and unk
@@ -302,13 +773,317 @@ class HansardDataset(torch.utils.data.Dataset):
         self.target_sos = E_sos
         self.target_eos = E_eos
         self.target_vocab_size = len(target_word2id) + 3  # unk, sos, and eos
-        self.pairs = tuple(pairs)
 
     def __len__(self):
-        return len(self.pairs)
+        return len(self.F_offsets) - 1
 
     def __getitem__(self, i):
-        return self.pairs[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'HansardDataset index {i} out of range')
+        return (
+            self.F[self.F_offsets[i]:self.F_offsets[i + 1]],
+            self.E[self.E_offsets[i]:self.E_offsets[i + 1]],
+        )
+
+
+class HansardIterableDataset(torch.utils.data.IterableDataset):
+    '''A streaming version of :class:`HansardDataset`
+
+    Rather than tokenizing everything up front, files are read one prefix at a
+    time as pairs are requested, so iteration starts immediately and memory
+    does not grow with the size of the corpus. Pairs are filtered in the same
+    way as in :class:`HansardDataset`.
+
+    When iterated within a :class:`torch.utils.data.DataLoader` with multiple
+    workers, each worker reads a disjoint share of the prefixes, so no pair is
+    seen twice in an epoch.
+
+    Parameters
+    ----------
+    dir_ : str
+    french_word2id : dict or str
+    english_word2id : dict or str
+    source_language : {'e', 'f'}, optional
+    prefixes : sequence, optional
+        See :class:`HansardDataset`.
+    shuffle : bool, optional
+        Whether to shuffle the order of prefixes and, through a buffer, the
+        order of pairs.
+    shuffle_buffer : int, optional
+        The number of pairs held in memory at once for shuffling. Bigger
+        buffers shuffle better but use more memory.
+    seed : int, optional
+        Shuffling is seeded by `seed` plus `epoch`.
+
+    Attributes
+    ----------
+    dir_ : str
+    source_language : {'e', 'f'}
+    source_unk : int
+    source_pad_id : int
+    source_vocab_size : int
+    target_unk : int
+    target_sos : int
+    target_eos : int
+    target_vocab_size : int
+        See :class:`HansardDataset`.
+    prefixes : list
+    epoch : int
+        Changes the shuffle every epoch. :class:`HansardDataLoader`
+        increments it each time it is iterated over.
+    '''
+
+    def __init__(
+            self, dir_, french_word2id, english_word2id, source_language='f',
+            prefixes=None, shuffle=False, shuffle_buffer=10000, seed=0):
+        source_word2id, target_word2id, target_language = \
+            _get_source_target_word2id(
+                french_word2id, english_word2id, source_language)
+        if prefixes is None:
+            prefixes = get_common_prefixes(dir_)
+        _in_range_check('shuffle_buffer', shuffle_buffer, 1)
+        self.dir_ = dir_
+        self.source_language = source_language
+        self.target_language = target_language
+        self.source_word2id = source_word2id
+        self.target_word2id = target_word2id
+        self.source_vocab_size = len(source_word2id) + 2  # pad id and unk
+        self.source_unk = len(source_word2id)
+        self.source_pad_id = len(source_word2id) + 1
+        self.target_unk = len(target_word2id)
+        self.target_sos = len(target_word2id) + 1
+        self.target_eos = len(target_word2id) + 2
+        self.target_vocab_size = len(target_word2id) + 3  # unk, sos, and eos
+        self.prefixes = list(prefixes)
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        prefixes = list(self.prefixes)
+        worker_info = torch.utils.data.get_worker_info()
+        if self.shuffle:
+            # every worker shuffles prefixes the same way before sharding
+            random.Random(self.seed + self.epoch).shuffle(prefixes)
+        if worker_info is None:
+            worker_id = 0
+        else:
+            worker_id = worker_info.id
+            prefixes = prefixes[worker_id::worker_info.num_workers]
+        pairs = self._iter_pairs(prefixes)
+        if not self.shuffle:
+            yield from pairs
+            return
+        rng = random.Random(
+            (self.seed + self.epoch) * 1000003 + worker_id + 1)
+        buffer = []
+        for pair in pairs:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(pair)
+            else:
+                i = rng.randrange(self.shuffle_buffer)
+                yield buffer[i]
+                buffer[i] = pair
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _iter_pairs(self, prefixes):
+        F_unk, E_unk = self.source_unk, self.target_unk
+        E_sos, E_eos = self.target_sos, self.target_eos
+        for prefix in prefixes:
+            F_l = get_dir_lines(
+                self.dir_, self.source_language,
+                [prefix + '.' + self.source_language])
+            E_l = get_dir_lines(
+                self.dir_, self.target_language,
+                [prefix + '.' + self.target_language])
+            pairs = [(F, E) for (F, _, _), (E, _, _) in zip(F_l, E_l)]
+            F_ids, F_offs = encode_batch(
+                self.source_word2id, [F for F, _ in pairs], F_unk)
+            E_ids, E_offs = encode_batch(
+                self.target_word2id, [E for _, E in pairs], E_unk)
+            for l in range(len(pairs)):
+                F = F_ids[F_offs[l]:F_offs[l + 1]].tolist()
+                E = E_ids[E_offs[l]:E_offs[l + 1]].tolist()
+                if not F or not E:
+                    # if either is empty, both should be
+                    assert not F and not E
+                    continue
+                if all(f == F_unk for f in F) and all(e == E_unk for e in E):
+                    # skip sentences that are solely OOV
+                    continue
+                yield torch.tensor(F), torch.tensor([E_sos] + E + [E_eos])
+
+
+def get_pair_lengths(dataset):
+    '''Get the source and target lengths of every pair in a dataset
+
+    A :class:`HansardDataset` gets them from its offsets without touching the
+    pairs. Any other dataset is read pair by pair.
+
+    Parameters
+    ----------
+    dataset : HansardDataset or sequence
+        Yields or indexes ``(F, E)`` pairs.
+
+    Returns
+    -------
+    F_lens, E_lens : numpy.ndarray
+        64-bit integer arrays of shape ``(len(dataset),)`` of the number of
+        source and target tokens of every pair, the latter including the
+        start- and end-of-sequence tokens.
+    '''
+    if isinstance(dataset, HansardDataset):
+        return (
+            np.diff(dataset.F_offsets).astype(np.int64),
+            np.diff(dataset.E_offsets).astype(np.int64))
+    F_lens = np.array([len(F) for F, _ in dataset], dtype=np.int64)
+    E_lens = np.array([len(E) for _, E in dataset], dtype=np.int64)
+    return F_lens, E_lens
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    '''Batch together bitext pairs of similar source and target lengths
+
+    Every epoch, indices of a :class:`HansardDataset` are (optionally)
+    shuffled and split into pools of ``pool_size`` batches. Each pool is
+    sorted by source then target length and cut into batches, so a batch
+    holds sentences of similar length and needs little padding. Finally the
+    order of the batches is (optionally) shuffled.
+
+    Batches either hold a fixed number of pairs (`batch_size`) or as many
+    pairs as fit in a token budget (`max_tokens`). In the latter case, a batch
+    of ``n`` pairs is allowed when ``n * (max_F_len + max_E_len)``, i.e. the
+    number of source and target tokens after padding, is at most
+    `max_tokens`. A pair which exceeds `max_tokens` by itself gets its own
+    batch.
+
+    Shuffling is seeded by ``seed`` plus the number of epochs so far, so
+    runs with the same seed see the same batches.
+
+    Parameters
+    ----------
+    dataset : HansardDataset
+    batch_size : int or None
+        The number of pairs per batch. Exactly one of `batch_size` and
+        `max_tokens` must be set.
+    shuffle : bool, optional
+        Whether to shuffle pairs and batches every epoch.
+    seed : int, optional
+    pool_size : int or None, optional
+        How many batches worth of pairs are sorted together. Larger pools
+        mean less padding but less randomness. If :obj:`None`, the whole
+        dataset is sorted at once.
+    max_tokens : int or None, optional
+        The maximum number of padded source and target tokens per batch.
+
+    Attributes
+    ----------
+    epoch : int
+        The number of epochs begun so far.
+    num_tokens : int
+        The number of source and target tokens in the current epoch,
+        excluding padding.
+    num_padded_tokens : int
+        The number of source and target tokens in the current epoch after
+        each batch has been padded.
+    '''
+
+    def __init__(
+            self, dataset, batch_size, shuffle=True, seed=0, pool_size=100,
+            max_tokens=None):
+        if (batch_size is None) == (max_tokens is None):
+            raise ValueError(
+                'Exactly one of batch_size and max_tokens must be set')
+        if batch_size is not None:
+            _in_range_check('batch_size', batch_size, 1)
+        else:
+            _in_range_check('max_tokens', max_tokens, 1)
+        if pool_size is not None:
+            _in_range_check('pool_size', pool_size, 1)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pool_size = pool_size
+        self.max_tokens = max_tokens
+        self.epoch = 0
+        self.F_lens, self.E_lens = get_pair_lengths(dataset)
+        self.num_tokens = self.num_padded_tokens = 0
+        self.batches = self._make_batches()
+
+    @property
+    def padding_ratio(self):
+        '''The proportion of tokens in the current epoch that are padding'''
+        if not self.num_padded_tokens:
+            return 0.
+        return 1. - self.num_tokens / self.num_padded_tokens
+
+    def _make_batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        N = len(self.F_lens)
+        if self.shuffle:
+            idx = torch.randperm(N, generator=generator).numpy()
+        else:
+            idx = np.arange(N)
+        if self.pool_size is None:
+            pool = N
+        elif self.batch_size is None:
+            # as many pairs as would fill pool_size batches of average pairs
+            mean_len = (self.F_lens.sum() + self.E_lens.sum()) / max(N, 1)
+            pool = self.pool_size * max(1, int(self.max_tokens // mean_len))
+        else:
+            pool = self.pool_size * self.batch_size
+        batches = []
+        for start in range(0, N, pool):
+            pool_idx = idx[start:start + pool]
+            # lexsort sorts by the last key first
+            pool_idx = pool_idx[np.lexsort(
+                (self.E_lens[pool_idx], self.F_lens[pool_idx]))]
+            batches.extend(self._cut_pool(pool_idx))
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator)
+            batches = [batches[i] for i in order.tolist()]
+        self.num_tokens = int(self.F_lens.sum() + self.E_lens.sum())
+        self.num_padded_tokens = sum(
+            len(batch) *
+            int(self.F_lens[batch].max() + self.E_lens[batch].max())
+            for batch in batches)
+        return batches
+
+    def _cut_pool(self, pool_idx):
+        if self.batch_size is not None:
+            return [
+                pool_idx[i:i + self.batch_size]
+                for i in range(0, len(pool_idx), self.batch_size)]
+        batches = []
+        start = max_F_len = max_E_len = 0
+        F_lens = self.F_lens[pool_idx].tolist()
+        E_lens = self.E_lens[pool_idx].tolist()
+        for i, (F_len, E_len) in enumerate(zip(F_lens, E_lens)):
+            max_F_len, max_E_len = max(max_F_len, F_len), max(max_E_len, E_len)
+            if (
+                    i > start and
+                    (i - start + 1) * (max_F_len + max_E_len) >
+                    self.max_tokens):
+                batches.append(pool_idx[start:i])
+                start, max_F_len, max_E_len = i, F_len, E_len
+        if start < len(pool_idx):
+            batches.append(pool_idx[start:])
+        return batches
+
+    def __iter__(self):
+        if self.epoch:
+            self.batches = self._make_batches()
+        self.epoch += 1
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches)
 
 
 class HansardDataLoader(torch.utils.data.DataLoader):
@@ -324,6 +1099,25 @@ class HansardDataLoader(torch.utils.data.DataLoader):
     english_word2id : dict or str
     source_language : {'e', 'f'}, optional
     prefixes : sequence, optional
+    cache_dir : str, optional
+    bucket : bool, optional
+        If set, batches are drawn by a :class:`BucketBatchSampler` of pairs
+        with similar lengths, using the `batch_size` and `shuffle` keyword
+        arguments.
+    seed : int, optional
+        Seeds the :class:`BucketBatchSampler` when `bucket` is set.
+    max_tokens : int, optional
+        If set, batches are drawn by a :class:`BucketBatchSampler` holding as
+        many pairs as fit in `max_tokens` padded source and target tokens.
+        `batch_size` is ignored. Implies `bucket`.
+    stream : bool, optional
+        If set, the data are read lazily through a
+        :class:`HansardIterableDataset` instead of all at once. The `shuffle`
+        keyword argument is handed to the dataset, which shuffles prefixes
+        and pairs within a buffer of `shuffle_buffer` pairs. Cannot be
+        combined with `cache_dir`, `bucket`, or `max_tokens`.
+    shuffle_buffer : int, optional
+        The size of the shuffle buffer when `stream` is set.
     kwargs : optional
         See :class:`torch.utils.data.DataLoader` for additional arguments.
         Do not specify `collate_fn`.
@@ -331,25 +1125,256 @@ class HansardDataLoader(torch.utils.data.DataLoader):
 
     def __init__(
             self, dir_, french_word2id, english_word2id, source_language='f',
-            prefixes=None, **kwargs):
+            prefixes=None, cache_dir=None, bucket=False, seed=0,
+            max_tokens=None, stream=False, shuffle_buffer=10000, **kwargs):
         if 'collate_fn' in kwargs:
             raise TypeError(
                 "HansardDataLoader() got an unexpected keyword argument "
                 "'collate_fn'")
-        dataset = HansardDataset(
-            dir_, french_word2id, english_word2id, source_language, prefixes)
+        if stream:
+            if cache_dir is not None or bucket or max_tokens is not None:
+                raise ValueError(
+                    'stream cannot be combined with cache_dir, bucket, or '
+                    'max_tokens')
+            dataset = HansardIterableDataset(
+                dir_, french_word2id, english_word2id, source_language,
+                prefixes, kwargs.pop('shuffle', False), shuffle_buffer, seed)
+        else:
+            dataset = HansardDataset(
+                dir_, french_word2id, english_word2id, source_language,
+                prefixes, cache_dir)
+        if max_tokens is not None:
+            kwargs.pop('batch_size', None)
+            kwargs['batch_sampler'] = BucketBatchSampler(
+                dataset, None, kwargs.pop('shuffle', False), seed,
+                max_tokens=max_tokens)
+        elif bucket:
+            kwargs['batch_sampler'] = BucketBatchSampler(
+                dataset, kwargs.pop('batch_size', 1),
+                kwargs.pop('shuffle', False), seed)
         super().__init__(dataset, collate_fn=self.collate, **kwargs)
 
+    def __iter__(self):
+        if isinstance(self.dataset, HansardIterableDataset):
+            # workers get a copy of the dataset, so advance the epoch here
+            self.dataset.epoch += 1
+        return super().__iter__()
+
     def collate(self, seq):
         F, E = zip(*seq)
         F_lens = torch.tensor([len(f) for f in F])
+        # HansardDataset stores ids compactly; models expect longs
         F = torch.nn.utils.rnn.pad_sequence(
-            F, padding_value=self.dataset.source_pad_id)
+            F, padding_value=self.dataset.source_pad_id).long()
         E = torch.nn.utils.rnn.pad_sequence(
-            E, padding_value=self.dataset.target_eos)
+            E, padding_value=self.dataset.target_eos).long()
         return F, F_lens, E
 
 
+class DevicePrefetcher(object):
+    '''Load batches ahead of time on a background thread
+
+    While the caller works on one batch, a background thread iterates over
+    the `dataloader` (collating the next batches, if the `dataloader` has no
+    workers of its own) and moves up to `depth` batches to `device`. When
+    `device` is a GPU, copies are made on a separate CUDA stream so that they
+    overlap with computation. They are asynchronous if the `dataloader` pins
+    memory.
+
+    Parameters
+    ----------
+    dataloader : iterable
+        Yields tuples of tensors, such as a :class:`HansardDataLoader`.
+    device : torch.device or str
+        Where to move batches to.
+    depth : int, optional
+        The maximum number of batches loaded ahead of the one in use. If 0,
+        batches are loaded on the caller's thread as they are requested.
+
+    Attributes
+    ----------
+    wait_time : float
+        The number of seconds the caller spent waiting for batches during the
+        last (or current) iteration.
+    num_batches : int
+        The number of batches yielded during the last (or current) iteration.
+    '''
+
+    def __init__(self, dataloader, device, depth=2):
+        _in_range_check('depth', depth, 0)
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.
+        self.num_batches = 0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        self.num_batches = 0
+        if not self.depth:
+            yield from self._iter_sync()
+            return
+        queue_ = queue.Queue(self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._fill, args=(queue_, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = queue_.get()
+                self.wait_time += time.perf_counter() - start
+                if item is None:
+                    break
+                batch, event = item
+                if isinstance(batch, BaseException):
+                    raise batch
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for x in batch:
+                        # let the caching allocator know who uses the memory
+                        x.record_stream(stream)
+                self.num_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            # unblock the thread if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    queue_.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def _iter_sync(self):
+        batches = iter(self.dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            batch = tuple(x.to(self.device) for x in batch)
+            self.wait_time += time.perf_counter() - start
+            self.num_batches += 1
+            yield batch
+
+    def _fill(self, queue_, stop):
+        if self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+        else:
+            stream = None
+        try:
+            for batch in self.dataloader:
+                if stop.is_set():
+                    return
+                if stream is None:
+                    batch = tuple(x.to(self.device) for x in batch)
+                    event = None
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = tuple(
+                            x.to(self.device, non_blocking=True)
+                            for x in batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                queue_.put((batch, event))
+        except Exception as e:
+            queue_.put((e, None))
+            return
+        queue_.put(None)
+
+
+def build_shortlist(dataset, per_word=50, chunk_size=10000):
+    '''Build a table of the target words likely to translate each source word
+
+    Every source token of a sentence pair in `dataset` is paired with every
+    target token of it. The target words paired with a source word ``f`` are
+    ranked by the Dice coefficient ``2 c(f, e) / (c(f) + c(e))``, where
+    ``c(f, e)`` counts the pairs of ``f`` and ``e`` and ``c(f)`` and ``c(e)``
+    the words.
+
+    Parameters
+    ----------
+    dataset : HansardDataset
+        ALWAYS use the training data, not the test data.
+    per_word : int, optional
+        How many target words to keep per source word.
+    chunk_size : int, optional
+        How many sentence pairs to count at once. Bounds memory use.
+
+    Returns
+    -------
+    shortlist : torch.LongTensor
+        A long tensor of shape ``(dataset.source_vocab_size, per_word)`` where
+        ``shortlist[f]`` are the target ids ranked highest for the source id
+        ``f``, best first, right-padded with ``-1`` if fewer were paired with
+        ``f``.
+    '''
+    _in_range_check('per_word', per_word, 1)
+    _in_range_check('chunk_size', chunk_size, 1)
+    V_f, V_e = dataset.source_vocab_size, dataset.target_vocab_size
+    F, E = dataset.F.numpy(), dataset.E.numpy()
+    F_offs, E_offs = dataset.F_offsets, dataset.E_offsets
+    F_lens = np.diff(F_offs)
+    E_lens = np.diff(E_offs) - 2  # without SOS and EOS
+    keys = np.empty(0, dtype=np.int64)  # f * V_e + e
+    counts = np.empty(0, dtype=np.int64)
+    for start in range(0, len(F_lens), chunk_size):
+        stop = min(start + chunk_size, len(F_lens))
+        num_pairs = F_lens[start:stop] * E_lens[start:stop]
+        sents = np.repeat(np.arange(start, stop), num_pairs)
+        pairs = np.arange(len(sents)) - np.repeat(
+            np.cumsum(num_pairs) - num_pairs, num_pairs)
+        f = F[F_offs[sents] + pairs // E_lens[sents]].astype(np.int64)
+        e = E[E_offs[sents] + 1 + pairs % E_lens[sents]]
+        chunk_keys, chunk_counts = np.unique(f * V_e + e, return_counts=True)
+        keys, inverse = np.unique(
+            np.concatenate([keys, chunk_keys]), return_inverse=True)
+        counts = np.bincount(
+            inverse, np.concatenate([counts, chunk_counts])).astype(np.int64)
+    f, e = keys // V_e, keys % V_e
+    f_counts = np.bincount(F, minlength=V_f)
+    e_counts = np.bincount(E, minlength=V_e)
+    dice = 2 * counts / (f_counts[f] + e_counts[e])
+    order = np.lexsort((-dice, f))  # by f, then by decreasing dice
+    f, e = f[order], e[order]
+    ranks = np.arange(len(f)) - np.searchsorted(f, f)
+    keep = ranks < per_word
+    shortlist = np.full((V_f, per_word), -1, dtype=np.int64)
+    shortlist[f[keep], ranks[keep]] = e[keep]
+    return torch.from_numpy(shortlist)
+
+
+def _smallest_int_dtype(max_id):
+    # the smallest numpy integer type that torch can hold and fits max_id
+    for dtype in (np.uint8, np.int16, np.int32):
+        if max_id <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _get_source_target_word2id(
+        french_word2id, english_word2id, source_language):
+    _in_set_check('source_language', source_language, {'e', 'f'})
+    if isinstance(french_word2id, str):
+        french_word2id = read_word2id_from_file(french_word2id)
+    else:
+        _word2id_validity_check('french_word2id', french_word2id)
+    if isinstance(english_word2id, str):
+        english_word2id = read_word2id_from_file(english_word2id)
+    else:
+        _word2id_validity_check('english_word2id', english_word2id)
+    if source_language == 'f':
+        return french_word2id, english_word2id, 'e'
+    else:
+        return english_word2id, french_word2id, 'f'
+
+
 def _in_range_check(
         name, value, low=-float('inf'), high=float('inf'),
         error=ValueError):
@@ -70,7 +70,26 @@ class Encoder(EncoderBase):
 
 
 class DecoderWithoutAttention(DecoderBase):
-    '''A recurrent decoder without attention'''
+    '''A recurrent decoder without attention
+
+    Attributes
+    ----------
+    shortlist_ff : tuple or None
+        The `target_vocab` the rows of ``ff`` were last picked out for,
+        followed by those rows of its weight and bias. They are reused for as
+        long as `target_vocab` stays the same.
+    input_table : torch.FloatTensor or None
+        If set by :func:`precompute_input_table`, the input-to-hidden product
+        ``embedding @ W_ih^T + b_ih`` of `cell` for every target word, of
+        shape ``(V, G * 2 * H)`` where ``G`` is the number of gates. Outside
+        of training, the rnn input of a time step is then a row of it rather
+        than an embedding, and `cell` is run from that. It is not updated
+        along with the weights, so compute it again after loading or moving
+        them, or set it back to :obj:`None`.
+    '''
+
+    shortlist_ff = None
+    input_table = None
 
     def init_submodules(self):
         # initialize parameterized submodules: embedding, cell, ff
@@ -112,20 +131,13 @@ class DecoderWithoutAttention(DecoderBase):
         # F_lens is of shape (N,)
         # htilde_tm1 (output) is of shape (N, 2 * H)
         # relevant pytorch modules: torch.cat
-        #unpadded = h[:F_lens, :]
-        #:self.hidden_state_size // 2
-        #nn.torch.cat(h[0, :, :unpadded // 2)], 
-        #        h[0, :, unpadded // 2:], 1)
-        htilde_tm1 = torch.cat((h[F_lens[0]-1,0,:self.hidden_state_size//2],
-            h[0, 0,self.hidden_state_size//2:]), 0)
-        htilde_tm1 = htilde_tm1.view(1,self.hidden_state_size)
-
-        for idx in range(1, F_lens.shape[0]):
-            output =torch.cat((h[F_lens[idx]-1,idx,:self.hidden_state_size//2],
-                h[0,idx,self.hidden_state_size//2:]) , 0)
-            output = output.view(1,self.hidden_state_size)
-            htilde_tm1 = torch.cat((htilde_tm1, output), 0)
-
+        half = self.hidden_state_size // 2
+        # gather every sentence's last forward state in one go rather than
+        # concatenating one sentence at a time
+        last = (F_lens.to(h.device) - 1).view(1, -1, 1)
+        last = last.expand(1, h.shape[1], half)
+        htilde_tm1 = torch.cat(
+            (h[..., :half].gather(0, last).squeeze(0), h[0, :, half:]), 1)
         return htilde_tm1
 
     def get_current_rnn_input(self, E_tm1, htilde_tm1, h, F_lens):
@@ -136,6 +148,11 @@ class DecoderWithoutAttention(DecoderBase):
         # h is of shape (S, N, 2 * H)
         # F_lens is of shape (N,)
         # xtilde_t (output) is of shape (N, Itilde)
+        # with an input table, xtilde_t is instead already the cell's input
+        # projection, of shape (N, G * 2 * H)
+        input_table = self.get_input_table()
+        if input_table is not None:
+            return input_table[E_tm1]
         xtilde_t = self.embedding(E_tm1)
         return xtilde_t
 
@@ -145,6 +162,9 @@ class DecoderWithoutAttention(DecoderBase):
         # htilde_tm1 is of shape (N, 2 * H) or a tuple of two of those (LSTM)
         # htilde_t (output) is of same shape as htilde_tm1
         #c_tm1 = torch.zeros_like(htilde_tm1)
+        if self.get_input_table() is not None:
+            return self.get_hidden_state_from_input_projection(
+                xtilde_t, htilde_tm1)
         if self.cell_type == 'lstm':
             #print(htilde_tm1)
             htilde_t = self.cell(xtilde_t, htilde_tm1)
@@ -152,21 +172,412 @@ class DecoderWithoutAttention(DecoderBase):
             htilde_t = self.cell(xtilde_t, htilde_tm1)
         return htilde_t
 
+    def precompute_input_table(self):
+        # fill input_table from the current weights of embedding and cell.
+        # Only the first word_embedding_size columns of W_ih multiply the
+        # embedding; the rest (if any) are left for get_current_rnn_input
+        W = self.cell.weight_ih[:, :self.word_embedding_size]
+        with torch.no_grad():
+            self.input_table = torch.nn.functional.linear(
+                self.embedding.weight, W, self.cell.bias_ih)
+        return self.input_table
+
+    def get_input_table(self):
+        # the input table, if there is one and the weights can't change under
+        # it. It carries no gradient, so training never looks it up
+        if self.training:
+            return None
+        return self.input_table
+
+    def get_hidden_state_from_input_projection(self, xtilde_t, htilde_tm1):
+        # what cell would return, given its input projection
+        # xtilde_t = x_t @ W_ih^T + b_ih rather than x_t itself.
+        # xtilde_t is of shape (N, G * 2 * H)
+        # htilde_tm1 is of shape (N, 2 * H) or a tuple of two of those (LSTM)
+        # htilde_t (output) is of same shape as htilde_tm1
+        cell = self.cell
+        if self.cell_type == 'lstm':
+            h_tm1, c_tm1 = htilde_tm1
+            gates = xtilde_t + torch.nn.functional.linear(
+                h_tm1, cell.weight_hh, cell.bias_hh)
+            i, f, g, o = gates.chunk(4, 1)
+            c_t = torch.sigmoid(f) * c_tm1 + torch.sigmoid(i) * torch.tanh(g)
+            return torch.sigmoid(o) * torch.tanh(c_t), c_t
+        hidden = torch.nn.functional.linear(
+            htilde_tm1, cell.weight_hh, cell.bias_hh)
+        if self.cell_type == 'gru':
+            i_r, i_z, i_n = xtilde_t.chunk(3, 1)
+            h_r, h_z, h_n = hidden.chunk(3, 1)
+            r = torch.sigmoid(i_r + h_r)
+            z = torch.sigmoid(i_z + h_z)
+            n = torch.tanh(i_n + r * h_n)
+            return n + z * (htilde_tm1 - n)
+        if cell.nonlinearity == 'relu':
+            return torch.relu(xtilde_t + hidden)
+        return torch.tanh(xtilde_t + hidden)
+
+    def get_all_rnn_inputs(self, E):
+        # the inputs to the rnn for every time step at once. No attention.
+        # E is of shape (T, N)
+        # xtilde (output) is of shape (T, N, Itilde)
+        return self.embedding(E)
+
+    def get_all_hidden_states(self, xtilde, htilde_0):
+        # run the cell over every time step at once.
+        # xtilde is of shape (T, N, Itilde)
+        # htilde_0 is of shape (N, 2 * H) or a tuple of two of those (LSTM)
+        # htilde (output) is of shape (T, N, 2 * H), cell states discarded
+        if self.cell_type == 'lstm':
+            htilde_0 = tuple(x.unsqueeze(0) for x in htilde_0)
+        else:
+            htilde_0 = htilde_0.unsqueeze(0)
+        htilde, _ = self.get_sequence_rnn()(xtilde, htilde_0)
+        return htilde
+
+    def get_sequence_rnn(self):
+        # a single-layer torch.nn.{LSTM,GRU,RNN} with the weights of cell. It
+        # is kept out of the submodules so that the weights appear once in
+        # the state dict and parameters, under cell
+        rnn = self.__dict__.get('sequence_rnn')
+        if rnn is None:
+            rnn_class = {
+                'lstm': torch.nn.LSTM,
+                'gru': torch.nn.GRU,
+                'rnn': torch.nn.RNN,
+            }[self.cell_type]
+            rnn = rnn_class(self.cell.input_size, self.hidden_state_size)
+            self.__dict__['sequence_rnn'] = rnn
+        # point it at the cell's current weights, wherever they've been moved
+        for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+            setattr(rnn, name + '_l0', getattr(self.cell, name))
+        return rnn
+
     def get_current_logits(self, htilde_t):
         # determine un-normalized log-probability distribution over output
         # tokens for current time step.
         # htilde_t is of shape (N, 2 * H), even for LSTM (cell state discarded)
         # logits_t (output) is of shape (N, V)
+        # with a shortlist, only the rows of ff for target_vocab are used.
+        # With an output index, log-probabilities of the words it finds are
+        # returned instead
+        if self.output_index is not None and not self.training:
+            return self.output_index.search(htilde_t)
+        if self.target_vocab is not None:
+            weight, bias = self.get_shortlist_ff()
+            return torch.nn.functional.linear(htilde_t, weight, bias)
         logits_t = self.ff(htilde_t)
         return logits_t
 
+    def get_shortlist_ff(self):
+        # reuse the rows of ff picked out for the current target_vocab.
+        # Otherwise, pick them out and keep them for the next time step
+        cached = self.shortlist_ff
+        if cached is None or cached[0] is not self.target_vocab:
+            vocab = self.target_vocab
+            cached = (vocab, self.ff.weight[vocab], self.ff.bias[vocab])
+            self.shortlist_ff = cached
+        return cached[1:]
+
+
+class AttentionContext(object):
+    '''What attention needs to know about a batch of encoder states
+
+    None of this changes while a batch is decoded, so it is computed once and
+    reused at every time step.
+
+    Parameters
+    ----------
+    h : torch.FloatTensor
+        Encoder states of shape ``(S, N, 2 * H)``.
+    F_lens : torch.LongTensor, optional
+        Source lengths of shape ``(N,)``.
+    beam_width : int, optional
+        How many consecutive decoder rows share each sentence, as in a beam
+        search. Keys and values are stored once per sentence either way.
+    eps : float, optional
+        The smallest norm to scale by, as in
+        :class:`torch.nn.CosineSimilarity`.
+
+    Attributes
+    ----------
+    h : torch.FloatTensor
+    F_lens : torch.LongTensor or None
+    beam_width : int
+        What the context was built from.
+    keys : torch.FloatTensor
+        `h` scaled to unit length, of shape ``(N, S, 2 * H)``.
+    values : torch.FloatTensor
+        `h` of shape ``(N, S, 2 * H)``.
+    pad_mask : torch.BoolTensor or None
+        Of shape ``(S, N * beam_width)``, where ``pad_mask[s, n]`` is whether
+        ``h[s, n // beam_width]`` is padding. :obj:`None` if `F_lens` is.
+    '''
+
+    def __init__(self, h, F_lens=None, beam_width=1, eps=1e-08):
+        self.h = h
+        self.F_lens = F_lens
+        self.beam_width = beam_width
+        keys = h / h.norm(dim=2, keepdim=True).clamp_min(eps)
+        self.keys = keys.transpose(0, 1)
+        self.values = h.transpose(0, 1)
+        if F_lens is None:
+            self.pad_mask = None
+        else:
+            pad_mask = torch.arange(h.shape[0], device=h.device)
+            pad_mask = pad_mask.unsqueeze(-1) >= F_lens.to(h.device)  # (S, N)
+            self.pad_mask = pad_mask.unsqueeze(-1).expand(
+                -1, -1, beam_width).flatten(1)
+
+
+class OutputIndex(object):
+    '''An approximate search for the largest logits of an output layer
+
+    The rows of the output layer's weight, with the bias appended to each,
+    are clustered by k-means. For each decoder state, only the words of the
+    `probes` clusters that could hold the largest logits are scored, along
+    with the words in `always`. A cluster's logits are bounded from above by
+    its centroid's logit plus its radius times the norm of the state. If
+    those bounds can't rule out that an unscored cluster holds one of the `k`
+    largest logits of a row, every word is scored for that row instead.
+
+    Log-probabilities are normalized over the whole vocabulary. The words of
+    a cluster that wasn't scored are taken to share its centroid's logit.
+
+    Parameters
+    ----------
+    weight : torch.FloatTensor
+        The output layer's weight, of shape ``(V, 2 * H)``.
+    bias : torch.FloatTensor, optional
+        The output layer's bias, of shape ``(V,)``.
+    num_clusters : int, optional
+        How many clusters to split the words into. Defaults to the square
+        root of the number of words clustered.
+    probes : int, optional
+        How many clusters to score for each row. More probes find more of the
+        largest logits without falling back, at the cost of scoring more
+        words.
+    k : int, optional
+        How many of the largest logits of a row must be found for it not to
+        fall back. Should be the beam width.
+    slack : float, optional
+        How much of each cluster's radius goes into its bound. At 1, a row
+        that doesn't fall back has exactly the same `k` best words as when
+        every word is scored. Lower values trust the centroids more, falling
+        back less often at the cost of recall.
+    always : torch.LongTensor, optional
+        Words to score for every row, such as the end-of-sequence token.
+        They are left out of the clusters. If they are the whole vocabulary,
+        there are no clusters and every word is always scored.
+    iterations : int, optional
+        How many iterations of k-means to run.
+    seed : int, optional
+        Seeds the choice of the initial centroids.
+
+    Attributes
+    ----------
+    weight, bias : torch.FloatTensor
+    probes, k : int
+    slack : float
+    always : torch.LongTensor
+        The sorted, unique ids of `always`, of shape ``(A,)``.
+    centroids : torch.FloatTensor
+        Of shape ``(C, 2 * H + 1)``. Empty clusters are dropped, so ``C`` may
+        be less than `num_clusters`.
+    radii : torch.FloatTensor
+        Of shape ``(C,)``, the furthest any word of a cluster is from its
+        centroid.
+    log_sizes : torch.FloatTensor
+        Of shape ``(C,)``, the log of the number of words in each cluster.
+    members : torch.LongTensor
+        Of shape ``(C, M)`` where ``M`` is the size of the largest cluster.
+        ``members[c, :sizes[c]]`` are the ids of the words of cluster ``c``.
+        The rest are 0.
+    candidates : torch.LongTensor or None
+        The ids of the words :func:`search` last returned log-probabilities
+        for, of shape ``(N, A + probes * M)``. Columns that weren't scored
+        are 0, with log-probabilities of ``-inf``.
+    rows_searched, rows_exact : int
+        How many rows :func:`search` has been called on, and how many of
+        those fell back to scoring every word.
+    '''
+
+    candidates = None
+
+    def __init__(
+            self, weight, bias=None, num_clusters=None, probes=8, k=1,
+            slack=1., always=None, iterations=10, seed=0):
+        V = weight.shape[0]
+        if bias is None:
+            bias = weight.new_zeros(V)
+        self.weight, self.bias = weight, bias
+        self.k, self.slack = k, slack
+        self.rows_searched = self.rows_exact = 0
+        with torch.no_grad():
+            rows = torch.cat([weight, bias.unsqueeze(1)], 1)  # (V, 2H + 1)
+            if always is None:
+                always = torch.zeros(0, dtype=torch.long)
+            self.always = torch.unique(always.to(weight.device))
+            is_clustered = torch.ones(V, dtype=torch.bool, device=rows.device)
+            is_clustered[self.always] = False
+            ids = is_clustered.nonzero().flatten()  # (V',)
+            if num_clusters is None:
+                num_clusters = max(1, round(ids.shape[0] ** .5))
+            if ids.shape[0]:
+                assignment, centroids = _kmeans(
+                    rows[ids], num_clusters, iterations, seed)
+            else:
+                # every word is always scored. There is nothing to cluster
+                assignment, centroids = ids, rows.new_empty(0, rows.shape[1])
+            C = centroids.shape[0]
+            self.probes = min(probes, C)
+            # the words of each cluster are stored together
+            assignment, order = torch.sort(assignment)
+            ids = ids[order]
+            self.rows = rows[ids]
+            self.always_rows = rows[self.always]
+            sizes = torch.bincount(assignment, minlength=C)
+            self.sizes = sizes.tolist()
+            self.offsets = (sizes.cumsum(0) - sizes).tolist()
+            self.members = ids.new_zeros(C, max(self.sizes, default=0))
+            self.radii = rows.new_empty(C)
+            for c, (offset, size) in enumerate(zip(self.offsets, self.sizes)):
+                self.members[c, :size] = ids[offset:offset + size]
+                self.radii[c] = (
+                    self.rows[offset:offset + size] - centroids[c]
+                ).norm(dim=1).max()
+            self.centroids = centroids
+            self.log_sizes = sizes.to(rows.dtype).log()
+
+    def search(self, htilde_t):
+        '''Get the log-probabilities of the most likely words
+
+        Parameters
+        ----------
+        htilde_t : torch.FloatTensor
+            A float tensor of shape ``(N, 2 * H)`` of decoder states.
+
+        Returns
+        -------
+        logpy_t : torch.FloatTensor
+            A float tensor of shape ``(N, A + probes * M)`` where
+            ``logpy_t[n, i]`` is the log-probability of the word
+            ``candidates[n, i]``, which is stored in `candidates`.
+        '''
+        N, A = htilde_t.shape[0], self.always.shape[0]
+        with torch.no_grad():
+            q = torch.cat([htilde_t, htilde_t.new_ones(N, 1)], 1)
+            centroid_logits = q @ self.centroids.T  # (N, C)
+            bounds = centroid_logits + self.slack * (
+                self.radii * q.norm(dim=1, keepdim=True))
+            probe = bounds.topk(self.probes, 1)[1]  # (N, P)
+            logits = torch.cat([
+                q @ self.always_rows.T, self.score_probes(q, probe)], 1)
+            candidates = torch.cat([
+                self.always.expand(N, A),
+                self.members[probe].flatten(1)], 1)
+            # the words of the clusters that weren't probed, each with its
+            # centroid's logit
+            rest = (centroid_logits + self.log_sizes).scatter(
+                1, probe, -float('inf'))
+            logpy_t = logits - torch.logsumexp(
+                torch.cat([logits, rest], 1), 1, keepdim=True)
+            # rows where an unprobed cluster might beat the k-th best logit
+            # are scored exactly. Only their best words are kept
+            exact = probe.new_zeros(0)
+            if self.probes < self.centroids.shape[0]:
+                kth = logits.topk(min(self.k, logits.shape[1]), 1)[0][:, -1]
+                unprobed = bounds.scatter(1, probe, -float('inf')).max(1)[0]
+                exact = (unprobed > kth).nonzero().flatten()
+            if exact.shape[0]:
+                full = torch.nn.functional.linear(
+                    htilde_t[exact], self.weight, self.bias).log_softmax(1)
+                logpy_t[exact, :A] = full[:, self.always]
+                full[:, self.always] = -float('inf')
+                width = min(logpy_t.shape[1] - A, full.shape[1] - A)
+                top, top_ids = full.topk(width, 1)
+                logpy_t[exact, A:] = -float('inf')
+                logpy_t[exact, A:A + width] = top
+                candidates[exact, A:] = 0
+                candidates[exact, A:A + width] = top_ids
+        self.candidates = candidates
+        self.rows_searched += N
+        self.rows_exact += exact.shape[0]
+        return logpy_t
+
+    def score_probes(self, q, probe):
+        '''Score the words of the probed clusters of each row
+
+        Rows probing the same cluster are scored together, one cluster at a
+        time.
+
+        Parameters
+        ----------
+        q : torch.FloatTensor
+            A float tensor of shape ``(N, 2 * H + 1)`` of decoder states,
+            each with a 1 appended for the bias.
+        probe : torch.LongTensor
+            A long tensor of shape ``(N, P)`` of the clusters each row probes.
+
+        Returns
+        -------
+        logits : torch.FloatTensor
+            A float tensor of shape ``(N, P * M)`` where
+            ``logits[n, p * M + i]`` is the logit of ``members[probe[n, p],
+            i]``, or ``-inf`` past the end of the cluster.
+        '''
+        N, P = probe.shape
+        M = self.members.shape[1]
+        logits = q.new_full((N * P, M), -float('inf'))
+        clusters, order = probe.flatten().sort()
+        clusters, counts = torch.unique_consecutive(
+            clusters, return_counts=True)
+        start = 0
+        for c, count in zip(clusters.tolist(), counts.tolist()):
+            slots = order[start:start + count]
+            start += count
+            offset, size = self.offsets[c], self.sizes[c]
+            logits[slots, :size] = (
+                q[slots // P] @ self.rows[offset:offset + size].T)
+        return logits.view(N, P * M)
+
+
+def _kmeans(x, num_clusters, iterations, seed):
+    # cluster the rows of x by k-means, starting from num_clusters distinct
+    # rows. Returns the cluster of each row and the centroids of the clusters
+    # that aren't empty
+    generator = torch.Generator().manual_seed(seed)
+    num_clusters = min(num_clusters, x.shape[0])
+    init = torch.randperm(x.shape[0], generator=generator)[:num_clusters]
+    centroids = x[init.to(x.device)].clone()
+    for i in range(iterations + 1):
+        # the nearest centroid by Euclidean distance
+        assignment = (
+            x @ centroids.T - centroids.pow(2).sum(1) / 2).argmax(1)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        if i == iterations:
+            break
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1)
+    nonempty = counts > 0
+    assignment = (nonempty.cumsum(0) - 1)[assignment]
+    return assignment, centroids[nonempty]
+
 
 class DecoderWithAttention(DecoderWithoutAttention):
     '''A decoder, this time with attention
 
     Inherits from DecoderWithoutAttention to avoid repeated code.
+
+    Attributes
+    ----------
+    attention_context : AttentionContext or None
+        The context of the batch being decoded. It is reused for as long as
+        the decoder is handed the same `h` and `F_lens`.
     '''
 
+    attention_context = None
+
     def init_submodules(self):
         # same as before, but with a slight modification for attention
         # using: self.target_vocab_size, self.word_embedding_size, self.pad_id,
@@ -204,11 +615,17 @@ class DecoderWithAttention(DecoderWithoutAttention):
 
     def get_current_rnn_input(self, E_tm1, htilde_tm1, h, F_lens):
         # update to account for attention. Use attend() for c_t
-        xtilde_t = self.embedding(E_tm1)
         if self.cell_type == 'lstm':
             temp = self.attend(htilde_tm1[0], h, F_lens)
         else:
             temp = self.attend(htilde_tm1, h, F_lens)
+        input_table = self.get_input_table()
+        if input_table is not None:
+            # the embedding's half of the input projection is looked up. Only
+            # c_t still goes through the remaining columns of W_ih
+            W = self.cell.weight_ih[:, self.word_embedding_size:]
+            return torch.addmm(input_table[E_tm1], temp, W.T)
+        xtilde_t = self.embedding(E_tm1)
         xtilde_t = torch.cat((xtilde_t, temp), 1)
         return xtilde_t
 
@@ -219,23 +636,36 @@ class DecoderWithAttention(DecoderWithoutAttention):
         # h is of shape (S, N, 2 * H)
         # F_lens is of shape (N,)
         # c_t (output) is of shape (N, 2 * H)
+        # h may be shared by groups of K rows (see DecoderBase)
+        N, K = h.shape[1], htilde_t.shape[0] // h.shape[1]
+        context = self.get_attention_context(h, F_lens, K)
         alpha = self.get_attention_weights(htilde_t, h, F_lens)
-        c_t = torch.zeros_like(htilde_t, device=htilde_t.device)
-
-        for idx in range(alpha.shape[0]):
-            out = alpha[idx].repeat(h.shape[2],1).T*h[idx]
-            c_t = c_t + out
-
+        # c_t[n * K + k] = sum_s alpha[s, n * K + k] * h[s, n], as one batched
+        # product over sentences
+        alpha = alpha.T.reshape(N, K, -1)  # (N, K, S)
+        c_t = torch.bmm(alpha, context.values).flatten(end_dim=1)
         return c_t
 
+    def get_attention_context(self, h, F_lens, beam_width=1):
+        # reuse the current context if it was built from these very tensors.
+        # Otherwise, build a new one and keep it for the next time step
+        context = self.attention_context
+        if (context is None or context.h is not h or
+                context.F_lens is not F_lens or
+                context.beam_width != beam_width):
+            context = AttentionContext(h, F_lens, beam_width)
+            self.attention_context = context
+        return context
+
     def get_attention_weights(self, htilde_t, h, F_lens):
-        # DO NOT MODIFY! Calculates attention weights, ensuring padded terms
-        # in h have weight 0 and no gradient. You have to implement
-        # get_energy_scores()
+        # Calculates attention weights, ensuring padded terms in h have weight
+        # 0 and no gradient. The padding mask comes from the attention context
+        # rather than being rebuilt every step
         # alpha_t (output) is of shape (S, N)
+        context = self.get_attention_context(
+            h, F_lens, htilde_t.shape[0] // h.shape[1])
+        pad_mask = context.pad_mask  # (S, N)
         e_t = self.get_energy_scores(htilde_t, h)
-        pad_mask = torch.arange(h.shape[0], device=h.device)
-        pad_mask = pad_mask.unsqueeze(-1) >= F_lens  # (S, N)
         e_t = e_t.masked_fill(pad_mask, -float('inf'))
         return torch.nn.functional.softmax(e_t, 0)
 
@@ -244,13 +674,19 @@ class DecoderWithAttention(DecoderWithoutAttention):
         # htilde_t is of shape (N, 2 * H)
         # h is of shape (S, N, 2 * H)
         # e_t (output) is of shape (S, N)
-        cos = torch.nn.CosineSimilarity(dim=1, eps=1e-08)
-        e_t = cos(htilde_t, h[0]).view(1,-1)
-        c = 1
-        for h_idx in h[1:]:
-            c = c+1
-            e_t = torch.cat((e_t, cos(htilde_t, h_idx).view(1,-1)), 0)
-        return e_t
+        # scale both to unit length (as torch.nn.CosineSimilarity does), then
+        # take every dot product in one batched product. The encoder states
+        # were scaled once for the whole batch by the attention context
+        context = self.attention_context
+        if context is None or context.h is not h:
+            context = AttentionContext(h)
+        eps = 1e-08
+        htilde_t = htilde_t / htilde_t.norm(dim=1, keepdim=True).clamp_min(eps)
+        # the K rows sharing a sentence are scored against its keys together
+        N, S = context.keys.shape[:2]
+        htilde_t = htilde_t.view(N, -1, htilde_t.shape[1]).transpose(1, 2)
+        e_t = torch.bmm(context.keys, htilde_t)  # (N, S, K)
+        return e_t.transpose(0, 1).reshape(S, -1)
 
 
 class EncoderDecoder(EncoderDecoderBase):
@@ -288,41 +724,70 @@ class EncoderDecoder(EncoderDecoderBase):
         # relevant pytorch modules: torch.{zero_like,stack}
         # hint: recall an LSTM's cell state is always initialized to zero.
         # Note logits sequence dimension is one shorter than E (why?)
-        '''
-        htilde_tm1 = self.decoder.get_first_hidden_state(h, F_lens)
-        print("htilde_tm1 ", htilde_tm1.shape)
-        #xtilde_t = self.decoder.get_current_rnn_input(E[0], htilde_tm1, h, F_lens) #(N, Itilde)
-        print("h ", h.shape)
-
-        for di in range(E.shape[0]):
-            htilde_tm1 = self.decoder.get_current_hidden_state(xtilde_t, htilde_tm1)
-            xtilde_t = self.decoder.get_current_rnn_input(E[di], htilde_tm1, h, F_lens)
-            decoder_input = torch.stack([decoder_input, xtilde_t[:-1]])
-        print("decoder_input ", decoder_input.shape)
-        return decoder_input 
-        '''
-        logits_ls = []
+        htilde = self.get_hidden_states_for_teacher_forcing(h, F_lens, E)
+        return self.decoder.get_current_logits(htilde)  # (T - 1, N, V)
+
+    def get_packed_logits_for_teacher_forcing(self, h, F_lens, E, keep):
+        # ff is only applied to the states of the kept positions
+        # keep is of shape (T - 1, N)
+        # logits (output) is of shape (M, Vo), M the number of kept positions
+        htilde = self.get_packed_hidden_states_for_teacher_forcing(
+            h, F_lens, E, keep)
+        return self.decoder.get_current_logits(htilde)
+
+    def get_packed_hidden_states_for_teacher_forcing(self, h, F_lens, E, keep):
+        # htilde (output) is of shape (M, 2 * H)
+        htilde = self.get_hidden_states_for_teacher_forcing(h, F_lens, E)
+        idx = keep.flatten().nonzero().flatten()  # (M,)
+        return htilde.flatten(end_dim=1).index_select(0, idx)
+
+    def get_hidden_states_for_teacher_forcing(self, h, F_lens, E):
+        # the decoder states (cell states discarded) that the logits of
+        # get_logits_for_teacher_forcing are computed from
+        # htilde (output) is of shape (T - 1, N, 2 * H)
         htilde_tm1 = self.decoder.get_first_hidden_state(h, F_lens)
-        for di in range(E.shape[0]-1):
+        if self.cell_type == 'lstm':
+            htilde_tm1 = (htilde_tm1, torch.zeros_like(htilde_tm1))
+        if not isinstance(self.decoder, DecoderWithAttention):
+            # no step depends on attention, so the inputs of every step are
+            # known up front. They go through one multi-step recurrent layer
+            xtilde = self.decoder.get_all_rnn_inputs(E[:-1])  # (T - 1, N, I)
+            return self.decoder.get_all_hidden_states(xtilde, htilde_tm1)
+        htilde = []
+        # scale the encoder states and build the padding mask once for every
+        # time step
+        self.decoder.attention_context = AttentionContext(h, F_lens)
+        for t in range(E.shape[0] - 1):
+            xtilde_t = self.decoder.get_current_rnn_input(
+                E[t], htilde_tm1, h, F_lens)
+            htilde_tm1 = self.decoder.get_current_hidden_state(
+                xtilde_t, htilde_tm1)
             if self.cell_type == 'lstm':
-                xtilde_t = self.decoder.get_current_rnn_input(E[di], 
-                    (htilde_tm1, htilde_tm1),h,F_lens)
-                h_t = self.decoder.get_current_hidden_state(xtilde_t,
-                    (htilde_tm1, htilde_tm1))
+                htilde.append(htilde_tm1[0])
             else:
-                xtilde_t = self.decoder.get_current_rnn_input(E[di], 
-                    htilde_tm1,h,F_lens)
-                h_t = self.decoder.get_current_hidden_state(xtilde_t,
-                    htilde_tm1)
-            logit_t = self.decoder.get_current_logits(2*h_t[0])
-            logits_ls.append(logit_t)
-        logits = torch.stack([i for i in logits_ls])
-        if logits.shape[0] !=E.shape[0]-1 and \
-            logits.shape[0] !=E.shape[1] and \
-            logits.shape[0] !=self.target_vocab_size:
-            print(False)
-
-        return logits
+                htilde.append(htilde_tm1)
+        # don't hold on to this batch's graph
+        self.decoder.attention_context = None
+        return torch.stack(htilde)
+
+    def beam_search(self, h, F_lens, max_T, on_max):
+        # the decoder builds an attention context at the first step of the
+        # search and reuses it for the rest. The same goes for the rows of ff
+        # on a shortlist. Drop them once done
+        try:
+            return super().beam_search(h, F_lens, max_T, on_max)
+        finally:
+            self.decoder.shortlist_ff = None
+            if isinstance(self.decoder, DecoderWithAttention):
+                self.decoder.attention_context = None
+
+    def beam_search_stream(self, *args, **kwargs):
+        try:
+            yield from super().beam_search_stream(*args, **kwargs)
+        finally:
+            self.decoder.target_vocab = self.decoder.shortlist_ff = None
+            if isinstance(self.decoder, DecoderWithAttention):
+                self.decoder.attention_context = None
 
     def update_beam(self, htilde_t, b_tm1_1, logpb_tm1, logpy_t):
         # perform the operations within the psuedo-code's loop in the
@@ -390,85 +855,3 @@ class EncoderDecoder(EncoderDecoderBase):
         b_t_1 = torch.cat([torch.gather(b_tm1_1, 2,kept_path), v], dim=0)
 
         return b_t_0, b_t_1, logpb_t
-
-print("****")
-
-en = Encoder(10)
-x = en.get_all_rnn_inputs(torch.LongTensor([[1,2,4,5],[4,3,9,8]]))
-F_lens = torch.LongTensor([2,2,2,2])
-h = en.get_all_hidden_states(x, F_lens, 2.2)
-b_tm1_1 =torch.Tensor([[4., 4., 4., 4.],
-         [3., 3., 3., 3.],
-         [2., 2., 2., 2.],
-         [1., 1., 1., 1.],
-         [5., 5., 5., 5.]])
-dec = DecoderWithoutAttention(20)
-logpb_tm1 =torch.Tensor([[1.2, 1.3, 1.4, 1.5],
-         [3., 3.1, 3.2, 3.3],
-         [2.2, 2.2, 2.3, 2.3],
-         [1., 1., 1.2, 1.3],
-         [5.1, 5.2, 5.3, 5.4]])
-#htilde_tm1= dec.get_first_hidden_state(h, F_lens)
-logpy_t = torch.Tensor([
-         [[1.2, 1.3, 1.4, 1.5, 1.2, 1.3, 1.4, 1.5],[1.2, 1.3, 1.4, 1.5, 1.2, 1.3, 1.4, 1.5],[1.2, 1.3, 1.4, 1.5, 1.2, 1.3, 1.4, 1.5],[2.2, 2.2, 2.3, 2.3,3., 3.1, 3.2, 3.3]],
-         [[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3]],
-         [[2.2, 2.2, 2.3, 2.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3]],
-         [[1., 1., 1.2, 1.3,1., 1., 1.2, 1.3],[1., 1., 1.2, 1.3,1., 1., 1.2, 1.3],[2.2, 2.2, 2.3, 2.3,3., 3.1, 3.2, 3.3],[2.2, 2.2, 2.3, 2.3,3., 3.1, 3.2, 3.3]],
-         [[5.1, 5.2, 5.3, 5.4,5.1, 5.2, 5.3, 5.4],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3],[3., 3.1, 3.2, 3.3,3., 3.1, 3.2, 3.3]]])
-htilde_t = torch.Tensor([[[1., 2., 3., 4.],
-         [4., 5., 5., 3.],
-         [6., 7., 9., 4.],
-         [9., 8., 1., 5.]],
-
-        [[4., 3., 2., 1.],
-         [9., 8., 1., 5.],
-         [3., 9., 1., 6.],
-         [6., 7., 9., 4.]],
-
-        [[1., 5., 4., 2.],
-         [2., 3., 4., 3.],
-         [7., 2., 3., 8.],
-         [7., 2., 3., 8.]],
-
-        [[2., 8., 3., 5.],
-         [4., 4., 5., 1.],
-         [4., 5., 1., 9.],
-         [3., 9., 1., 6.]],
-
-        [[1., 2., 3., 5.],
-         [4., 5., 2., 4.],
-         [4., 5., 2., 4.],
-         [7., 5., 3., 2.]]])
-endec = EncoderDecoder(Encoder,DecoderWithAttention,8,8)
-print(endec.update_beam(htilde_t, b_tm1_1, logpb_tm1, logpy_t))
-'''
-logpb_tm1 = torch.where(
-            torch.arange(3) > 0,  # K
-            torch.full_like(
-                htilde_tm1[..., 0].unsqueeze(1), -float('inf')),  # k > 0
-            torch.zeros_like(
-                htilde_tm1[..., 0].unsqueeze(1)),  # k == 0
-        )
-print(logpb_tm1)
-print(logpb_tm1.size())
-print("*******************")
-b_tm1_1 = torch.full_like(  # (t, N, K)
-            logpb_tm1, 100100, dtype=torch.long).unsqueeze(0)
-print(b_tm1_1)
-print(b_tm1_1.size())
-
-#print(h[0, 0,dec.hidden_state_size//2:])
-print("*******************")
-F = torch.LongTensor([4,3,2])
-h2 = torch.LongTensor([[[1,2,3,4],[4,5,5,3],[6,7,9,4]],
-                       [[4,3,2,1],[9,8,1,5],[3,9,1,6]],
-                       [[1,5,4,2],[2,3,4,3],[7,2,3,8]],
-                       [[2,8,3,5],[4,4,5,1],[4,5,1,9]]])
-print(h2.size())
-#temp = h2[F[:]-1,:,:2//2]
-#print(torch.LongTensor(h2[F[0]-1, 0,:]))
-temp = torch.cat([h2[F[i]-1, i,:] for i in [0,1]], 1)
-print(temp.size())
-print(temp)
-#print(torch.diagonal(temp,dim1=0, dim2=1))
-'''
@@ -9,12 +9,14 @@ import os
 import argparse
 import gzip
 import random
+import time
 
 import torch
 
 import a2_dataloader
 import a2_encoder_decoder
 import a2_training_and_testing
+import a2_benchmarks
 
 
 def build_vocab(opts):
@@ -23,6 +25,29 @@ def build_vocab(opts):
     a2_dataloader.write_word2id_to_file(word2id, opts.out)
 
 
+def build_vocabs(opts):
+    lang2word2id = a2_dataloader.build_vocabs_from_dir(
+        opts.training_dir, opts.max_vocab, num_workers=opts.num_workers)
+    a2_dataloader.write_word2id_to_file(lang2word2id['e'], opts.english_out)
+    a2_dataloader.write_word2id_to_file(lang2word2id['f'], opts.french_out)
+
+
+def convert_vocab(opts):
+    word2id = a2_dataloader.read_word2id_from_file(opts.vocab_in)
+    a2_dataloader.write_word2id_to_file(word2id, opts.vocab_out)
+
+
+def build_shortlist(opts):
+    french_word2id = a2_dataloader.read_word2id_from_file(opts.french_vocab)
+    english_word2id = a2_dataloader.read_word2id_from_file(opts.english_vocab)
+    dataset = a2_dataloader.HansardDataset(
+        opts.training_dir, french_word2id, english_word2id, opts.source_lang,
+        cache_dir=opts.cache_dir)
+    del french_word2id, english_word2id
+    shortlist = a2_dataloader.build_shortlist(dataset, opts.per_word)
+    torch.save(shortlist, opts.out)
+
+
 def build_data_train_dev_split(opts):
     common = a2_dataloader.get_common_prefixes(opts.training_dir)
     random.seed(opts.seed)
@@ -80,7 +105,9 @@ def train(opts):
     train_prefixes = opts.train_prefixes.read().strip().split('\n')
     train_dataloader = a2_dataloader.HansardDataLoader(
         opts.training_dir, french_word2id, english_word2id, opts.source_lang,
-        train_prefixes, batch_size=opts.batch_size, shuffle=True,
+        train_prefixes, cache_dir=opts.cache_dir, bucket=opts.bucket,
+        seed=opts.seed, max_tokens=opts.max_tokens, stream=opts.stream,
+        batch_size=opts.batch_size, shuffle=True,
         pin_memory=(opts.device.type == 'cuda'),
         num_workers=1,
     )
@@ -88,15 +115,27 @@ def train(opts):
     dev_prefixes = opts.dev_prefixes.read().strip().split('\n')
     dev_dataloader = a2_dataloader.HansardDataLoader(
         opts.training_dir, french_word2id, english_word2id, opts.source_lang,
-        dev_prefixes, batch_size=opts.batch_size,
+        dev_prefixes, cache_dir=opts.cache_dir, bucket=opts.bucket,
+        seed=opts.seed, max_tokens=opts.max_tokens, stream=opts.stream,
+        batch_size=opts.batch_size,
         pin_memory=(opts.device.type == 'cuda'),
         num_workers=1,
     )
     del dev_prefixes, french_word2id, english_word2id
+    if opts.stream:
+        num_tokens = None  # counting would mean reading everything up front
+    else:
+        F_lens, E_lens = a2_dataloader.get_pair_lengths(
+            train_dataloader.dataset)
+        num_tokens = int(F_lens.sum() + E_lens.sum())
+        del F_lens, E_lens
     model = init(opts, train_dataloader)
     print(model)
+    if opts.sparse_embeddings:
+        model.encoder.embedding.sparse = True
+        model.decoder.embedding.sparse = True
     model.to(opts.device)
-    optimizer = torch.optim.Adam(model.parameters())
+    optimizer = a2_training_and_testing.build_optimizer(model)
     best_bleu = 0.
     num_poor = 0
     epoch = 1
@@ -110,8 +149,11 @@ def train(opts):
         model.train()
         print("***")
         print(train_dataloader)
+        start = time.time()
         loss = a2_training_and_testing.train_for_epoch(
-            model, train_dataloader, optimizer, opts.device)
+            model, train_dataloader, optimizer, opts.device, opts.prefetch,
+            opts.loss_chunk_size, opts.sampled_softmax)
+        duration = time.time() - start
         model.eval()
         bleu = a2_training_and_testing.compute_average_bleu_over_dataset(
             model, dev_dataloader,
@@ -120,6 +162,14 @@ def train(opts):
             opts.device,
         )
         print(f'Epoch {epoch}: loss={loss}, BLEU={bleu}')
+        if num_tokens is not None:
+            tokens_per_sec = num_tokens / duration
+            print(f'Epoch {epoch}: {tokens_per_sec:.1f} tokens/s')
+        if isinstance(
+                train_dataloader.batch_sampler,
+                a2_dataloader.BucketBatchSampler):
+            padding_ratio = train_dataloader.batch_sampler.padding_ratio
+            print(f'Epoch {epoch}: padding ratio={padding_ratio:.3f}')
         if bleu < best_bleu:
             num_poor += 1
         else:
@@ -139,6 +189,8 @@ def test(opts):
     english_word2id = a2_dataloader.read_word2id_from_file(opts.english_vocab)
     dataloader = a2_dataloader.HansardDataLoader(
         opts.testing_dir, french_word2id, english_word2id, opts.source_lang,
+        cache_dir=opts.cache_dir, bucket=opts.bucket,
+        max_tokens=opts.max_tokens, stream=opts.stream,
         batch_size=opts.batch_size,
         pin_memory=(opts.device.type == 'cuda')
     )
@@ -149,13 +201,188 @@ def test(opts):
     del state_dict
     model.to(opts.device)
     model.eval()
-    bleu = a2_training_and_testing.compute_average_bleu_over_dataset(
+    if opts.input_table:
+        model.decoder.precompute_input_table()
+    approximate = opts.shortlist is not None or opts.output_index
+    if approximate:
+        # decode with the full vocabulary first to compare against
+        model.beam_rows_decoded = 0
+        start = time.time()
+        full_bleu = compute_test_bleu(opts, model, dataloader)
+        full_duration = time.time() - start
+        full_rows = model.beam_rows_decoded
+    if opts.shortlist is not None:
+        model.shortlist = torch.load(opts.shortlist)
+        model.shortlist_frequent = opts.shortlist_frequent
+    if opts.output_index:
+        decoder = model.decoder
+        # leave some words to cluster, besides <sos> and <eos>
+        always = torch.arange(
+            min(opts.index_frequent, model.target_vocab_size - 2),
+            device=opts.device)
+        always = torch.cat([
+            always, torch.tensor([model.target_eos], device=opts.device)])
+        start = time.time()
+        decoder.output_index = a2_encoder_decoder.OutputIndex(
+            decoder.ff.weight, decoder.ff.bias, opts.index_clusters,
+            opts.index_probes, opts.beam_width, opts.index_slack, always)
+        print(
+            f'Built an output index of '
+            f'{decoder.output_index.centroids.shape[0]} clusters in '
+            f'{time.time() - start:.1f}s')
+    model.beam_rows_decoded = model.beam_rows_skipped = 0
+    start = time.time()
+    bleu = compute_test_bleu(opts, model, dataloader)
+    duration = time.time() - start
+    print(f'The average BLEU score over the test set was {bleu}')
+    if approximate:
+        name = 'the shortlist' if opts.shortlist is not None else (
+            'the output index')
+        print(
+            f'With {name}, decoding took {duration:.1f}s rather than '
+            f'{full_duration:.1f}s ({full_duration / duration:.2f}x) and BLEU '
+            f'changed by {bleu - full_bleu:+.4f} from {full_bleu}')
+        print(
+            f'Beam steps took {duration / model.beam_rows_decoded * 1e6:.1f} '
+            f'us per decoder row rather than '
+            f'{full_duration / full_rows * 1e6:.1f} us')
+    if opts.output_index:
+        index = decoder.output_index
+        print(
+            f'The output index fell back to scoring every word for '
+            f'{index.rows_exact} of {index.rows_searched} decoder rows')
+    rows = model.beam_rows_decoded + model.beam_rows_skipped
+    flops = a2_benchmarks.decoder_flops_per_row(model) / 1e9
+    print(
+        f'Beam search skipped {model.beam_rows_skipped} of {rows} decoder '
+        f'rows for finished sentences, saving ~'
+        f'{model.beam_rows_skipped * flops:.1f} of {rows * flops:.1f} '
+        f'GFLOPs (excluding attention)')
+
+
+def compute_test_bleu(opts, model, dataloader):
+    if opts.continuous:
+        return a2_training_and_testing.compute_average_bleu_over_stream(
+            model, dataloader,
+            dataloader.dataset.target_sos,
+            dataloader.dataset.target_eos,
+            opts.device,
+            opts.continuous,
+        )
+    return a2_training_and_testing.compute_average_bleu_over_dataset(
         model, dataloader,
         dataloader.dataset.target_sos,
         dataloader.dataset.target_eos,
         opts.device,
     )
-    print(f'The average BLEU score over the test set was {bleu}')
+
+
+def bench(opts):
+    if opts.benchmark == 'tokenizer':
+        results = a2_benchmarks.benchmark_tokenizer(
+            opts.training_dir, repeats=opts.repeats)
+        print(f'Tokenized {results["lines"]} lines')
+        print(f'Line-by-line: {results["by_line"]:.0f} lines/s')
+        print(f'Bulk: {results["bulk"]:.0f} lines/s')
+    elif opts.benchmark == 'vocab':
+        results = a2_benchmarks.benchmark_vocab(
+            opts.vocab, opts.training_dir, opts.lang, repeats=opts.repeats)
+        print(f'Text load: {results["text"] * 1000:.1f} ms')
+        print(f'Binary load: {results["binary"] * 1000:.1f} ms')
+        print(f'Encoded {results["tokens"]} tokens')
+        print(f'Per-token lookup: {results["by_token"]:.0f} tokens/s')
+        print(f'Batch encode: {results["batch"]:.0f} tokens/s')
+    elif opts.benchmark == 'first-hidden-state':
+        results = a2_benchmarks.benchmark_first_hidden_state(
+            opts.batch_sizes, repeats=opts.repeats, device=opts.device)
+        for N, result in results.items():
+            print(
+                f'N={N}: loop={result["loop"] * 1000:.3f} ms, '
+                f'gather={result["gather"] * 1000:.3f} ms, '
+                f'equal={result["equal"]}')
+    elif opts.benchmark == 'attention':
+        results = a2_benchmarks.benchmark_attention(
+            opts.source_lens, opts.batch_size, num_steps=opts.num_steps,
+            repeats=opts.repeats, device=opts.device)
+        for S, result in results.items():
+            print(
+                f'S={S}: loop={result["loop"] * 1000:.3f} ms, '
+                f'batched={result["batched"] * 1000:.3f} ms, '
+                f'cached={result["cached"] * 1000:.3f} ms, '
+                f'max diff={result["max_diff"]:.2e}')
+    elif opts.benchmark == 'beam-encoder-states':
+        results = a2_benchmarks.benchmark_beam_encoder_states(
+            opts.batch_size, opts.beam_widths, repeats=opts.repeats,
+            device=opts.device)
+        for K, result in results.items():
+            print(
+                f'K={K}: replicated={result["replicated"] * 1000:.1f} ms '
+                f'({result["replicated_mb"]:.1f} MB), '
+                f'shared={result["shared"] * 1000:.1f} ms '
+                f'({result["shared_mb"]:.1f} MB), '
+                f'max diff={result["max_diff"]:.2e}')
+    elif opts.benchmark == 'teacher-forcing':
+        results = a2_benchmarks.benchmark_teacher_forcing(
+            opts.target_lens, opts.batch_size, cell_type=opts.cell_type,
+            repeats=opts.repeats, device=opts.device)
+        for T, result in results.items():
+            print(
+                f'T={T}: loop={result["loop"]:.0f} tokens/s, '
+                f'fused={result["fused"]:.0f} tokens/s, '
+                f'max diff={result["max_diff"]:.2e}')
+    elif opts.benchmark == 'input-table':
+        results = a2_benchmarks.benchmark_input_table(
+            opts.beam_widths, opts.batch_size, vocab_size=opts.vocab_size,
+            cell_type=opts.cell_type, attention=opts.with_attention,
+            repeats=opts.repeats, device=opts.device)
+        print(f'Input table: {results.pop("table_mb"):.1f} MB')
+        for K, result in results.items():
+            print(
+                f'K={K}: embedding={result["embedding"] * 1000:.1f} ms, '
+                f'table={result["table"] * 1000:.1f} ms, '
+                f'max diff={result["max_diff"]:.2e}')
+    elif opts.benchmark == 'output-index':
+        results = a2_benchmarks.benchmark_output_index(
+            opts.probes, opts.batch_size, opts.beam_width,
+            vocab_size=opts.vocab_size, slack=opts.slack,
+            repeats=opts.repeats, device=opts.device)
+        for P, result in results.items():
+            print(
+                f'P={P}: exact={result["exact"] * 1000:.2f} ms/step, '
+                f'index={result["index"] * 1000:.2f} ms/step, '
+                f'recall={result["recall"]:.3f}, '
+                f'fallback={result["fallback"]:.3f}')
+    elif opts.benchmark == 'loss':
+        results = a2_benchmarks.benchmark_loss(
+            opts.num_tokens, opts.vocab_size, chunk_size=opts.chunk_size,
+            device=opts.device)
+        for M, result in results.items():
+            print(
+                f'{M} tokens ({result["logits_mb"]:.0f} MB of logits): '
+                f'full={result["full"]:.0f} MB in {result["full_s"]:.2f}s, '
+                f'chunked={result["chunked"]:.0f} MB in '
+                f'{result["chunked_s"]:.2f}s '
+                f'({result["full"] / result["chunked"]:.1f}x less)')
+    elif opts.benchmark == 'optimizer':
+        results = a2_benchmarks.benchmark_optimizer(
+            opts.vocab_size, num_tokens=opts.num_tokens, repeats=opts.repeats,
+            device=opts.device)
+        for M, result in results.items():
+            print(
+                f'{M} tokens: dense={result["dense"] * 1000:.2f} ms, '
+                f'sparse={result["sparse"] * 1000:.2f} ms')
+    elif opts.benchmark == 'dataset-memory':
+        dataset = a2_dataloader.HansardDataset(
+            opts.training_dir, opts.french_vocab, opts.english_vocab,
+            opts.source_lang, cache_dir=opts.cache_dir)
+        results = a2_benchmarks.benchmark_dataset_memory(dataset)
+        print(f'Flat storage: {results["flat_size"]:.1f} MB')
+        print(
+            f'Memory dirtied per worker, one tensor per sequence: '
+            f'{results["pairs"]:.1f} MB')
+        print(
+            f'Memory dirtied per worker, flat storage: '
+            f'{results["flat"]:.1f} MB')
 
 
 def main(args=None):
@@ -163,12 +390,20 @@ def main(args=None):
     opts = parser.parse_args(args)
     if opts.command == 'vocab':
         build_vocab(opts)
+    elif opts.command == 'vocabs':
+        build_vocabs(opts)
+    elif opts.command == 'convert-vocab':
+        convert_vocab(opts)
+    elif opts.command == 'shortlist':
+        build_shortlist(opts)
     elif opts.command == 'split':
         build_data_train_dev_split(opts)
     elif opts.command == 'train':
         train(opts)
     elif opts.command == 'test':
         test(opts)
+    elif opts.command == 'bench':
+        bench(opts)
     return 0
 
 
@@ -177,9 +412,13 @@ def build_parser():
     subparsers = parser.add_subparsers(
         help='Specific commands', dest='command')
     build_vocab_parser(subparsers)
+    build_vocabs_parser(subparsers)
+    build_convert_vocab_parser(subparsers)
+    build_shortlist_parser(subparsers)
     build_data_train_dev_split_parser(subparsers)
     build_training_parser(subparsers)
     build_testing_parser(subparsers)
+    build_bench_parser(subparsers)
     return parser
 
 
@@ -208,6 +447,96 @@ def build_vocab_parser(subparsers):
     return parser
 
 
+def build_vocabs_parser(subparsers):
+    parser = subparsers.add_parser(
+        'vocabs',
+        help='Build both the English and French vocab files in one pass'
+    )
+    parser.add_argument(
+        'training_dir', action=readable_dir,
+        help='Where the training data is located'
+    )
+    parser.add_argument(
+        'english_out', type=lambda p: possible_gzipped_file(p, 'w'),
+        help='Where to output the English vocab file to. If the path ends '
+        'with ".gz", will gzip the file.'
+    )
+    parser.add_argument(
+        'french_out', type=lambda p: possible_gzipped_file(p, 'w'),
+        help='Where to output the French vocab file to. If the path ends '
+        'with ".gz", will gzip the file.'
+    )
+    parser.add_argument(
+        '--max-vocab', metavar='V', type=lower_bound, default=20000,
+        help='The maximum size of each vocabulary. Words with lower '
+        'frequency will be cut first'
+    )
+    parser.add_argument(
+        '--num-workers', metavar='P', type=lower_bound, default=None,
+        help='The number of processes to count words with. Defaults to one '
+        'per CPU'
+    )
+    return parser
+
+
+def build_convert_vocab_parser(subparsers):
+    parser = subparsers.add_parser(
+        'convert-vocab',
+        help='Convert a vocab file between the text and binary formats'
+    )
+    parser.add_argument(
+        'vocab_in', type=possible_gzipped_file,
+        help='The vocab file to read. If the path ends with ".bin", it is '
+        'read as binary, otherwise as text'
+    )
+    parser.add_argument(
+        'vocab_out', type=lambda p: possible_gzipped_file(p, 'w'),
+        help='Where to write the converted vocab file. If the path ends with '
+        '".bin", it is written as binary, otherwise as text. If the path ends '
+        'with ".gz", will gzip the file.'
+    )
+    return parser
+
+
+def build_shortlist_parser(subparsers):
+    parser = subparsers.add_parser(
+        'shortlist',
+        help='Build a table of the target words likely to translate each '
+        'source word, to restrict decoding to'
+    )
+    parser.add_argument(
+        'training_dir', action=readable_dir,
+        help='Where the training data is located'
+    )
+    parser.add_argument(
+        'english_vocab', type=possible_gzipped_file,
+        help='English vocabulary file'
+    )
+    parser.add_argument(
+        'french_vocab', type=possible_gzipped_file,
+        help='French vocabulary file'
+    )
+    parser.add_argument(
+        'out', type=lambda p: possible_gzipped_file(p, 'wb'),
+        help='Where to output the shortlist. If the path ends with ".gz", '
+        'will gzip the file.'
+    )
+    parser.add_argument(
+        '--source-lang', choices=['f', 'e'], default='f',
+        help='The source language'
+    )
+    parser.add_argument(
+        '--per-word', metavar='M', type=lower_bound, default=50,
+        help='The number of target words to keep per source word'
+    )
+    parser.add_argument(
+        '--cache-dir', metavar='DIR', default=None,
+        help='Where to cache tokenized data between runs. If unset, data are '
+        'tokenized from scratch every time'
+    )
+    return parser
+
+
 def build_data_train_dev_split_parser(subparsers):
     parser = subparsers.add_parser(
         'split',
@@ -286,10 +615,22 @@ def build_training_parser(subparsers):
         help='The number of epochs with no BLEU improvement after which to '
         'call it quits. If unset, will train until the epoch limit instead.'
     )
-    parser.add_argument(
+    batching = parser.add_mutually_exclusive_group()
+    batching.add_argument(
         '--batch-size', metavar='N', type=lower_bound, default=100,
         help='The number of sequences to process at once'
     )
+    batching.add_argument(
+        '--max-tokens', metavar='T', type=lower_bound, default=None,
+        help='If set, batches hold a variable number of sequences whose '
+        'padded source and target tokens number at most T. Mutually exclusive '
+        'with --batch-size. Implies --bucket'
+    )
+    parser.add_argument(
+        '--bucket', action='store_true', default=False,
+        help='When set, batch together sequences of similar length to cut '
+        'down on padding'
+    )
     parser.add_argument(
         '--device', metavar='DEV', type=torch.device,
         default=torch.device('cpu'),
@@ -298,6 +639,44 @@ def build_training_parser(subparsers):
     parser.add_argument(
         '--seed', type=int, metavar='S', default=0,
         help='The random seed, for reproducibility')
+    parser.add_argument(
+        '--cache-dir', metavar='DIR', default=None,
+        help='Where to cache tokenized data between runs. If unset, data are '
+        'tokenized from scratch every time'
+    )
+    parser.add_argument(
+        '--stream', action='store_true', default=False,
+        help='When set, read data lazily instead of loading it all before '
+        'starting. Cannot be combined with --cache-dir, --bucket, or '
+        '--max-tokens'
+    )
+    parser.add_argument(
+        '--prefetch', metavar='B', type=lambda v: lower_bound(v, 0),
+        default=2,
+        help='How many training batches to load onto the device in the '
+        'background ahead of the current one. 0 loads them synchronously'
+    )
+    parser.add_argument(
+        '--sparse-embeddings', action='store_true', default=False,
+        help='When set, the encoder and decoder embeddings get sparse '
+        'gradients and are updated with sparse Adam, so a batch only updates '
+        'the rows of its words. Other parameters still use dense Adam'
+    )
+    loss = parser.add_mutually_exclusive_group()
+    loss.add_argument(
+        '--loss-chunk-size', metavar='C', type=lower_bound, default=None,
+        help='If set, compute the output layer and loss C target tokens at a '
+        'time, never holding the logits of the whole batch. Cuts peak memory '
+        'at the cost of recomputing the output layer in the backward pass'
+    )
+    loss.add_argument(
+        '--sampled-softmax', metavar='S', type=lower_bound, default=None,
+        help='If set, train with a sampled softmax over the targets of each '
+        'batch and S words drawn by frequency, rather than the whole target '
+        'vocabulary. The reported loss is then that of the sample. Testing '
+        'still uses the full softmax. Mutually exclusive with '
+        '--loss-chunk-size'
+    )
     add_common_model_options(parser)
     return parser
 
@@ -325,19 +704,349 @@ def build_testing_parser(subparsers):
         '--source-lang', choices=['f', 'e'], default='f',
         help='The source language'
     )
-    parser.add_argument(
+    batching = parser.add_mutually_exclusive_group()
+    batching.add_argument(
         '--batch-size', metavar='N', type=lower_bound, default=100,
         help='The number of sequences to process at once'
     )
+    batching.add_argument(
+        '--max-tokens', metavar='T', type=lower_bound, default=None,
+        help='If set, batches hold a variable number of sequences whose '
+        'padded source and target tokens number at most T. Mutually exclusive '
+        'with --batch-size. Implies --bucket'
+    )
+    parser.add_argument(
+        '--bucket', action='store_true', default=False,
+        help='When set, batch together sequences of similar length to cut '
+        'down on padding'
+    )
     parser.add_argument(
         '--device', metavar='DEV', type=torch.device,
         default=torch.device('cpu'),
         help='Where to do training (e.g. "cpu", "cuda")'
     )
+    parser.add_argument(
+        '--cache-dir', metavar='DIR', default=None,
+        help='Where to cache tokenized data between runs. If unset, data are '
+        'tokenized from scratch every time'
+    )
+    parser.add_argument(
+        '--stream', action='store_true', default=False,
+        help='When set, read data lazily instead of loading it all before '
+        'starting. Cannot be combined with --cache-dir, --bucket, or '
+        '--max-tokens'
+    )
+    parser.add_argument(
+        '--continuous', metavar='N', type=lower_bound, default=None,
+        help='If set, beam search N sentences at a time, swapping in the next '
+        'sentence as soon as one finishes rather than waiting for the rest '
+        'of its batch. --batch-size and --max-tokens then only affect how '
+        'data are loaded'
+    )
+    approximate = parser.add_mutually_exclusive_group()
+    approximate.add_argument(
+        '--shortlist', metavar='PATH',
+        type=lambda p: possible_gzipped_file(p, 'rb'), default=None,
+        help='If set, a shortlist built by the "shortlist" command. Beam '
+        'search then only scores the target words on the shortlists of the '
+        'source words in a batch. The test set is decoded both with and '
+        'without it to report the speedup and change in BLEU'
+    )
+    approximate.add_argument(
+        '--output-index', action='store_true', default=False,
+        help='When set, cluster the rows of the decoder\'s output layer and '
+        'only score the words of the most promising clusters at each step of '
+        'beam search, scoring every word for a row when it can\'t be sure it '
+        'found the best ones. The test set is decoded both with and without '
+        'it to report the speedup and change in BLEU'
+    )
+    parser.add_argument(
+        '--shortlist-frequent', metavar='N', type=lambda v: lower_bound(v, 0),
+        default=1000,
+        help='The number of most frequent target words always scored with '
+        '--shortlist'
+    )
+    parser.add_argument(
+        '--index-clusters', metavar='C', type=lower_bound, default=None,
+        help='The number of clusters of --output-index. Defaults to the '
+        'square root of the vocabulary size'
+    )
+    parser.add_argument(
+        '--index-probes', metavar='P', type=lower_bound, default=8,
+        help='How many clusters --output-index scores per beam path. More '
+        'find the best words more often, scoring more of them'
+    )
+    parser.add_argument(
+        '--index-slack', metavar='X', type=float, default=1.,
+        help='How much of each cluster\'s radius --output-index bounds its '
+        'logits by. At 1, a path only skips scoring every word when that '
+        'could not change its best words. Lower values fall back less often, '
+        'at the cost of recall'
+    )
+    parser.add_argument(
+        '--index-frequent', metavar='N', type=lambda v: lower_bound(v, 0),
+        default=100,
+        help='The number of most frequent target words --output-index always '
+        'scores'
+    )
+    parser.add_argument(
+        '--input-table', action='store_true', default=False,
+        help='When set, precompute the product of every target word\'s '
+        'embedding with the decoder cell\'s input weights once, and look it '
+        'up at every step of beam search. Takes V x 4 x 2H floats for an LSTM '
+        '(3 for a GRU, 1 for an RNN)'
+    )
     add_common_model_options(parser)
     return parser
 
 
+def build_bench_parser(subparsers):
+    parser = subparsers.add_parser(
+        'bench', help='Time faster code paths against the ones they replaced')
+    benchmarks = parser.add_subparsers(
+        help='Specific benchmarks', dest='benchmark')
+    tokenizer = benchmarks.add_parser(
+        'tokenizer', help='Tokenize every file in a directory')
+    tokenizer.add_argument(
+        'training_dir', action=readable_dir,
+        help='Where the training data is located'
+    )
+    tokenizer.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    vocab = benchmarks.add_parser(
+        'vocab', help='Load a vocabulary and encode a directory with it')
+    vocab.add_argument(
+        'training_dir', action=readable_dir,
+        help='Where the training data is located'
+    )
+    vocab.add_argument(
+        'lang', choices=['e', 'f'], help='The language of the vocabulary')
+    vocab.add_argument('vocab', help='A text vocabulary file')
+    vocab.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    first_hidden_state = benchmarks.add_parser(
+        'first-hidden-state',
+        help="Build the decoder's first hidden state for various batch sizes")
+    first_hidden_state.add_argument(
+        '--batch-sizes', metavar='N', type=lower_bound, nargs='+',
+        default=[1, 10, 100, 1000],
+        help='The batch sizes to time'
+    )
+    first_hidden_state.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    first_hidden_state.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    attention = benchmarks.add_parser(
+        'attention', help='Attend over sources of various lengths')
+    attention.add_argument(
+        '--source-lens', metavar='S', type=lower_bound, nargs='+',
+        default=[10, 50, 100],
+        help='The source lengths to time'
+    )
+    attention.add_argument(
+        '--batch-size', metavar='N', type=lower_bound, default=100,
+        help='The number of sequences to attend over at once'
+    )
+    attention.add_argument(
+        '--num-steps', metavar='T', type=lower_bound, default=10,
+        help='The number of decoder steps attending over the same sources'
+    )
+    attention.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    attention.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    beam_encoder_states = benchmarks.add_parser(
+        'beam-encoder-states',
+        help='Decode with encoder states replicated per beam path or shared')
+    beam_encoder_states.add_argument(
+        '--beam-widths', metavar='K', type=lower_bound, nargs='+',
+        default=[1, 4, 16],
+        help='The beam widths to time'
+    )
+    beam_encoder_states.add_argument(
+        '--batch-size', metavar='N', type=lower_bound, default=100,
+        help='The number of source sentences'
+    )
+    beam_encoder_states.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    beam_encoder_states.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    teacher_forcing = benchmarks.add_parser(
+        'teacher-forcing',
+        help='Teacher force a decoder without attention on targets of various '
+        'lengths, forwards and backwards')
+    teacher_forcing.add_argument(
+        '--target-lens', metavar='T', type=lambda v: lower_bound(v, 2),
+        nargs='+', default=[10, 30, 50],
+        help='The target lengths to time'
+    )
+    teacher_forcing.add_argument(
+        '--batch-size', metavar='N', type=lower_bound, default=100,
+        help='The number of sequences'
+    )
+    teacher_forcing.add_argument(
+        '--cell-type', choices=['lstm', 'gru', 'rnn'], default='lstm',
+        help='What recurrent architecture the decoder uses'
+    )
+    teacher_forcing.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    teacher_forcing.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    input_table = benchmarks.add_parser(
+        'input-table',
+        help='Step a decoder with and without a precomputed input table')
+    input_table.add_argument(
+        '--beam-widths', metavar='K', type=lower_bound, nargs='+',
+        default=[1, 4, 16],
+        help='The beam widths to time'
+    )
+    input_table.add_argument(
+        '--batch-size', metavar='N', type=lower_bound, default=100,
+        help='The number of source sentences'
+    )
+    input_table.add_argument(
+        '--vocab-size', metavar='V', type=lower_bound, default=20000,
+        help='The number of target words'
+    )
+    input_table.add_argument(
+        '--cell-type', choices=['lstm', 'gru', 'rnn'], default='lstm',
+        help='What recurrent architecture the decoder uses'
+    )
+    input_table.add_argument(
+        '--with-attention', action='store_true', default=False,
+        help='Whether the decoder uses attention'
+    )
+    input_table.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    input_table.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    output_index = benchmarks.add_parser(
+        'output-index',
+        help='Score beam paths with every word and with an output index')
+    output_index.add_argument(
+        '--probes', metavar='P', type=lower_bound, nargs='+',
+        default=[2, 8, 32],
+        help='The numbers of clusters to probe to time'
+    )
+    output_index.add_argument(
+        '--batch-size', metavar='N', type=lower_bound, default=100,
+        help='The number of source sentences'
+    )
+    output_index.add_argument(
+        '--beam-width', metavar='K', type=lower_bound, default=4,
+        help='The number of paths per sentence'
+    )
+    output_index.add_argument(
+        '--vocab-size', metavar='V', type=lower_bound, default=20000,
+        help='The number of target words'
+    )
+    output_index.add_argument(
+        '--slack', metavar='X', type=float, default=1.,
+        help='How much of each cluster\'s radius bounds its logits'
+    )
+    output_index.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    output_index.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    loss = benchmarks.add_parser(
+        'loss',
+        help='Measure the peak memory of the output layer loss, whole and in '
+        'chunks')
+    loss.add_argument(
+        '--num-tokens', metavar='M', type=lower_bound, nargs='+',
+        default=[2000, 8000],
+        help='The numbers of target tokens in a batch to measure'
+    )
+    loss.add_argument(
+        '--vocab-size', metavar='V', type=lower_bound, default=20000,
+        help='The number of target words'
+    )
+    loss.add_argument(
+        '--chunk-size', metavar='C', type=lower_bound, default=1024,
+        help='How many tokens the chunked loss computes logits for at once'
+    )
+    loss.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    optimizer = benchmarks.add_parser(
+        'optimizer',
+        help='Step a word embedding with dense Adam and with sparse Adam')
+    optimizer.add_argument(
+        '--vocab-size', metavar='V', type=lower_bound, default=20000,
+        help='The number of words in the embedding'
+    )
+    optimizer.add_argument(
+        '--num-tokens', metavar='M', type=lower_bound, nargs='+',
+        default=[100, 1000],
+        help='The numbers of tokens in a batch to time'
+    )
+    optimizer.add_argument(
+        '--repeats', metavar='R', type=lower_bound, default=3,
+        help='How many times to repeat each timing. The fastest is kept'
+    )
+    optimizer.add_argument(
+        '--device', metavar='DEV', type=torch.device,
+        default=torch.device('cpu'),
+        help='Where to run (e.g. "cpu", "cuda")'
+    )
+    dataset_memory = benchmarks.add_parser(
+        'dataset-memory',
+        help='Measure the memory a DataLoader worker copies reading a dataset')
+    dataset_memory.add_argument(
+        'training_dir', action=readable_dir,
+        help='Where the training data is located'
+    )
+    dataset_memory.add_argument(
+        'english_vocab', help='English vocabulary file')
+    dataset_memory.add_argument(
+        'french_vocab', help='French vocabulary file')
+    dataset_memory.add_argument(
+        '--source-lang', choices=['f', 'e'], default='f',
+        help='The source language'
+    )
+    dataset_memory.add_argument(
+        '--cache-dir', metavar='DIR', default=None,
+        help='Where to cache tokenized data between runs'
+    )
+    return parser
+
+
 def add_common_model_options(parser):
     parser.add_argument(
         '--with-attention', action='store_true', default=False,
@@ -403,6 +1112,8 @@ def possible_gzipped_file(path, mode='r'):
             mode += 't'
     else:
         open_ = open
+        if path.endswith('.bin') and mode[-1] != 'b':
+            mode += 'b'  # binary vocab files
     try:
         f = open_(path, mode=mode)
     except OSError as e:
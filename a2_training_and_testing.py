@@ -5,37 +5,47 @@
 You don't need anything more than what's been imported here.
 '''
 
+import math
+import time
+
 import torch
 import a2_bleu_score
+import a2_dataloader
 
 
 from tqdm import tqdm
 
 
-def train_for_epoch(model, dataloader, optimizer, device):
+def train_for_epoch(
+        model, dataloader, optimizer, device, prefetch=2,
+        loss_chunk_size=None, num_sampled=None):
     '''Train an EncoderDecoder for an epoch
 
     An epoch is one full loop through the training data. This function:
 
     1. Defines a loss function using :class:`torch.nn.CrossEntropyLoss`,
-       keeping track of what id the loss considers "padding"
+       summed over target tokens
     2. For every iteration of the `dataloader` (which yields triples
        ``F, F_lens, E``)
-       1. Sends ``F`` to the appropriate device via ``F = F.to(device)``. Same
-          for ``F_lens`` and ``E``.
+       1. Receives ``F``, ``F_lens``, and ``E`` already on `device` from a
+          :class:`a2_dataloader.DevicePrefetcher`, which loads the next
+          batches in the background
        2. Zeros out the model's previous gradient with ``optimizer.zero_grad()``
-       3. Calls ``logits = model(F, F_lens, E)`` to determine next-token
-          probabilities.
-       4. Modifies ``E`` for the loss function, getting rid of a token and
-          replacing excess end-of-sequence tokens with padding using
-        ``model.get_target_padding_mask()`` and ``torch.masked_fill``
-       5. Flattens out the sequence dimension into the batch dimension of both
-          ``logits`` and ``E``
-       6. Calls ``loss = loss_fn(logits, E)`` to calculate the batch loss
-       7. Calls ``loss.backward()`` to backpropagate gradients through
+       3. Calls ``logits, E = model.forward_packed(F, F_lens, E)`` to
+          determine next-token probabilities. Only the targets that are not
+          padding (per ``model.get_target_padding_mask()``) are kept, packed
+          into one dimension, and only their logits are computed
+       4. Calls ``loss = loss_fn(logits, E)`` to calculate the summed batch
+          loss, then divides it by the number of target tokens in the batch
+       5. Calls ``loss.backward()`` to backpropagate gradients through
           ``model``
-       8. Calls ``optim.step()`` to update model parameters
-    3. Returns the average loss over sequences
+       6. Calls ``optim.step()`` to update model parameters
+    3. Returns the average loss over target tokens
+
+    Batches may differ in size (e.g. when batching by a token budget), so the
+    returned loss sums per-token losses over the whole epoch before dividing
+    by the total number of target tokens, rather than averaging per-batch
+    means.
 
     Parameters
     ----------
@@ -48,11 +58,26 @@ def train_for_epoch(model, dataloader, optimizer, device):
     optimizer : torch.optim.Optimizer
         Implements some algorithm for updating parameters using gradient
         calculations.
+    prefetch : int, optional
+        The number of batches to load ahead of the current one. If 0, batches
+        are loaded synchronously.
+    loss_chunk_size : int, optional
+        If set, the logits are never stored whole. Steps 3 and 4 instead get
+        the decoder states with ``model.forward_packed(F, F_lens, E,
+        states=True)`` and compute the loss with
+        :func:`chunked_cross_entropy`, `loss_chunk_size` target tokens at a
+        time.
+    num_sampled : int, optional
+        If set, the loss is computed over a sample of the target vocabulary
+        with :func:`sampled_softmax_cross_entropy`, drawing `num_sampled` ids
+        per batch, rather than over all of it. The returned loss is then that
+        of the sample. Cannot be combined with `loss_chunk_size`.
 
     Returns
     -------
     avg_loss : float
-        The total loss divided by the total numer of sequence
+        The total loss divided by the total number of non-padding target
+        tokens
     '''
     # If you want, instead of looping through your dataloader as
     # for ... in dataloader: ...
@@ -65,38 +90,221 @@ def train_for_epoch(model, dataloader, optimizer, device):
     # If you are running into CUDA memory errors part way through training,
     # try "del F, F_lens, E, logits, loss" at the end of each iteration of
     # the loop.
-    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=model.source_pad_id)
+    if loss_chunk_size is not None and num_sampled is not None:
+        raise ValueError(
+            'loss_chunk_size and num_sampled cannot be combined')
+    # padding never reaches the loss, so nothing needs ignoring
+    loss_fn = torch.nn.CrossEntropyLoss(reduction='sum')
     loss_tot = 0.0
-    i = 0
-    seq_count = 0 #NEW
-    for F, F_lens, E in dataloader:
-      seq_count += E.size()[1] #NEW
-      if torch.cuda.is_available():
-        F = F.to(device)
-        F_lens = F_lens.to(device)
-        E = E.to(device)
+    token_count = 0
+    batches = a2_dataloader.DevicePrefetcher(dataloader, device, prefetch)
+    start = time.perf_counter()
+    for F, F_lens, E in batches:
       optimizer.zero_grad()
-      logits = model(F, F_lens, E, device)
-      pad_mask = model.get_target_padding_mask(E)
-      E = E.masked_fill(pad_mask, model.source_pad_id)
-      logits = torch.flatten(logits, 0,1)
-      #logits = torch.cat((logits, torch.zeros(E.shape[1],logits.shape[1],
-      #    device=device)))
-      E = torch.flatten(E[1:, :])
-      loss = loss_fn(logits, E)
+      if loss_chunk_size is not None:
+        logits, E = model.forward_packed(F, F_lens, E, states=True)
+        loss = chunked_cross_entropy(
+            logits, E, model.decoder.ff.weight, model.decoder.ff.bias,
+            loss_chunk_size)
+      elif num_sampled is not None:
+        logits, E = model.forward_packed(F, F_lens, E, states=True)
+        loss = sampled_softmax_cross_entropy(
+            logits, E, model.decoder.ff.weight, model.decoder.ff.bias,
+            num_sampled)
+      else:
+        logits, E = model.forward_packed(F, F_lens, E)
+        loss = loss_fn(logits, E)
+      num_tokens = E.shape[0]
       loss_tot = loss_tot + loss.item()
+      token_count += num_tokens
+      loss = loss / max(num_tokens, 1)
       loss.backward()
       optimizer.step()
       del F, F_lens, E, logits, loss
 
-    #avg_loss = loss_tot / len(dataloader)
-    avg_loss = loss_tot / seq_count #NEW
+    avg_loss = loss_tot / max(token_count, 1)
+    duration = time.perf_counter() - start
     print("************************")
     print("avg_loss : ", avg_loss)
+    print(
+        "data_wait : {:.2f}s ({:.1%} of the epoch)".format(
+            batches.wait_time, batches.wait_time / max(duration, 1e-9)))
     print("************************")
     return avg_loss
 
 
+def build_optimizer(model):
+    '''Build the optimizer to train a model with
+
+    Usually :class:`torch.optim.Adam` over every parameter. Embeddings with
+    sparse gradients (``torch.nn.Embedding(..., sparse=True)``) only touch
+    the rows of the words in a batch, but dense Adam would still update the
+    moments of every row. Their weights get a :class:`torch.optim.SparseAdam`
+    instead, and the other parameters a dense Adam, stepped together by a
+    :class:`SplitOptimizer`.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+
+    Returns
+    -------
+    optimizer : torch.optim.Adam or SplitOptimizer
+    '''
+    sparse = [
+        module.weight for module in model.modules()
+        if isinstance(module, torch.nn.Embedding) and module.sparse]
+    if not sparse:
+        return torch.optim.Adam(model.parameters())
+    dense = [
+        p for p in model.parameters() if all(p is not q for q in sparse)]
+    return SplitOptimizer(
+        torch.optim.SparseAdam(sparse), torch.optim.Adam(dense))
+
+
+class SplitOptimizer(object):
+    '''Several optimizers over disjoint parameters, stepped as one
+
+    Parameters
+    ----------
+    optimizers : torch.optim.Optimizer
+
+    Attributes
+    ----------
+    optimizers : tuple
+    '''
+
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def chunked_cross_entropy(htilde, E, weight, bias, chunk_size=1024):
+    '''Summed cross-entropy of a linear output layer, a chunk at a time
+
+    The same as ``torch.nn.functional.cross_entropy(torch.nn.functional.
+    linear(htilde, weight, bias), E, reduction='sum')``, but the logits are
+    only ever computed for `chunk_size` rows at once, in the forward pass and
+    again in the backward pass. The memory of the ``(M, V)`` logits and their
+    gradient is traded for a second output layer product.
+
+    Parameters
+    ----------
+    htilde : torch.FloatTensor
+        A float tensor of shape ``(M, H)`` of decoder states.
+    E : torch.LongTensor
+        A long tensor of shape ``(M,)`` of the target of every state.
+    weight : torch.FloatTensor
+        The output layer's weight, of shape ``(V, H)``.
+    bias : torch.FloatTensor
+        The output layer's bias, of shape ``(V,)``.
+    chunk_size : int, optional
+        How many rows to compute logits for at once.
+
+    Returns
+    -------
+    loss : torch.FloatTensor
+        The summed loss, a scalar.
+    '''
+    return _ChunkedCrossEntropy.apply(htilde, E, weight, bias, chunk_size)
+
+
+def sampled_softmax_cross_entropy(htilde, E, weight, bias, num_sampled):
+    '''Summed cross-entropy of a linear output layer over sampled words
+
+    Rather than normalizing over the whole vocabulary, each row is normalized
+    over a shared set of candidates: the targets of the batch plus
+    `num_sampled` ids drawn from a log-uniform (Zipfian) distribution. The
+    vocabularies of :func:`a2_dataloader.build_vocab_from_dir` number words
+    from most to least frequent, so this roughly samples words by frequency.
+    Every candidate's logit is corrected by the log of its chance of being
+    drawn, as in Jean et al. (2015), so that the loss estimates the full
+    softmax's. Only the output layer rows of the candidates are used.
+
+    Parameters
+    ----------
+    htilde : torch.FloatTensor
+        A float tensor of shape ``(M, H)`` of decoder states.
+    E : torch.LongTensor
+        A long tensor of shape ``(M,)`` of the target of every state.
+    weight : torch.FloatTensor
+        The output layer's weight, of shape ``(V, H)``.
+    bias : torch.FloatTensor
+        The output layer's bias, of shape ``(V,)``.
+    num_sampled : int
+        How many ids to draw (with replacement) for the batch.
+
+    Returns
+    -------
+    loss : torch.FloatTensor
+        The summed loss over the candidates, a scalar.
+    '''
+    V = weight.shape[0]
+    log_V1 = math.log(V + 1)
+    sampled = torch.rand(num_sampled, device=E.device) * log_V1
+    sampled = (sampled.exp() - 1).long().clamp_(0, V - 1)
+    candidates, inverse = torch.unique(
+        torch.cat([E, sampled]), return_inverse=True)
+    # the chance each candidate was drawn at least once
+    q = (
+        (candidates.double() + 2).log() - (candidates.double() + 1).log()
+    ) / log_V1
+    log_drawn = torch.log(-torch.expm1(num_sampled * torch.log1p(-q)))
+    logits = torch.nn.functional.linear(
+        htilde, weight[candidates], bias[candidates])
+    logits = logits - log_drawn.to(logits.dtype)
+    return torch.nn.functional.cross_entropy(
+        logits, inverse[:E.shape[0]], reduction='sum')
+
+
+class _ChunkedCrossEntropy(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, htilde, E, weight, bias, chunk_size):
+        ctx.save_for_backward(htilde, E, weight, bias)
+        ctx.chunk_size = chunk_size
+        loss = htilde.new_zeros(())
+        for start in range(0, htilde.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            logits = torch.nn.functional.linear(htilde[chunk], weight, bias)
+            loss += torch.nn.functional.cross_entropy(
+                logits, E[chunk], reduction='sum')
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        htilde, E, weight, bias = ctx.saved_tensors
+        grad_htilde = torch.empty_like(htilde)
+        grad_weight = torch.zeros_like(weight)
+        grad_bias = torch.zeros_like(bias)
+        for start in range(0, htilde.shape[0], ctx.chunk_size):
+            chunk = slice(start, start + ctx.chunk_size)
+            # d loss / d logits = softmax(logits) - one_hot(E), recomputed
+            grad_logits = torch.nn.functional.softmax(
+                torch.nn.functional.linear(htilde[chunk], weight, bias), 1)
+            rows = torch.arange(grad_logits.shape[0], device=E.device)
+            grad_logits[rows, E[chunk]] -= 1
+            grad_logits *= grad_loss
+            grad_htilde[chunk] = grad_logits.mm(weight)
+            grad_weight.addmm_(grad_logits.T, htilde[chunk])
+            grad_bias += grad_logits.sum(0)
+        return grad_htilde, None, grad_weight, grad_bias, None
+
+
 def compute_batch_total_bleu(E_ref, E_cand, target_sos, target_eos):
     '''Compute the total BLEU score over elements in a batch
 
@@ -195,3 +403,59 @@ def compute_average_bleu_over_dataset(
     print("avg_bleu : ", avg_bleu)
     print("************************")
     return avg_bleu
+
+
+def compute_average_bleu_over_stream(
+        model, dataloader, target_sos, target_eos, device, batch_size):
+    '''Determine the average BLEU score across sequences searched as a stream
+
+    Like :func:`compute_average_bleu_over_dataset`, but the batches from
+    `dataloader` are split back into sentences and fed to
+    ``model.beam_search_stream``, which searches `batch_size` of them at once
+    and swaps in the next sentence as soon as one finishes.
+
+    Parameters
+    ----------
+    model : EncoderDecoder
+        The model we're testing.
+    dataloader : HansardDataLoader
+        Serves up batches of data.
+    target_sos : int
+        The ID of the start-of-sequence tag in the target vocabulary.
+    target_eos : int
+        The ID of the end-of-sequence tag in the target vocabulary.
+    device : torch.device
+        Where to perform computations.
+    batch_size : int
+        The number of sentences to search at once.
+
+    Returns
+    -------
+    avg_bleu : float
+        The total BLEU score summed over all sequences divided by the number of
+        sequences
+    '''
+    E_refs = dict()
+
+    def sentences():
+        i = 0
+        for F, F_lens, E_ref in dataloader:
+            F = F.to(device)
+            for n, F_len in enumerate(F_lens.tolist()):
+                E_refs[i] = E_ref[:, n:n + 1]
+                i += 1
+                yield F[:F_len, n]
+
+    total_bleu = 0.0
+    seq_count = 0
+    for i, b_1 in model.beam_search_stream(sentences(), batch_size):
+        E_cand = b_1[:, :1].cpu()
+        total_bleu += compute_batch_total_bleu(
+            E_refs.pop(i), E_cand, target_sos, target_eos)
+        seq_count += 1
+
+    avg_bleu = total_bleu / max(seq_count, 1)
+    print("************************")
+    print("avg_bleu : ", avg_bleu)
+    print("************************")
+    return avg_bleu
@@ -0,0 +1,279 @@
+# Copyright 2020 University of Toronto, all rights reserved
+
+'''Unit tests for a2_dataloader.py
+
+These are example tests solely for your benefit and will not count towards
+your grade.
+'''
+
+import os
+from collections import Counter
+
+import pytest
+import torch
+import a2_dataloader
+
+
+def _write_bitext(dir_):
+    # three short debates, one with an empty line and one with an all-OOV line
+    bitext = {
+        'a': (
+            'The cat sat.\n\nA dog barked!\n',
+            'Le chat assis.\n\nUn chien aboie!\n'),
+        'b': (
+            'Zzz qqq.\nThe dog, the cat.\n',
+            'Yyy www.\nLe chien, le chat.\n'),
+        'c': ('Cat 42 sat\n', 'Chat 42 assis\n'),
+    }
+    for prefix, (e, f) in bitext.items():
+        with open(os.path.join(dir_, prefix + '.e'), 'w') as file_:
+            file_.write(e)
+        with open(os.path.join(dir_, prefix + '.f'), 'w') as file_:
+            file_.write(f)
+    english_word2id = a2_dataloader.build_vocab_from_dir(dir_, 'e', 6)
+    french_word2id = a2_dataloader.build_vocab_from_dir(dir_, 'f', 6)
+    return french_word2id, english_word2id
+
+
+def test_corpus_cache_matches_tokenizing(tmp_path):
+    dir_ = str(tmp_path / 'data')
+    os.mkdir(dir_)
+    cache_dir = str(tmp_path / 'cache')
+    french_word2id, english_word2id = _write_bitext(dir_)
+    for source_language in ('e', 'f'):
+        for prefixes in (None, ['c', 'a']):
+            expected = a2_dataloader.HansardDataset(
+                dir_, french_word2id, english_word2id, source_language,
+                prefixes)
+            assert len(expected)
+            for _ in range(2):  # build, then read
+                actual = a2_dataloader.HansardDataset(
+                    dir_, french_word2id, english_word2id, source_language,
+                    prefixes, cache_dir)
+                assert len(actual) == len(expected)
+                for (F_a, E_a), (F_e, E_e) in zip(actual, expected):
+                    assert torch.equal(F_a, F_e)
+                    assert torch.equal(E_a, E_e)
+                    assert E_a[0] == actual.target_sos
+                    assert E_a[-1] == actual.target_eos
+    # one cache per language
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_bucket_batch_sampler(tmp_path):
+    dir_ = str(tmp_path)
+    french_word2id, english_word2id = _write_bitext(dir_)
+    dataset = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id)
+    sampler = a2_dataloader.BucketBatchSampler(dataset, 2, seed=3)
+    epoch_1, epoch_2 = list(sampler), list(sampler)
+    assert sampler.epoch == 2
+    for batches in (epoch_1, epoch_2):
+        assert all(len(batch) <= 2 for batch in batches)
+        assert sorted(sum(batches, [])) == list(range(len(dataset)))
+    # same seed, same batches
+    sampler = a2_dataloader.BucketBatchSampler(dataset, 2, seed=3)
+    assert list(sampler) == epoch_1
+    assert 0. <= sampler.padding_ratio < 1.
+    # sorting the whole dataset in order leaves batches ordered by length
+    sampler = a2_dataloader.BucketBatchSampler(
+        dataset, 1, shuffle=False, pool_size=None)
+    F_lens = [len(dataset[batch[0]][0]) for batch in sampler]
+    assert F_lens == sorted(F_lens)
+    assert sampler.padding_ratio == 0.
+
+
+def test_get_pair_lengths(tmp_path):
+    dir_ = str(tmp_path)
+    french_word2id, english_word2id = _write_bitext(dir_)
+    dataset = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id)
+    # the offsets give the same lengths as reading every pair
+    F_lens, E_lens = a2_dataloader.get_pair_lengths(dataset)
+    F_exp, E_exp = a2_dataloader.get_pair_lengths(list(dataset))
+    assert F_lens.dtype == E_lens.dtype == 'int64'
+    assert F_lens.tolist() == F_exp.tolist() == [len(F) for F, _ in dataset]
+    assert E_lens.tolist() == E_exp.tolist() == [len(E) for _, E in dataset]
+
+
+def test_bucket_batch_sampler_max_tokens(tmp_path):
+    dir_ = str(tmp_path)
+    french_word2id, english_word2id = _write_bitext(dir_)
+    dataset = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id)
+    max_tokens = 12
+    sampler = a2_dataloader.BucketBatchSampler(
+        dataset, None, max_tokens=max_tokens)
+    batches = list(sampler)
+    assert sorted(sum(batches, [])) == list(range(len(dataset)))
+    for batch in batches:
+        F_len = max(len(dataset[i][0]) for i in batch)
+        E_len = max(len(dataset[i][1]) for i in batch)
+        assert len(batch) == 1 or len(batch) * (F_len + E_len) <= max_tokens
+
+
+def test_iterable_dataset_matches_dataset(tmp_path):
+    dir_ = str(tmp_path)
+    french_word2id, english_word2id = _write_bitext(dir_)
+    dataset = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id)
+    expected = [(F.tolist(), E.tolist()) for F, E in dataset]
+    stream = a2_dataloader.HansardIterableDataset(
+        dir_, french_word2id, english_word2id)
+    assert [(F.tolist(), E.tolist()) for F, E in stream] == expected
+    # shuffled and sharded over workers, each pair should still appear once
+    for num_workers in (0, 2):
+        dataloader = a2_dataloader.HansardDataLoader(
+            dir_, french_word2id, english_word2id, stream=True,
+            shuffle=True, shuffle_buffer=2, num_workers=num_workers)
+        for _ in range(2):
+            actual = []
+            for F, F_lens, E in dataloader:
+                for n in range(F.shape[1]):
+                    E_n = E[:, n].tolist()
+                    E_n = E_n[:E_n.index(dataset.target_eos) + 1]
+                    actual.append((F[:F_lens[n], n].tolist(), E_n))
+            assert sorted(actual) == sorted(expected)
+
+
+def test_build_vocabs_from_dir(tmp_path):
+    dir_ = str(tmp_path)
+    _write_bitext(dir_)
+    for num_workers in (1, 2):
+        lang2word2id = a2_dataloader.build_vocabs_from_dir(
+            dir_, 7, num_workers=num_workers)
+        for lang in ('e', 'f'):
+            assert lang2word2id[lang] == a2_dataloader.build_vocab_from_dir(
+                dir_, lang, 7)
+
+
+def test_get_dir_lines_matches_readline(tmp_path):
+    contents = [
+        b'', b'\n', b'The cat,sat 42 times\n\nNo newline at end',
+        b'Windows\r\nline endings\rold mac\n',
+        b'Caf\xc3\xa9 9\nna\xc3\xafve\n',
+        b'a\x1cb\x0bc\x0cd\te  f-g\n',
+    ]
+    for i, data in enumerate(contents):
+        filename = f'{i}.e'
+        (tmp_path / filename).write_bytes(data)
+        expected = []
+        with open(str(tmp_path / filename)) as f:
+            offs, line = f.tell(), f.readline()
+            while line:
+                tokenized = a2_dataloader.TOKENIZER_PATTERN.split(line.lower())
+                expected.append(([w for w in tokenized if w], filename, offs))
+                offs, line = f.tell(), f.readline()
+        actual = a2_dataloader.get_dir_lines(str(tmp_path), 'e', [filename])
+        assert list(actual) == expected
+
+
+def test_binary_vocab_round_trip(tmp_path):
+    word2id = {'the': 2, 'café': 0, 'chat': 1}
+    binary = str(tmp_path / 'vocab.bin')
+    text = str(tmp_path / 'vocab.txt.gz')
+    a2_dataloader.write_word2id_to_file(word2id, binary)
+    assert a2_dataloader.read_word2id_from_file(binary) == word2id
+    a2_dataloader.write_word2id_to_file(
+        a2_dataloader.read_word2id_from_file(binary), text)
+    assert a2_dataloader.read_word2id_from_file(text) == word2id
+    # flipping a byte of the payload should fail the checksum
+    data = bytearray((tmp_path / 'vocab.bin').read_bytes())
+    data[-1] ^= 1
+    (tmp_path / 'vocab.bin').write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        a2_dataloader.read_word2id_from_file(binary)
+
+
+def test_encode_batch():
+    word2id = {'a': 0, 'b': 1}
+    ids, offsets = a2_dataloader.encode_batch(
+        word2id, [['a', 'c'], [], ['b', 'b', 'a']])
+    assert ids.tolist() == [0, 2, 1, 1, 0]
+    assert offsets.tolist() == [0, 2, 2, 5]
+    ids, offsets = a2_dataloader.encode_batch(word2id, [], unk=5)
+    assert ids.tolist() == [] and offsets.tolist() == [0]
+
+
+def test_corpus_cache_only_retokenizes_changed_files(tmp_path, monkeypatch):
+    dir_ = str(tmp_path / 'data')
+    os.mkdir(dir_)
+    cache_dir = str(tmp_path / 'cache')
+    french_word2id, english_word2id = _write_bitext(dir_)
+    a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id, cache_dir=cache_dir)
+    # change one file, touch another without changing it, and add a debate
+    with open(os.path.join(dir_, 'b.e'), 'w') as file_:
+        file_.write('Zzz qqq.\nThe cat, the dog.\n')
+    os.utime(os.path.join(dir_, 'c.f'), ns=(0, 0))
+    with open(os.path.join(dir_, 'd.e'), 'w') as file_:
+        file_.write('A cat\n')
+    with open(os.path.join(dir_, 'd.f'), 'w') as file_:
+        file_.write('Un chat\n')
+    tokenized = []
+    tokenize_dir_ids = a2_dataloader._tokenize_dir_ids
+
+    def _tokenize_dir_ids(dir_, lang, word2id, prefixes):
+        tokenized.extend(p + '.' + lang for p in prefixes)
+        return tokenize_dir_ids(dir_, lang, word2id, prefixes)
+
+    monkeypatch.setattr(a2_dataloader, '_tokenize_dir_ids', _tokenize_dir_ids)
+    actual = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id, cache_dir=cache_dir)
+    assert sorted(tokenized) == ['b.e', 'd.e', 'd.f']
+    monkeypatch.undo()
+    expected = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id)
+    assert len(actual) == len(expected)
+    for (F_a, E_a), (F_e, E_e) in zip(actual, expected):
+        assert torch.equal(F_a, F_e)
+        assert torch.equal(E_a, E_e)
+
+
+@pytest.mark.parametrize('depth', [0, 1, 2])
+def test_device_prefetcher(tmp_path, depth):
+    dir_ = str(tmp_path)
+    french_word2id, english_word2id = _write_bitext(dir_)
+    dataloader = a2_dataloader.HansardDataLoader(
+        dir_, french_word2id, english_word2id, batch_size=1)
+    prefetcher = a2_dataloader.DevicePrefetcher(dataloader, 'cpu', depth)
+    for _ in range(2):
+        batches = list(prefetcher)
+        assert prefetcher.num_batches == len(batches) == len(dataloader)
+        assert prefetcher.wait_time >= 0.
+        for actual, expected in zip(batches, dataloader):
+            assert all(torch.equal(a, e) for a, e in zip(actual, expected))
+    # stopping early shouldn't hang, and errors should reach the caller
+    for _ in zip(range(1), prefetcher):
+        pass
+
+    def broken():
+        yield next(iter(dataloader))
+        raise RuntimeError('broken')
+
+    with pytest.raises(RuntimeError):
+        list(a2_dataloader.DevicePrefetcher(broken(), 'cpu', depth))
+
+
+def test_build_shortlist(tmp_path):
+    dir_ = str(tmp_path)
+    french_word2id, english_word2id = _write_bitext(dir_)
+    dataset = a2_dataloader.HansardDataset(
+        dir_, french_word2id, english_word2id)
+    pair_counts, f_counts, e_counts = Counter(), Counter(), Counter()
+    for F, E in dataset:
+        F, E = F.tolist(), E[1:-1].tolist()
+        f_counts.update(F)
+        e_counts.update(E)
+        pair_counts.update((f, e) for f in F for e in E)
+    e_counts[dataset.target_sos] = e_counts[dataset.target_eos] = len(dataset)
+    for chunk_size in (1, 2, 100):
+        shortlist = a2_dataloader.build_shortlist(dataset, 2, chunk_size)
+        assert shortlist.shape == (dataset.source_vocab_size, 2)
+        for f in range(dataset.source_vocab_size):
+            dice = dict(
+                (e, 2 * c / (f_counts[f] + e_counts[e]))
+                for (f_, e), c in pair_counts.items() if f_ == f)
+            expected = sorted(dice, key=lambda e: (-dice[e], e))[:2]
+            expected += [-1] * (2 - len(expected))
+            assert shortlist[f].tolist() == expected
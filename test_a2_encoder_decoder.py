@@ -7,7 +7,10 @@ your grade.
 '''
 
 
+import warnings
+
 import torch
+import a2_abcs
 import a2_encoder_decoder
 
 
@@ -48,3 +51,403 @@ def test_update_beam():
     assert torch.allclose(b_t_0[1, 1], htilde_t[1, 0])
     assert torch.allclose(b_t_1[:, 1, 0], torch.tensor([0, 0]))
     assert torch.allclose(b_t_1[:, 1, 1], torch.tensor([0, 1]))
+
+
+def test_get_first_hidden_state():
+    torch.manual_seed(2020)
+    S, N, H = 5, 4, 3
+    decoder = a2_encoder_decoder.DecoderWithoutAttention(
+        10, hidden_state_size=2 * H)
+    F_lens = torch.tensor([5, 1, 3, 5])
+    h = torch.rand(S, N, 2 * H, requires_grad=True)
+    htilde_0 = decoder.get_first_hidden_state(h, F_lens)
+    assert htilde_0.shape == (N, 2 * H)
+    for n in range(N):
+        assert torch.equal(htilde_0[n, :H], h[F_lens[n] - 1, n, :H])
+        assert torch.equal(htilde_0[n, H:], h[0, n, H:])
+    # only the states copied over get a gradient
+    htilde_0.sum().backward()
+    assert h.grad.sum() == N * 2 * H
+
+
+def test_attend():
+    torch.manual_seed(2021)
+    S, N, H = 6, 4, 3
+    decoder = a2_encoder_decoder.DecoderWithAttention(
+        10, hidden_state_size=2 * H)
+    F_lens = torch.tensor([6, 2, 1, 4])
+    h = torch.rand(S, N, 2 * H, dtype=torch.double)
+    h = h.masked_fill((torch.arange(S).unsqueeze(-1) >= F_lens)[..., None], 0.)
+    h.requires_grad_()
+    htilde_t = torch.rand(N, 2 * H, dtype=torch.double, requires_grad=True)
+    c_t = decoder.attend(htilde_t, h, F_lens)
+    # one sentence at a time, straight from the definition
+    cos = torch.nn.CosineSimilarity(dim=0, eps=1e-08)
+    for n in range(N):
+        e = torch.stack([cos(htilde_t[n], h[s, n]) for s in range(F_lens[n])])
+        alpha = torch.softmax(e, 0)
+        c_n = (alpha.unsqueeze(-1) * h[:F_lens[n], n]).sum(0)
+        assert torch.allclose(c_t[n], c_n)
+    # padded states get no gradient
+    c_t.sum().backward()
+    assert torch.all(h.grad[1:, 2] == 0.)
+    assert torch.all(h.grad[4:, 3] == 0.)
+
+
+def test_attention_context_built_once_per_batch(monkeypatch):
+    torch.manual_seed(2022)
+    V, N = 8, 3
+    ed = a2_encoder_decoder.EncoderDecoder(
+        a2_encoder_decoder.Encoder, a2_encoder_decoder.DecoderWithAttention,
+        V, V + 1, source_pad_id=V - 1, target_sos=V - 1, target_eos=V,
+        encoder_hidden_size=4, word_embedding_size=4, cell_type='gru',
+        beam_width=2,
+    )
+    built = []
+    init = a2_encoder_decoder.AttentionContext.__init__
+
+    def count(self, *args, **kwargs):
+        built.append(self)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(a2_encoder_decoder.AttentionContext, '__init__', count)
+    F_lens = torch.tensor([5, 2, 4])
+    F = torch.randint(V - 1, (5, N))
+    F = F.masked_fill(torch.arange(5).unsqueeze(-1) >= F_lens, V - 1)
+    E = torch.randint(V - 1, (6, N))
+    E[0] = V - 1
+    E[-1] = V
+    ed.train()
+    ed(F, F_lens, E).sum().backward()
+    assert len(built) == 1
+    assert ed.decoder.attention_context is None
+    ed.eval()
+    with torch.no_grad():
+        ed(F, F_lens, max_T=5)
+    assert len(built) == 2
+    assert ed.decoder.attention_context is None
+
+
+def test_decoder_shares_h_between_rows():
+    torch.manual_seed(2023)
+    S, N, K, H, V = 4, 3, 2, 3, 7
+    decoder = a2_encoder_decoder.DecoderWithAttention(
+        V, word_embedding_size=5, hidden_state_size=2 * H, cell_type='lstm')
+    F_lens = torch.tensor([4, 1, 3])
+    h = torch.rand(S, N, 2 * H)
+    E_tm1 = torch.randint(V, (N * K,))
+    htilde_tm1 = (torch.rand(N * K, 2 * H), torch.rand(N * K, 2 * H))
+    logits, htilde_t = decoder(E_tm1, htilde_tm1, h, F_lens)
+    decoder.attention_context = None
+    h_rep = h.repeat_interleave(K, 1)
+    F_lens_rep = F_lens.repeat_interleave(K)
+    logits_rep, htilde_t_rep = decoder(E_tm1, htilde_tm1, h_rep, F_lens_rep)
+    assert torch.allclose(logits, logits_rep)
+    assert torch.allclose(htilde_t[0], htilde_t_rep[0])
+    assert torch.allclose(htilde_t[1], htilde_t_rep[1])
+
+
+def test_beam_search_sets_finished_sentences_aside(monkeypatch):
+    torch.manual_seed(2024)
+    V, K, H = 6, 3, 2
+    ed = a2_encoder_decoder.EncoderDecoder(
+        a2_encoder_decoder.Encoder, a2_encoder_decoder.DecoderWithoutAttention,
+        V, V, source_pad_id=V - 1, target_sos=V - 2, target_eos=V - 1,
+        encoder_hidden_size=H, word_embedding_size=2, cell_type='gru',
+        beam_width=K,
+    )
+    ed.eval()
+    table = torch.randn(V, V)
+
+    def get_first_hidden_state(h, F_lens):
+        return torch.zeros(h.shape[1], 2 * H)
+
+    def forward(E_tm1, htilde_tm1, h, F_lens):
+        # every path counts its steps in htilde and ends on the step that
+        # matches its source sentence's length
+        htilde_t = htilde_tm1 + 1
+        F_lens = F_lens.repeat_interleave(E_tm1.shape[0] // F_lens.shape[0])
+        logits_t = table[E_tm1].clone()
+        logits_t[:, V - 1] = (htilde_t[:, 0] >= F_lens).float() * 20 - 10
+        return logits_t, htilde_t
+
+    monkeypatch.setattr(
+        ed.decoder, 'get_first_hidden_state', get_first_hidden_state)
+    monkeypatch.setattr(ed.decoder, 'forward', forward)
+    F_lens = torch.tensor([3, 2, 5, 4])
+    h = torch.rand(5, 4, 2 * H)
+    b_1 = ed.beam_search(h, F_lens, 10, 'raise')
+    assert b_1.shape == (6, 4, K)
+    # from the second step on, one sentence is set aside after each step
+    assert ed.beam_rows_decoded == (4 + 4 + 3 + 2 + 1) * K
+    assert ed.beam_rows_skipped == (1 + 2 + 3) * K
+    for n, F_len in enumerate(F_lens.tolist()):
+        b_1_n = ed.beam_search(
+            h[:F_len, n:n + 1], F_lens[n:n + 1], 10, 'raise')
+        assert b_1_n.shape == (F_len + 1, 1, K)
+        assert torch.equal(b_1[:F_len + 1, n:n + 1], b_1_n)
+        assert torch.all(b_1[F_len + 1:, n] == V - 1)
+
+
+def test_beam_search_stream_matches_beam_search(monkeypatch):
+    torch.manual_seed(2025)
+    V, K, H = 6, 3, 2
+    ed = a2_encoder_decoder.EncoderDecoder(
+        a2_encoder_decoder.Encoder, a2_encoder_decoder.DecoderWithoutAttention,
+        V, V, source_pad_id=V - 1, target_sos=V - 2, target_eos=V - 1,
+        encoder_hidden_size=H, word_embedding_size=2, cell_type='gru',
+        beam_width=K,
+    )
+    ed.eval()
+    table = torch.randn(V, V)
+
+    def get_first_hidden_state(h, F_lens):
+        return torch.zeros(h.shape[1], 2 * H)
+
+    def forward(E_tm1, htilde_tm1, h, F_lens):
+        # as above: every path ends on the step matching its source length
+        htilde_t = htilde_tm1 + 1
+        F_lens = F_lens.repeat_interleave(E_tm1.shape[0] // F_lens.shape[0])
+        logits_t = table[E_tm1].clone()
+        logits_t[:, V - 1] = (htilde_t[:, 0] >= F_lens).float() * 20 - 10
+        return logits_t, htilde_t
+
+    monkeypatch.setattr(
+        ed.decoder, 'get_first_hidden_state', get_first_hidden_state)
+    monkeypatch.setattr(ed.decoder, 'forward', forward)
+    F_lens = [3, 2, 5, 4, 1, 1]
+    sentences = [torch.randint(V - 2, (F_len,)) for F_len in F_lens]
+    ed.beam_rows_decoded = 0
+    finished = dict(ed.beam_search_stream(sentences, 2, 10, 'raise'))
+    assert sorted(finished) == list(range(len(F_lens)))
+    # a sentence is decoded for as many steps as it has source words, and a
+    # finished one is never decoded again
+    assert ed.beam_rows_decoded == sum(F_lens) * K
+    for i, F_i in enumerate(sentences):
+        F_i = F_i.unsqueeze(1)
+        F_lens_i = torch.tensor([F_i.shape[0]])
+        b_1_i = ed.beam_search(
+            ed.encoder(F_i, F_lens_i), F_lens_i, 10, 'raise')
+        assert torch.equal(finished[i], b_1_i[:, 0])
+
+
+def test_beam_lattice_paths():
+    torch.manual_seed(1031)
+    T, N, K, V = 7, 3, 4, 10
+    b_tm1_1 = torch.randint(V, (1, N, K))
+    lattice = a2_abcs.BeamLattice(b_tm1_1[0], 2)
+    for t in range(T):
+        k_tm1 = torch.randint(K, (N, K))
+        v = torch.randint(V, (N, K))
+        b_tm1_1 = torch.cat([
+            b_tm1_1.gather(2, k_tm1.unsqueeze(0).expand_as(b_tm1_1)),
+            v.unsqueeze(0)])
+        lattice.append(k_tm1, v)
+        assert torch.equal(lattice.last, v)
+    assert torch.equal(lattice.paths(), b_tm1_1)
+    keep = torch.tensor([True, False, True])
+    assert torch.equal(lattice.paths(keep), b_tm1_1[:, keep])
+    lattice.keep(keep)
+    lattice.forget(3)
+    assert torch.equal(lattice.paths(), b_tm1_1[-3:, keep])
+
+
+def test_shortlist_restricts_target_vocab():
+    torch.manual_seed(1032)
+    S, N, V, H = 4, 3, 12, 3
+    ed = a2_encoder_decoder.EncoderDecoder(
+        a2_encoder_decoder.Encoder, a2_encoder_decoder.DecoderWithoutAttention,
+        V, V, encoder_hidden_size=H, word_embedding_size=2, cell_type='gru',
+        beam_width=2,
+    )
+    ed.eval()
+    F = torch.randint(V - 1, (S, N))
+    F_lens = torch.tensor([4, 2, 3])
+    F[F_lens.unsqueeze(0) <= torch.arange(S).unsqueeze(1)] = V - 1
+    htilde_t = torch.rand(N, 2 * H)
+    logits = ed.decoder.get_current_logits(htilde_t)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        b_1 = ed(F, F_lens, max_T=5)
+        # a shortlist with every word on it changes nothing
+        ed.shortlist = torch.full((V, 1), -1, dtype=torch.long)
+        ed.shortlist_frequent = V
+        assert torch.equal(ed(F, F_lens, max_T=5), b_1)
+        # a source word maps to target words 0 and 1. Padding maps to nothing
+        ed.shortlist_frequent = 0
+        ed.shortlist = torch.tensor([[0, 1]] * (V - 1) + [[-1, -1]])
+        target_vocab = ed.get_target_vocab(F)
+        assert target_vocab.tolist() == [0, 1, ed.target_eos]
+        ed.decoder.target_vocab = target_vocab
+        logits_shortlist = ed.decoder.get_current_logits(htilde_t)
+        assert torch.allclose(logits_shortlist, logits[:, target_vocab])
+        ed.decoder.target_vocab = None
+        b_1 = ed(F, F_lens, max_T=5)
+    assert ed.decoder.target_vocab is None
+    assert torch.all((b_1[1:] < 2) | (b_1[1:] == ed.target_eos))
+
+
+def test_output_index_finds_best_words():
+    torch.manual_seed(1036)
+    S, N, V, H, K = 4, 3, 30, 3, 2
+    ed = a2_encoder_decoder.EncoderDecoder(
+        a2_encoder_decoder.Encoder, a2_encoder_decoder.DecoderWithoutAttention,
+        V, V, encoder_hidden_size=H, word_embedding_size=2, cell_type='lstm',
+        beam_width=K,
+    )
+    ed.eval()
+    ff = ed.decoder.ff
+    always = torch.tensor([ed.target_eos, 0])
+    htilde_t = torch.randn(10, 2 * H)
+    logpy = torch.nn.functional.log_softmax(ff(htilde_t), 1)
+    # probing every cluster scores every word exactly
+    index = a2_encoder_decoder.OutputIndex(
+        ff.weight, ff.bias, num_clusters=5, probes=5, k=K, always=always)
+    assert index.always.tolist() == [0, ed.target_eos]
+    assert sorted(index.members[index.members > 0].tolist()) == list(
+        range(1, V - 1))
+    logpy_index = index.search(htilde_t)
+    candidates = index.candidates
+    assert candidates.shape == (
+        10, 2 + index.probes * index.members.shape[1])
+    found = logpy_index > -float('inf')
+    assert torch.equal(found.sum(1), torch.full((10,), V))
+    assert torch.allclose(
+        logpy_index[found], logpy.gather(1, candidates)[found], atol=1e-5)
+    assert index.rows_exact == 0
+    # probing one cluster finds the same best words, falling back if need be
+    index = a2_encoder_decoder.OutputIndex(
+        ff.weight, ff.bias, num_clusters=5, probes=1, k=K, always=always)
+    logpy_index = index.search(htilde_t)
+    best = index.candidates.gather(1, logpy_index.topk(K, 1)[1])
+    assert torch.equal(best, logpy.topk(K, 1)[1])
+    assert index.rows_searched == 10
+    # beam search only sees the candidates of each path
+    F = torch.randint(V - 1, (S, N))
+    F_lens = torch.tensor([4, 2, 3])
+    F[F_lens.unsqueeze(0) <= torch.arange(S).unsqueeze(1)] = V - 1
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        b_1 = ed(F, F_lens, max_T=5)
+        ed.decoder.output_index = a2_encoder_decoder.OutputIndex(
+            ff.weight, ff.bias, num_clusters=5, probes=5, k=K, always=always)
+        assert torch.equal(ed(F, F_lens, max_T=5), b_1)
+    # training scores every word
+    ed.train()
+    assert ed.decoder.get_current_logits(htilde_t).shape == (10, V)
+
+
+def test_output_index_without_clusters():
+    torch.manual_seed(1037)
+    V, H = 6, 4
+    ff = torch.nn.Linear(H, V)
+    htilde_t = torch.randn(5, H)
+    # every word is always scored, so there is nothing to cluster
+    index = a2_encoder_decoder.OutputIndex(
+        ff.weight, ff.bias, probes=3, k=2, always=torch.arange(V))
+    assert index.centroids.shape[0] == index.probes == 0
+    logpy_index = index.search(htilde_t)
+    assert torch.equal(index.candidates, torch.arange(V).expand(5, V))
+    with torch.no_grad():
+        logpy = torch.nn.functional.log_softmax(ff(htilde_t), 1)
+    assert torch.allclose(logpy_index, logpy, atol=1e-6)
+    assert index.rows_searched == 5 and index.rows_exact == 0
+
+
+def test_teacher_forcing_fused_matches_steps():
+    torch.manual_seed(1033)
+    S, T, N, V, H = 4, 5, 3, 8, 3
+    for cell_type in ('lstm', 'gru', 'rnn'):
+        ed = a2_encoder_decoder.EncoderDecoder(
+            a2_encoder_decoder.Encoder,
+            a2_encoder_decoder.DecoderWithoutAttention,
+            V, V, encoder_hidden_size=H, word_embedding_size=2,
+            cell_type=cell_type,
+        )
+        F_lens = torch.tensor([4, 1, 3])
+        h = torch.rand(S, N, 2 * H)
+        E = torch.randint(V, (T, N))
+        logits = ed.get_logits_for_teacher_forcing(h, F_lens, E)
+        assert logits.shape == (T - 1, N, V)
+        htilde_tm1 = None
+        for t in range(T - 1):
+            logits_t, htilde_tm1 = ed.decoder(E[t], htilde_tm1, h, F_lens)
+            assert torch.allclose(logits[t], logits_t, atol=1e-6)
+        # the weights live in the cell alone
+        assert not any('sequence_rnn' in k for k in ed.state_dict())
+        logits.sum().backward()
+        assert ed.decoder.cell.weight_hh.grad is not None
+
+
+def test_input_table_matches_cell():
+    torch.manual_seed(1035)
+    S, N, V, H = 4, 3, 8, 6
+    F_lens = torch.tensor([4, 1, 3])
+    h = torch.rand(S, N, H)
+    E = torch.randint(V, (3, N))
+    for decoder_class in (
+            a2_encoder_decoder.DecoderWithoutAttention,
+            a2_encoder_decoder.DecoderWithAttention):
+        for cell_type in ('lstm', 'gru', 'rnn'):
+            decoder = decoder_class(
+                V, word_embedding_size=2, hidden_state_size=H,
+                cell_type=cell_type)
+            decoder.eval()
+            input_table = decoder.precompute_input_table()
+            assert input_table.shape == (V, decoder.cell.weight_ih.shape[0])
+            assert not input_table.requires_grad
+            # the padding word's embedding is zero
+            assert torch.allclose(input_table[-1], decoder.cell.bias_ih)
+            htilde = dict.fromkeys(('cell', 'table'))
+            for t in range(E.shape[0]):
+                for name, table in (('cell', None), ('table', input_table)):
+                    decoder.input_table = table
+                    logits_t, htilde[name] = decoder(
+                        E[t], htilde[name], h, F_lens)
+                    decoder.attention_context = None
+                    if name == 'cell':
+                        expected = logits_t
+                assert torch.allclose(logits_t, expected, atol=1e-6)
+            # training never looks the table up
+            decoder.train()
+            assert decoder.get_input_table() is None
+
+
+def test_forward_packed_matches_masked_loss():
+    torch.manual_seed(1034)
+    S, N, V, H = 4, 3, 8, 3
+    F = torch.randint(V - 1, (S, N))
+    F_lens = torch.tensor([4, 2, 3])
+    F[F_lens.unsqueeze(0) <= torch.arange(S).unsqueeze(1)] = V - 1
+    E = torch.tensor([
+        [V - 2, V - 2, V - 2],
+        [1, 2, 3],
+        [V - 1, 4, 5],
+        [V - 1, V - 1, 0],
+        [V - 1, V - 1, V - 1],
+    ])
+    for decoder_class in (
+            a2_encoder_decoder.DecoderWithoutAttention,
+            a2_encoder_decoder.DecoderWithAttention):
+        ed = a2_encoder_decoder.EncoderDecoder(
+            a2_encoder_decoder.Encoder, decoder_class, V, V,
+            encoder_hidden_size=H, word_embedding_size=2, cell_type='lstm',
+            encoder_dropout=0.,
+        )
+        ed.train()
+        logits = ed(F, F_lens, E)
+        E_masked = E[1:].masked_fill(ed.get_target_padding_mask(E[1:]), -100)
+        loss = torch.nn.functional.cross_entropy(
+            logits.flatten(end_dim=1), E_masked.flatten(), reduction='sum')
+        loss.backward()
+        grads = [p.grad.clone() for p in ed.parameters()]
+        ed.zero_grad()
+        logits_packed, E_packed = ed.forward_packed(F, F_lens, E)
+        assert E_packed.tolist() == [1, 2, 3, V - 1, 4, 5, V - 1, 0, V - 1]
+        assert logits_packed.shape == (9, V)
+        loss_packed = torch.nn.functional.cross_entropy(
+            logits_packed, E_packed, reduction='sum')
+        assert torch.allclose(loss, loss_packed)
+        loss_packed.backward()
+        for grad, p in zip(grads, ed.parameters()):
+            assert torch.allclose(grad, p.grad, atol=1e-6)
@@ -0,0 +1,72 @@
+# Copyright 2020 University of Toronto, all rights reserved
+
+'''Unit tests for a2_training_and_testing.py
+
+These are example tests solely for your benefit and will not count towards
+your grade.
+'''
+
+import pytest
+import torch
+import a2_training_and_testing
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 100])
+def test_chunked_cross_entropy(chunk_size):
+    torch.manual_seed(1035)
+    M, H, V = 7, 4, 9
+    ff = torch.nn.Linear(H, V)
+    htilde = torch.randn(M, H, requires_grad=True)
+    E = torch.randint(V, (M,))
+    loss = torch.nn.functional.cross_entropy(ff(htilde), E, reduction='sum')
+    (2 * loss).backward()
+    grads = [x.grad.clone() for x in (htilde, ff.weight, ff.bias)]
+    htilde.grad = ff.weight.grad = ff.bias.grad = None
+    loss_chunked = a2_training_and_testing.chunked_cross_entropy(
+        htilde, E, ff.weight, ff.bias, chunk_size)
+    assert torch.allclose(loss, loss_chunked)
+    (2 * loss_chunked).backward()
+    for grad, x in zip(grads, (htilde, ff.weight, ff.bias)):
+        assert torch.allclose(grad, x.grad, atol=1e-6)
+
+
+def test_sampled_softmax_cross_entropy():
+    torch.manual_seed(1036)
+    M, H, V = 7, 4, 50
+    ff = torch.nn.Linear(H, V)
+    htilde = torch.randn(M, H)
+    E = torch.randint(5, (M,))
+    # with enough draws, every word is a candidate for sure
+    loss = torch.nn.functional.cross_entropy(ff(htilde), E, reduction='sum')
+    loss_sampled = a2_training_and_testing.sampled_softmax_cross_entropy(
+        htilde, E, ff.weight, ff.bias, 10 ** 6)
+    assert torch.allclose(loss, loss_sampled)
+    # otherwise, only the targets and the drawn words get gradients
+    loss_sampled = a2_training_and_testing.sampled_softmax_cross_entropy(
+        htilde, E, ff.weight, ff.bias, 3)
+    loss_sampled.backward()
+    used = ff.bias.grad != 0
+    assert torch.all(used[E])
+    assert 0 < int(used.sum()) <= len(set(E.tolist())) + 3
+
+
+def test_build_optimizer_splits_sparse_embeddings():
+    torch.manual_seed(1037)
+    model = torch.nn.Sequential(
+        torch.nn.Embedding(10, 3, sparse=True), torch.nn.Linear(3, 2))
+    optimizer = a2_training_and_testing.build_optimizer(model)
+    assert isinstance(optimizer, a2_training_and_testing.SplitOptimizer)
+    sparse, dense = optimizer.optimizers
+    assert isinstance(sparse, torch.optim.SparseAdam)
+    assert sparse.param_groups[0]['params'] == [model[0].weight]
+    assert len(dense.param_groups[0]['params']) == 2
+    weight = model[0].weight.detach().clone()
+    optimizer.zero_grad()
+    model(torch.tensor([1, 4])).sum().backward()
+    optimizer.step()
+    # only the rows of the batch's words move
+    moved = torch.any(model[0].weight != weight, 1)
+    assert moved.tolist() == [i in (1, 4) for i in range(10)]
+    model[0].sparse = False
+    assert isinstance(
+        a2_training_and_testing.build_optimizer(model), torch.optim.Adam)